@@ -0,0 +1,500 @@
+import argparse
+import json
+import os
+import random
+import selectors
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from socket import *
+from threading import Thread
+from chatprotocol import CONTROL, FILE_CHUNK_SIZE, FILE_DATA, FILE_DATA_HEADER, TEXT, FrameDecoder, ProtocolError, encode_frame, encode_hello, split_transfer_id
+
+# Benchmarks for chatserver. Both start chatserver.py on a generated config on loopback.
+#
+#   python3 chatbench.py broadcast [--sizes 1,2,4,8] [--messages 5000] [--mode thread|eventloop] [--json]
+#
+# One client sends --messages lines as fast as it can, every member (the sender included) reads
+# until it has all of them. msgs/s counts lines, deliveries/s counts lines times members.
+#
+#   python3 chatbench.py load [--clients 32] [--channels 4] [--duration 10] [--chat-rate 2] ... [--json]
+#
+# Simulated chatclient sessions speaking the framed protocol chat, whisper, /list, /switch, /send
+# files and disconnect and reconnect (queue churn), each at its own rate per session per second.
+# Reports throughput, end-to-end delivery latency percentiles of chat lines and whispers, and the
+# server's CPU time, RSS and thread count (from /proc, Linux only). --json prints the results as
+# JSON so runs of different versions can be compared.
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chatserver.py")
+
+def max_capacity():
+    # chatserver's configuration limit, CHATSERVER_MAX_CAPACITY from the environment the servers started here inherit
+    limit = os.environ.get("CHATSERVER_MAX_CAPACITY", "8")
+    if not limit.isdigit() or int(limit) < 1:
+        sys.exit(f"Error: Invalid CHATSERVER_MAX_CAPACITY \"{limit}\".")
+    return int(limit)
+
+def free_port():
+    with socket(AF_INET, SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+def start_server(script, mode, channels, directory):
+    # channels is a list of (name, port, capacity)
+    config_file = os.path.join(directory, "bench.cfg")
+    with open(config_file, "w") as file:
+        for name, port, capacity in channels:
+            file.write(f"channel {name} {port} {capacity}\n")
+    env = dict(os.environ, CHATSERVER_MODE=mode)
+    process = subprocess.Popen([sys.executable, script, "1000", config_file], stdin=subprocess.PIPE,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env, text=True)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline: # listening once a connect succeeds
+        try:
+            create_connection(("localhost", channels[-1][1])).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    sys.exit("Error: chatserver did not start.")
+
+def stop_server(process):
+    try:
+        process.stdin.write("/shutdown\n")
+        process.stdin.flush()
+        process.wait(5)
+    except (OSError, subprocess.TimeoutExpired):
+        process.kill()
+
+def connect_client(port, username):
+    sock = create_connection(("localhost", port))
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    sock.sendall(encode_hello(username))
+    decoder = FrameDecoder()
+    while True: # until the join message, so every member is in the channel before timing starts
+        data = sock.recv(65536)
+        if not data:
+            sys.exit(f"Error: {username} was disconnected while joining.")
+        for frame_type, payload in decoder.feed(data):
+            if frame_type == TEXT and b"You have joined the channel" in payload:
+                return sock, decoder
+
+def receive_lines(sock, decoder, prefix, count, finished, index):
+    received = 0
+    while received < count:
+        data = sock.recv(1 << 20)
+        if not data:
+            break
+        for frame_type, payload in decoder.feed(data):
+            if frame_type == TEXT and payload.startswith(prefix):
+                received += 1
+    finished[index] = time.perf_counter()
+
+def run_size(script, mode, size, messages, payload_size):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        server = start_server(script, mode, [("bench", port, size)], directory)
+        try:
+            clients = [connect_client(port, f"bench{i}") for i in range(size)]
+            line = "x" * payload_size
+            frame = encode_frame(TEXT, line)
+            prefix = b"[bench0] "
+
+            finished = [None] * size
+            readers = [Thread(target=receive_lines, args=(sock, decoder, prefix, messages, finished, i), daemon=True)
+                       for i, (sock, decoder) in enumerate(clients)]
+            for reader in readers:
+                reader.start()
+
+            start = time.perf_counter()
+            sender = clients[0][0]
+            batch = 64 # frames per sendall, the server sees a steady stream rather than one line per packet
+            for sent in range(0, messages, batch):
+                sender.sendall(frame * min(batch, messages - sent))
+            for reader in readers:
+                reader.join(120)
+            for sock, decoder in clients:
+                sock.close()
+        finally:
+            stop_server(server)
+
+    if None in finished:
+        sys.exit(f"Error: not every line was delivered in a channel of {size}.")
+    elapsed = max(finished) - start
+    return {"size": size, "messages": messages, "seconds": round(elapsed, 4),
+            "msgs_per_sec": round(messages / elapsed), "deliveries_per_sec": round(messages * size / elapsed)}
+
+def broadcast(args):
+    results = [run_size(args.server, args.mode, int(size), args.messages, args.payload) for size in args.sizes.split(",")]
+
+    if args.json:
+        print(json.dumps({"mode": args.mode, "payload": args.payload, "results": results}, indent=2))
+        return
+    print(f"{'size':>6} {'msgs/s':>10} {'deliveries/s':>14}")
+    for result in results:
+        print(f"{result['size']:>6} {result['msgs_per_sec']:>10} {result['deliveries_per_sec']:>14}")
+
+class ProcessSampler:
+    # Samples the server's CPU time, RSS and thread count from /proc every interval seconds
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.rss_kb = []
+        self.threads = []
+        self.running = True
+
+    def cpu_seconds(self):
+        with open(f"/proc/{self.pid}/stat") as file:
+            fields = file.read().rpartition(")")[2].split()
+        return (int(fields[11]) + int(fields[12])) / self.clock_ticks # utime + stime
+
+    def sample(self):
+        with open(f"/proc/{self.pid}/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    self.rss_kb.append(int(line.split()[1]))
+                elif line.startswith("Threads:"):
+                    self.threads.append(int(line.split()[1]))
+
+    def run(self):
+        while self.running:
+            try:
+                self.sample()
+            except OSError: # server gone
+                return
+            time.sleep(self.interval)
+
+class Session:
+    # One simulated chatclient
+    def __init__(self, bench, index):
+        self.bench = bench
+        self.username = f"load{index}"
+        self.sock = None
+        self.decoder = None
+        self.channel = None # channel name once connected
+        self.queued = False
+        self.rejected = False # name still taken, e.g. reconnected before the server saw the old connection go
+        self.next_action = {} # action -> time.monotonic() it is next due
+        self.lines_sent = 0
+        self.uploads = {} # transfer ID -> [file size, bytes sent, window limit]
+        self.downloads = {} # transfer ID -> [file size, bytes received]
+
+    def connect(self, channel_name):
+        self.sock = create_connection(("localhost", self.bench.ports[channel_name]))
+        self.sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.sock.sendall(encode_hello(self.username))
+        self.decoder = FrameDecoder()
+        self.channel = None
+        self.queued = False
+        self.rejected = False
+        self.uploads.clear()
+        self.downloads.clear()
+        self.bench.selector.register(self.sock, selectors.EVENT_READ, self)
+
+    def disconnect(self):
+        self.bench.selector.unregister(self.sock)
+        self.sock.close()
+        self.sock = None
+        self.channel = None
+
+    def send(self, frame_type, message):
+        try:
+            self.sock.sendall(encode_frame(frame_type, message))
+        except OSError:
+            self.bench.errors += 1
+
+    def read(self):
+        try:
+            data = self.sock.recv(1 << 20)
+        except OSError:
+            data = b""
+        try:
+            frames = self.decoder.feed(data) if data else None
+        except ProtocolError:
+            frames = None
+        if frames is None: # dropped by the server, come back later
+            if not self.rejected:
+                self.bench.errors += 1
+            self.disconnect()
+            self.bench.schedule_reconnect(self)
+            return
+        now = time.perf_counter_ns()
+        for frame_type, payload in frames:
+            if frame_type == FILE_DATA:
+                self.receive_file_data(payload)
+            elif frame_type == CONTROL:
+                self.handle_control(payload.decode())
+            else:
+                self.handle_text(payload.decode(), now)
+
+    def handle_text(self, message, now):
+        stamp = message.find(" t=")
+        if stamp >= 0 and message.startswith("[") and "whispers to " in message and "whispers to you]" not in message:
+            pass # the server's copy of our own whisper
+        elif stamp >= 0 and message.startswith("["): # chat line or whisper from a session
+            self.bench.latencies.append(now - int(message[stamp + 3:].split(" ", 1)[0]))
+            if "whispers to you]" in message:
+                self.bench.counts["whispers_delivered"] += 1
+            else:
+                self.bench.counts["chat_delivered"] += 1
+        elif message.startswith("[Server Message] You have joined the channel"):
+            self.channel = message.split('"')[1]
+            self.queued = False
+        elif message.startswith("[Server Message] You are in the waiting queue"):
+            self.channel = None
+            self.queued = True
+        elif "already has user" in message:
+            self.rejected = True
+            self.bench.counts["rejected"] += 1
+        elif message.startswith("[Channel]"):
+            self.bench.counts["list_replies"] += 1
+        elif message.startswith("[Server Message] Sent "):
+            self.bench.counts["files_sent"] += 1
+
+    def handle_control(self, message):
+        message, transfer_id = split_transfer_id(message)
+        words = message.split(" ")
+        if message.startswith("[Server Message] Start transmission."):
+            size = self.bench.file_size
+            self.uploads[transfer_id] = [size, 0, 0]
+            self.send(CONTROL, f"[FileSize] {size} {self.bench.file_digest} {transfer_id}")
+        elif message.startswith("[Server Message] Resume") and transfer_id in self.uploads:
+            self.uploads[transfer_id][1] = int(words[3])
+        elif message.startswith("[Server Message] Window") and transfer_id in self.uploads:
+            self.uploads[transfer_id][2] = int(words[3])
+            self.send_file_data(transfer_id)
+        elif message.startswith("[Server Message] FileSize"): # "FileSize <name> <size> <digest>"
+            self.downloads[transfer_id] = [int(words[4]), 0]
+            self.send(CONTROL, f"[Client Message] Ready 0 {transfer_id}")
+        elif message.startswith("[Server Message] File Transfer Failed"):
+            self.uploads.pop(transfer_id, None)
+            self.downloads.pop(transfer_id, None)
+            self.bench.counts["files_failed"] += 1
+
+    def send_file_data(self, transfer_id):
+        upload = self.uploads[transfer_id]
+        size, sent, limit = upload
+        chunk = self.bench.file_chunk
+        while sent < min(size, limit):
+            length = min(FILE_CHUNK_SIZE, size - sent, limit - sent)
+            self.send(FILE_DATA, FILE_DATA_HEADER.pack(transfer_id, zlib.crc32(chunk[:length])) + chunk[:length])
+            sent += length
+        upload[1] = sent
+        if sent == size:
+            del self.uploads[transfer_id]
+
+    def receive_file_data(self, payload):
+        transfer_id, crc = FILE_DATA_HEADER.unpack_from(payload)
+        download = self.downloads.get(transfer_id)
+        if download is None:
+            return
+        download[1] += len(payload) - FILE_DATA_HEADER.size
+        self.bench.counts["file_bytes"] += len(payload) - FILE_DATA_HEADER.size
+        if download[1] >= download[0]:
+            del self.downloads[transfer_id]
+            self.send(CONTROL, f"[Client Message] Received {transfer_id}")
+
+    def act(self, action):
+        bench = self.bench
+        if action == "chat":
+            self.lines_sent += 1
+            self.send(TEXT, f"t={time.perf_counter_ns()} {bench.padding}")
+        elif action == "whisper":
+            target = bench.random_member(self)
+            if target is None:
+                return
+            self.send(TEXT, f"/whisper {target.username} t={time.perf_counter_ns()} {bench.padding}")
+        elif action == "list":
+            self.send(TEXT, "/list")
+        elif action == "switch":
+            self.send(TEXT, f"/switch {random.choice([name for name in bench.ports if name != self.channel])}")
+        elif action == "send":
+            target = bench.random_member(self)
+            if target is None or self.uploads:
+                return
+            self.send(TEXT, f"/send {target.username} bench.bin")
+        elif action == "churn":
+            self.disconnect()
+            bench.schedule_reconnect(self)
+        bench.counts[action] += 1
+
+class LoadBenchmark:
+    def __init__(self, args):
+        self.args = args
+        self.rates = {"chat": args.chat_rate, "whisper": args.whisper_rate, "list": args.list_rate,
+                      "switch": args.switch_rate, "send": args.send_rate, "churn": args.churn_rate}
+        self.ports = {} # channel name -> port
+        self.selector = selectors.DefaultSelector()
+        self.sessions = []
+        self.reconnects = [] # (time.monotonic(), session)
+        self.latencies = [] # nanoseconds from sending a chat line or whisper to each delivery
+        self.counts = {name: 0 for name in ("chat", "whisper", "list", "switch", "send", "churn", "chat_delivered",
+                                            "whispers_delivered", "list_replies", "files_sent", "files_failed", "file_bytes", "reconnects", "rejected")}
+        self.errors = 0
+        self.padding = "x" * max(0, args.payload - 24)
+        self.file_size = args.file_size
+        self.file_chunk = os.urandom(min(FILE_CHUNK_SIZE, max(1, args.file_size)))
+        self.file_digest = "0" * 64 # not checked by the server, the simulated targets do not keep files
+
+    def random_member(self, session):
+        members = [other for other in self.sessions if other is not session and other.channel == session.channel and other.channel is not None]
+        return random.choice(members) if members else None
+
+    def schedule(self, session, now):
+        for action, rate in self.rates.items():
+            if rate > 0:
+                session.next_action[action] = now + random.expovariate(rate)
+
+    def schedule_reconnect(self, session):
+        session.next_action.clear()
+        self.reconnects.append((time.monotonic() + random.uniform(0.05, 0.5), session))
+
+    def run(self):
+        args = self.args
+        with tempfile.TemporaryDirectory() as directory:
+            channels = [(f"load{i}", free_port(), args.capacity) for i in range(args.channels)]
+            self.ports = {name: port for name, port, capacity in channels}
+            server = start_server(args.server, args.mode, channels, directory)
+            sampler = ProcessSampler(server.pid)
+            Thread(target=sampler.run, daemon=True).start()
+            try:
+                return self.drive(server, sampler)
+            finally:
+                sampler.running = False
+                stop_server(server)
+
+    def drive(self, server, sampler):
+        args = self.args
+        names = list(self.ports)
+        for i in range(args.clients):
+            session = Session(self, i)
+            session.connect(names[i % len(names)])
+            self.sessions.append(session)
+        settle = time.monotonic() + 1
+        while time.monotonic() < settle: # handshakes, joins and queue placements
+            self.poll(0.05)
+        self.latencies.clear()
+
+        cpu_start = sampler.cpu_seconds()
+        start = time.monotonic()
+        for session in self.sessions:
+            self.schedule(session, start)
+        end = start + args.duration
+        while time.monotonic() < end:
+            now = time.monotonic()
+            for session in self.sessions:
+                if session.sock is None:
+                    continue
+                for action, due in list(session.next_action.items()):
+                    if due > now:
+                        continue
+                    rate = self.rates[action]
+                    session.next_action[action] = due + random.expovariate(rate)
+                    if session.queued and action not in ("list", "switch", "churn"): # queued clients can only do these
+                        continue
+                    if session.channel is None and not session.queued:
+                        continue
+                    session.act(action)
+                    if session.sock is None:
+                        break
+            for when, session in list(self.reconnects):
+                if when <= now:
+                    self.reconnects.remove((when, session))
+                    session.connect(random.choice(names))
+                    self.schedule(session, now)
+                    self.counts["reconnects"] += 1
+            due = [when for session in self.sessions for when in session.next_action.values()] + [when for when, session in self.reconnects]
+            self.poll(max(0, min(due + [end]) - time.monotonic()))
+        elapsed = time.monotonic() - start
+
+        drain = time.monotonic() + 1 # deliveries still in flight
+        while time.monotonic() < drain:
+            self.poll(0.05)
+        cpu = sampler.cpu_seconds() - cpu_start
+        return self.report(elapsed, cpu, sampler)
+
+    def poll(self, timeout):
+        for key, mask in self.selector.select(timeout):
+            session = key.data
+            if session.sock is not None:
+                session.read()
+
+    def report(self, elapsed, cpu, sampler):
+        args = self.args
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] / 1e6, 3)
+
+        counts = self.counts
+        return {
+            "config": {"mode": args.mode, "clients": args.clients, "channels": args.channels, "capacity": args.capacity,
+                       "duration": args.duration, "payload": args.payload, "file_size": args.file_size, "rates": self.rates},
+            "elapsed": round(elapsed, 3),
+            "throughput": {
+                **counts,
+                "chat_sent_per_sec": round(counts["chat"] / elapsed, 1),
+                "deliveries_per_sec": round((counts["chat_delivered"] + counts["whispers_delivered"]) / elapsed, 1),
+                "file_mb_per_sec": round(counts["file_bytes"] / elapsed / 1e6, 3),
+            },
+            "latency_ms": {"samples": len(latencies), "p50": percentile(0.5), "p99": percentile(0.99),
+                           "p999": percentile(0.999), "max": percentile(1)},
+            "server": {"cpu_seconds": round(cpu, 3), "cpu_percent": round(100 * cpu / elapsed, 1),
+                       "rss_kb_max": max(sampler.rss_kb, default=None), "threads_max": max(sampler.threads, default=None)},
+            "errors": self.errors,
+        }
+
+def load(args):
+    if not 1 <= args.capacity <= max_capacity():
+        sys.exit(f"Error: --capacity must be between 1 and {max_capacity()}.")
+    result = LoadBenchmark(args).run()
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    throughput, latency, server = result["throughput"], result["latency_ms"], result["server"]
+    print(f"{args.clients} clients, {args.channels} channels, {result['elapsed']}s ({args.mode})")
+    print(f"chat sent/s: {throughput['chat_sent_per_sec']}  deliveries/s: {throughput['deliveries_per_sec']}  file MB/s: {throughput['file_mb_per_sec']}")
+    print(f"whispers: {throughput['whisper']}  lists: {throughput['list']}  switches: {throughput['switch']}  sends: {throughput['send']} "
+          f"(sent {throughput['files_sent']}, failed {throughput['files_failed']})  reconnects: {throughput['reconnects']}")
+    print(f"latency ms: p50 {latency['p50']}  p99 {latency['p99']}  p999 {latency['p999']}  max {latency['max']}  ({latency['samples']} samples)")
+    print(f"server: cpu {server['cpu_percent']}%  rss max {server['rss_kb_max']} kB  threads max {server['threads_max']}  errors: {result['errors']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chatserver.")
+    parser.add_argument("--mode", default="thread", choices=("thread", "eventloop"))
+    parser.add_argument("--server", default=SERVER_SCRIPT, help="chatserver.py to benchmark")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_broadcast = commands.add_parser("broadcast", help="broadcast throughput by channel size")
+    parser_broadcast.add_argument("--sizes", default="1,2,4,8", help="comma separated channel sizes")
+    parser_broadcast.add_argument("--messages", type=int, default=5000, help="chat lines sent per run")
+    parser_broadcast.add_argument("--payload", type=int, default=64, help="characters per chat line")
+    parser_broadcast.set_defaults(run=broadcast)
+
+    parser_load = commands.add_parser("load", help="mixed load from simulated clients, latency percentiles")
+    parser_load.add_argument("--clients", type=int, default=32)
+    parser_load.add_argument("--channels", type=int, default=4)
+    parser_load.add_argument("--capacity", type=int, default=max_capacity(), help="capacity of every channel, extra clients queue (up to CHATSERVER_MAX_CAPACITY)")
+    parser_load.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser_load.add_argument("--payload", type=int, default=64, help="characters per chat line")
+    parser_load.add_argument("--file-size", type=int, default=1 << 18, help="bytes per /send")
+    parser_load.add_argument("--chat-rate", type=float, default=2, help="chat lines per client per second")
+    parser_load.add_argument("--whisper-rate", type=float, default=0.2)
+    parser_load.add_argument("--list-rate", type=float, default=0.05)
+    parser_load.add_argument("--switch-rate", type=float, default=0.02)
+    parser_load.add_argument("--send-rate", type=float, default=0.01)
+    parser_load.add_argument("--churn-rate", type=float, default=0.02, help="disconnects and reconnects per client per second")
+    parser_load.set_defaults(run=load)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
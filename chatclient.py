@@ -1,12 +1,23 @@
 import datetime
 import sys, os, time
+import hashlib
+import json
+import zlib
 from socket import *
 from sys import stdout, stdin, argv, exit
 import re
 from enum import Enum
-from threading import Thread
+from threading import Condition, Lock, Thread
+from chatprotocol import COMPRESSION_CODECS, CONTROL, FILE_CHUNK_SIZE, FILE_DATA, HEADER, RECV_BUFSIZE, TEXT, FILE_DATA_HEADER, TRANSFER_ID_VERSION, Compressor, FrameDecoder, encode_frame, encode_hello, is_hello_reply, parse_hello_reply, split_transfer_id
 
 BUFSIZE = 1024
+FILE_BUFSIZE = 1 << 18 # files are received into one reusable buffer of this size
+JOURNAL_INTERVAL = 1 << 24 # a partial download's journal is brought up to date every this many bytes
+# With CHATCLIENT_CHANNEL set the handshake names that channel, for a server that serves every channel
+# on one shared port (CHATSERVER_SHARED_PORT); port_number is then the shared port
+CHANNEL = os.environ.get("CHATCLIENT_CHANNEL")
+# Compression codecs to offer, comma separated in order of preference; "off" (or nothing known) offers none
+COMPRESSION = tuple(codec for codec in os.environ.get("CHATCLIENT_COMPRESSION", ",".join(COMPRESSION_CODECS)).split(",") if codec in COMPRESSION_CODECS)
 sock = None
 quit = False
 mute = False
@@ -16,6 +27,70 @@ file_path = None
 client_doesnt_exist = False
 sending = True
 
+protocol_version = None # framed protocol version agreed with the server, None for the original protocol
+decoder = None
+compressor = None # Compressor once the server agreed to compression, used with send_lock held
+pending_frames = [] # frames that arrived together with the handshake
+send_lock = Lock() # uploads run in their own threads, whole frames must not interleave
+upload_windows = {} # transfer ID -> offset the server lets the upload send up to, -1 once it failed
+upload_offsets = {} # transfer ID -> offset the upload resumes from
+upload_window_changed = Condition()
+
+# files being received from the server by transfer ID (None without transfer IDs, one file at a time)
+incoming_files = {}
+incoming_frame_file = None # file the current FILE_DATA frame belongs to
+incoming_frame_left = 0 # payload bytes of the current FILE_DATA frame not read yet
+file_buffer = bytearray(FILE_BUFSIZE)
+
+class IncomingFile:
+    # Bytes go straight to file (None if it could not be opened) under a temporary name. With a digest
+    # from the sender the download is checked chunk by chunk and a journal next to the partial file
+    # records how much of it is verified, so the same file sent again resumes from there.
+    def __init__(self, transfer_id, basename, file_size, digest):
+        self.transfer_id = transfer_id
+        self.basename = basename
+        self.file_size = file_size
+        self.digest = digest
+        self.received = 0
+        self.verified = 0 # end of the last chunk whose checksum matched
+        self.journaled = 0
+        self.resumed_from = 0
+        self.sha256 = hashlib.sha256()
+        self.chunk_crc = None # running CRC-32 and expected CRC-32 of the chunk being received
+        self.chunk_expected = None
+        self.chunk_left = 0
+        self.failed = False
+        self.started = time.monotonic()
+        self.file = open_incoming_file(self)
+
+    def journal_path(self):
+        return self.basename + ".journal"
+
+    def write_journal(self):
+        # Only verified bytes are recorded, written to the side and renamed so a crash never leaves half a journal
+        if self.digest is None or self.file is None or self.verified == self.journaled:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        journal = {"size": self.file_size, "digest": self.digest, "offset": self.verified}
+        with open(self.journal_path() + ".tmp", "w") as f:
+            json.dump(journal, f)
+        os.replace(self.journal_path() + ".tmp", self.journal_path())
+        self.journaled = self.verified
+
+    def close(self, keep):
+        # Stop receiving, keeping the partial file and its journal for a resume if keep
+        self.failed = True
+        incoming_files.pop(self.transfer_id, None)
+        if self.file is None:
+            return
+        if keep and self.digest is not None:
+            self.write_journal()
+        self.file.close()
+        if not keep or self.digest is None:
+            remove_quietly(self.file.name)
+            remove_quietly(self.journal_path())
+
 class EXIT_CODES(Enum):
     USAGE_ERROR = 3
     PORT_CHECK_ERROR = 7
@@ -61,6 +136,91 @@ def start_connection(port):
         print(f"Error: Unable to connect to port {port}.", file=sys.stderr)
         exit(EXIT_CODES.PORT_CHECK_ERROR.value)
 
+def send_message(sock, message, frame_type=TEXT):
+    with send_lock:
+        if protocol_version is None:
+            sock.send(message.encode())
+        elif message: # an empty line has nothing to send
+            sock.sendall(compressed(encode_frame(frame_type, message)))
+
+def compressed(data):
+    # data as it goes on the wire, call with send_lock held so the stream stays in send order
+    return data if compressor is None else compressor.compress(data)
+
+def send_file_frame(sock, header, file, offset, count):
+    # One FILE_DATA frame, call with send_lock held. Uncompressed the kernel copies the file bytes with sendfile.
+    if compressor is None:
+        sock.sendall(header)
+        sock.sendfile(file, offset, count)
+    else:
+        sock.sendall(compressor.compress(header + os.pread(file.fileno(), count, offset)))
+
+def has_transfer_ids():
+    return protocol_version is not None and protocol_version >= TRANSFER_ID_VERSION
+
+def read_messages(sock):
+    # One recv split into (frame type, payload) messages, an empty payload means the server closed.
+    # File bytes are written out here and not returned.
+    global pending_frames, incoming_frame_left, incoming_frame_file
+    if pending_frames:
+        frames, pending_frames = pending_frames, []
+        return frames
+
+    if protocol_version is not None:
+        if incoming_frame_left: # file bytes go straight into the buffer, not through the decoder
+            data = receive_file_bytes(sock, incoming_frame_left)
+            if not data:
+                return [(TEXT, b"")]
+            incoming_frame_left -= len(data)
+            if incoming_frame_file is not None:
+                receive_file_data(sock, incoming_frame_file, data)
+            return []
+        data = sock.recv(RECV_BUFSIZE)
+        if not data:
+            return [(TEXT, b"")]
+        messages = []
+        for frame_type, payload in decoder.feed(data):
+            if frame_type == FILE_DATA:
+                receive_frame(sock, payload, len(payload))
+            elif payload:
+                messages.append((frame_type, payload))
+        header_size = FILE_DATA_HEADER.size if has_transfer_ids() else 0
+        partial = decoder.take_partial(FILE_DATA, header_size) if incoming_files else None
+        if partial is not None:
+            payload, incoming_frame_left = partial
+            incoming_frame_file = receive_frame(sock, payload, len(payload) + incoming_frame_left)
+        return messages
+
+    incoming = incoming_files.get(None)
+    if incoming is not None: # don't read past the end of the file
+        data = receive_file_bytes(sock, incoming.file_size - incoming.received)
+        if not data:
+            return [(TEXT, b"")]
+        receive_file_data(sock, incoming, data)
+        return []
+    return [(TEXT, sock.recv(BUFSIZE))]
+
+def receive_file_bytes(sock, count):
+    # recv_into the reusable file buffer, returns a view of what was read
+    received = sock.recv_into(file_buffer, min(FILE_BUFSIZE, count))
+    return memoryview(file_buffer)[:received]
+
+def receive_frame(sock, payload, length):
+    # Start of a FILE_DATA frame of length bytes, returns the file it belongs to
+    if not has_transfer_ids():
+        incoming = incoming_files.get(None)
+    else:
+        transfer_id, crc = FILE_DATA_HEADER.unpack_from(payload)
+        incoming = incoming_files.get(transfer_id)
+        if incoming is None:
+            return None
+        incoming.chunk_crc, incoming.chunk_expected = 0, crc
+        incoming.chunk_left = length - FILE_DATA_HEADER.size
+        payload = payload[FILE_DATA_HEADER.size:]
+    if incoming is not None:
+        receive_file_data(sock, incoming, payload)
+    return incoming
+
 def handle_stdin(sock):
     global quit, mute, mute_duration, file_path, sending
     while True: 
@@ -76,7 +236,7 @@ def handle_stdin(sock):
                         sys.stdout.flush()
                     else:
                         quit = True
-                        sock.send(line.encode())
+                        send_message(sock, line)
                         sock.close()
                         sys.exit(0)
                 elif commands[0] == "/list" or commands[0] == "/list\n":
@@ -84,7 +244,7 @@ def handle_stdin(sock):
                         print("[Server Message] Usage: /list", file=sys.stdout)
                         sys.stdout.flush()
                     else: 
-                        sock.send(line.encode()) # server will handle list command
+                        send_message(sock, line) # server will handle list command
                 elif commands[0] == "/whisper" or commands[0] == "/whisper\n":
                     commands = line.split(maxsplit=2)
                     if len(commands) != 3: # too little/many arguments, unnecessary since maxsplit 2
@@ -94,7 +254,7 @@ def handle_stdin(sock):
                     elif mute: 
                         print(f"[Server Message] You are still in mute for {mute_duration} seconds.", file=sys.stdout, flush=True)
                     else: 
-                        sock.send(line.encode()) # server will handle whisper command
+                        send_message(sock, line) # server will handle whisper command
                 elif commands[0] == "/send" or commands[0] == "/send\n":
                     commands = line.split(maxsplit=2)
                     if len(commands) != 3:
@@ -107,7 +267,7 @@ def handle_stdin(sock):
                         print(f"[Server Message] You are still in mute for {mute_duration} seconds.", file=sys.stdout, flush=True)
                     else:
                         file_path = commands[2].strip()
-                        sock.send(line.encode())
+                        send_message(sock, line)
                         sending = True
                 elif commands[0] == "/switch":
                     if len(commands) != 2: # too little/many arguments
@@ -115,130 +275,353 @@ def handle_stdin(sock):
                     elif commands[1] == "" or commands[1] == " ":
                         print("[Server Message] Usage: /switch channel_name", file=sys.stdout, flush=True)
                     else: 
-                        sock.send(line.encode())
+                        send_message(sock, line)
                 elif commands[0] == "/switch\n": 
                     print("[Server Message] Usage: /switch channel_name", file=sys.stdout, flush=True) 
+                elif commands[0] == "/history":
+                    if len(commands) == 3 and commands[1] == "since" and commands[2] != "":
+                        send_message(sock, line) # server checks the timestamp and replies from its archive
+                    elif len(commands) != 2 or not commands[1].isdigit() or int(commands[1]) == 0:
+                        print("[Server Message] Usage: /history message_count", file=sys.stdout, flush=True)
+                    else:
+                        send_message(sock, line) # server replies with the channel's last chat lines
+                elif commands[0] == "/search":
+                    if line.partition(" ")[2].strip() == "":
+                        print("[Server Message] Usage: /search text", file=sys.stdout, flush=True)
+                    else:
+                        send_message(sock, line)
                 else:
                     if mute: 
                         print(f"[Server Message] You are still in mute for {mute_duration} seconds.", file=sys.stdout, flush=True)
                     else:
-                        sock.send(line.encode())
+                        send_message(sock, line)
         except KeyboardInterrupt:
             sock.close()
             sys.exit(0)
             break
 
 def handle_socket(sock, client_username):
-    global quit, mute, mute_duration, client_doesnt_exist, file_path, sending
-
     while True: 
         try: 
-            data = sock.recv(BUFSIZE).decode().strip()
-
-            if re.match(r'^\[Server Message\] .+ is not in the channel\.$', data): 
-                print(data, file=sys.stdout,flush=True)
-                client_doesnt_exist = True # server gave error that client sending to doesn't exist
-                continue
-
-            if data == "[Server Message] Start transmission." and sending == True:
-                try:
-                    with open(file_path, "rb") as file:
-
-                        if client_doesnt_exist: # don't send 
-                            continue
-                        else: # send
-                            file_data = file.read()
-
-                            # Send file size
-                            file_size = len(file_data)
-                            message = f"[FileSize] {file_size}"
-                            sock.sendall(message.encode())
-
-                            # Send file data 
-                            sock.sendall(file_data)
-                except FileNotFoundError:
-                    print(f"[Server Message] \"{file_path}\" does not exist.", file=sys.stdout, flush=True)
-                    
-                    
-                sending = False
-                file_path = None
-                client_doesnt_exist = False
-                continue # stop with sending 
-
-            client_doesnt_exist = False
-            sending = False
-            file_path = None
-
-            if re.match(r"^\[Server Message\] FileSize \S+ \d+$", data): # server wants to send file
-                data = data.strip()
-                commands = data.split(" ")
-                file_size = int(commands[4])
-                basename = commands[3]
-    	
-                message = "[Client Message] Ready"
-                sock.sendall(message.encode())
-
-                file_data = b""
-                while len(file_data) < file_size: 
-                    current = sock.recv(min(BUFSIZE, file_size - len(file_data)))
-                    if not current:
-                        # failed
-                        message = "[Client Message] File Transfer Failed"
-                        sock.sendall(message.encode())
-                        continue
-                    file_data += current
-
-                if not len(file_data) == file_size: 
-                    message = "[Client Message] File Transfer Failed"
-                    sock.sendall(message.encode())
-                else: 
-                    message = "[Client Message] Received"
-                    sock.sendall(message.encode())
-
-                    try:
-                        with open(basename, "wb") as f:
-                            f.write(file_data)
-                    except PermissionError:
-                        message = "[Client Message] File Transfer Failed"
-                        sock.sendall(message.encode())
-
-                continue
-
-            connected_message = f"Welcome to chatclient, {client_username}."
-            if data == connected_message:
-                mute = False
-            
-            afk_message = rf'^\[Server Message\] {re.escape(client_username)} went AFK in channel ".*?"\.$'
-            if re.match(afk_message, data):
-                print(data, file=sys.stdout, flush=True)
-                os._exit(0)
-
-            empty_kick_message = "[Server Message] You are removed from the channel."
-            if data == empty_kick_message:
-                print(data, file=sys.stdout,flush=True)
-                os._exit(0)
-
-            if not data:
-                if not quit:
-                    print("Error: server connection closed.", file=sys.stderr, flush=True)
-                    os._exit(EXIT_CODES.DISCONNECT_ERROR.value)
-                else:
-                    os._exit(0)
-
-            mute_message = r'^\[Server Message\] You have been muted for .*? seconds\.$'
-            if re.match(mute_message, data):
-                print(data, file=sys.stdout, flush=True)
-                # Extract duration
-                match = re.search(r"(\b\d+)", data)
-                duration = int(match.group(1))
-                handle_mute(duration)
-            else:   
-                print(data, file=sys.stdout, flush=True)
+            for frame_type, payload in read_messages(sock):
+                handle_server_message(sock, client_username, frame_type, payload.decode().strip())
         except KeyboardInterrupt:
             sock.close()
             sys.exit(0)
             break
 
+def handle_server_message(sock, client_username, frame_type, data):
+    global quit, mute, mute_duration, client_doesnt_exist, file_path, sending
+
+    # file transfer messages come as CONTROL frames, the original protocol can only match on text
+    control = frame_type == CONTROL or protocol_version is None
+
+    if control and has_transfer_ids():
+        handle_transfer_message(sock, data)
+        return
+
+    if re.match(r'^\[Server Message\] .+ is not in the channel\.$', data): 
+        print(data, file=sys.stdout,flush=True)
+        client_doesnt_exist = True # server gave error that client sending to doesn't exist
+        return
+
+    if control and data == "[Server Message] Start transmission." and sending == True:
+        try:
+            with open(file_path, "rb") as file:
+
+                if client_doesnt_exist: # don't send 
+                    pass
+                else: # send
+                    send_file(sock, file, file_path)
+        except FileNotFoundError:
+            print(f"[Server Message] \"{file_path}\" does not exist.", file=sys.stdout, flush=True)
+            
+            
+        sending = False
+        file_path = None
+        client_doesnt_exist = False
+        return # stop with sending 
+
+    client_doesnt_exist = False
+    sending = False
+    file_path = None
+
+    if control and re.match(r"^\[Server Message\] FileSize \S+ \d+$", data): # server wants to send file
+        data = data.strip()
+        commands = data.split(" ")
+        receive_file(sock, None, commands[3], int(commands[4]))
+        return
+
+    connected_message = f"Welcome to chatclient, {client_username}."
+    if data == connected_message:
+        mute = False
+    
+    afk_message = rf'^\[Server Message\] {re.escape(client_username)} went AFK in channel ".*?"\.$'
+    if re.match(afk_message, data):
+        print(data, file=sys.stdout, flush=True)
+        os._exit(0)
+
+    empty_kick_message = "[Server Message] You are removed from the channel."
+    if data == empty_kick_message:
+        print(data, file=sys.stdout,flush=True)
+        os._exit(0)
+
+    if not data:
+        if not quit:
+            print("Error: server connection closed.", file=sys.stderr, flush=True)
+            os._exit(EXIT_CODES.DISCONNECT_ERROR.value)
+        else:
+            os._exit(0)
+
+    mute_message = r'^\[Server Message\] You have been muted for .*? seconds\.$'
+    if re.match(mute_message, data):
+        print(data, file=sys.stdout, flush=True)
+        # Extract duration
+        match = re.search(r"(\b\d+)", data)
+        duration = int(match.group(1))
+        handle_mute(duration)
+    else:   
+        print(data, file=sys.stdout, flush=True)
+
+def handle_transfer_message(sock, data):
+    # File transfer control messages when every transfer has an ID, any number can run at once
+    data, transfer_id = split_transfer_id(data)
+    commands = data.split(" ")
+    if transfer_id is None:
+        return
+    if data.startswith("[Server Message] Start transmission. ") and len(commands) == 5:
+        upload_thread = Thread(target=upload_file, args=(sock, commands[4], transfer_id))
+        upload_thread.daemon = True
+        upload_thread.start()
+    elif re.match(r"^\[Server Message\] (Window|Resume) \d+$", data): # upload may send more, from where
+        with upload_window_changed:
+            if commands[2] == "Window":
+                upload_windows[transfer_id] = int(commands[3])
+            else:
+                upload_offsets[transfer_id] = int(commands[3])
+            upload_window_changed.notify_all()
+    elif re.match(r"^\[Server Message\] FileSize \S+ \d+ ([0-9a-f]{64}|-)$", data): # server wants to send file
+        digest = commands[5] if commands[5] != "-" else None
+        receive_file(sock, transfer_id, commands[3], int(commands[4]), digest)
+    elif data == "[Server Message] File Transfer Failed":
+        incoming = incoming_files.get(transfer_id)
+        if incoming is not None: # sender went away, keep what arrived for when it sends again
+            incoming.close(True)
+        else: # our upload, the target went away
+            with upload_window_changed:
+                upload_windows[transfer_id] = -1
+                upload_window_changed.notify_all()
+
+def upload_file(sock, path, transfer_id):
+    try:
+        with open(path, "rb") as file:
+            send_file(sock, file, path, transfer_id)
+    except FileNotFoundError:
+        print(f"[Server Message] \"{path}\" does not exist.", file=sys.stdout, flush=True)
+    except OSError: # connection gone, the socket thread reports it
+        pass
+
+def send_file(sock, file, path, transfer_id=None):
+    # Upload with sendfile so the file is copied to the socket by the kernel, not through Python
+    file_size = os.fstat(file.fileno()).st_size
+    started = time.monotonic()
+
+    # Send file size, with transfer IDs also the digest that identifies the file for a resume
+    message = f"[FileSize] {file_size}"
+    if transfer_id is not None:
+        digest, chunk_crcs = checksum_file(file)
+        message += f" {digest} {transfer_id}"
+    send_message(sock, message, CONTROL)
+
+    # Send file data, a frame at a time so chat and other transfers go out in between
+    if protocol_version is None:
+        with send_lock:
+            sock.sendfile(file, 0, file_size)
+    elif transfer_id is None:
+        for offset in range(0, file_size, FILE_CHUNK_SIZE):
+            count = min(FILE_CHUNK_SIZE, file_size - offset)
+            with send_lock:
+                send_file_frame(sock, HEADER.pack(count, FILE_DATA), file, offset, count)
+    else:
+        offset = wait_for_resume(transfer_id)
+        start = offset
+        while offset is not None and offset < file_size:
+            # whole chunks only, each with the checksum taken before the upload started
+            window = wait_for_window(transfer_id, offset)
+            if window < 0: # target went away
+                offset = None
+                break
+            chunk = offset // FILE_CHUNK_SIZE
+            count = min(FILE_CHUNK_SIZE, file_size - offset)
+            with send_lock:
+                header = HEADER.pack(FILE_DATA_HEADER.size + count, FILE_DATA) + FILE_DATA_HEADER.pack(transfer_id, chunk_crcs[chunk])
+                send_file_frame(sock, header, file, offset, count)
+            offset += count
+        with upload_window_changed:
+            upload_windows.pop(transfer_id, None)
+            upload_offsets.pop(transfer_id, None)
+        if offset is None:
+            return
+        file_size -= start
+    report_throughput("Sent", path, file_size, started)
+
+def checksum_file(file):
+    # SHA-256 of the whole file and the CRC-32 of every FILE_CHUNK_SIZE chunk, in one pass
+    sha256 = hashlib.sha256()
+    chunk_crcs = []
+    for data in iter(lambda: file.read(FILE_CHUNK_SIZE), b""):
+        sha256.update(data)
+        chunk_crcs.append(zlib.crc32(data))
+    return sha256.hexdigest(), chunk_crcs
+
+def wait_for_resume(transfer_id):
+    # Offset the target wants the file from, None if the transfer failed first
+    with upload_window_changed:
+        while transfer_id not in upload_offsets and upload_windows.get(transfer_id) != -1:
+            upload_window_changed.wait()
+        return upload_offsets.get(transfer_id)
+
+def wait_for_window(transfer_id, offset):
+    # Window limit past offset, -1 if the transfer failed
+    with upload_window_changed:
+        while 0 <= upload_windows.get(transfer_id, 0) <= offset:
+            upload_window_changed.wait()
+        return upload_windows[transfer_id]
+
+def receive_file(sock, transfer_id, basename, file_size, digest=None):
+    incoming = IncomingFile(transfer_id, basename, file_size, digest)
+    incoming_files[transfer_id] = incoming
+    message = "[Client Message] Ready"
+    if transfer_id is not None:
+        message += f" {incoming.received}"
+    send_transfer_message(sock, message, transfer_id)
+    if incoming.received == file_size:
+        receive_file_data(sock, incoming, b"")
+
+def send_transfer_message(sock, message, transfer_id):
+    if transfer_id is not None:
+        message += f" {transfer_id}"
+    send_message(sock, message, CONTROL)
+
+def open_incoming_file(incoming):
+    # Received bytes are written under a temporary name and renamed once the file is complete.
+    # A journal for the same file (size and digest) means its verified part is already there.
+    path = incoming.basename + ".part"
+    offset = read_journal(incoming)
+    try:
+        if offset:
+            file = open(path, "r+b")
+            rehash_partial_file(incoming, file, offset)
+            return file
+        file = open(path, "wb")
+    except OSError: # e.g. no permission, the bytes are still read and the transfer reported as failed
+        return None
+    try:
+        os.posix_fallocate(file.fileno(), 0, incoming.file_size)
+    except (AttributeError, OSError): # preallocation is only an optimisation
+        pass
+    return file
+
+def read_journal(incoming):
+    if incoming.digest is None:
+        return 0
+    try:
+        with open(incoming.journal_path()) as f:
+            journal = json.load(f)
+        if journal["size"] != incoming.file_size or journal["digest"] != incoming.digest:
+            return 0
+        offset = int(journal["offset"])
+        if offset % FILE_CHUNK_SIZE and offset != incoming.file_size: # resumes start on a chunk
+            return 0
+        if os.path.getsize(incoming.basename + ".part") < offset:
+            return 0
+        return offset
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+
+def rehash_partial_file(incoming, file, offset):
+    # The whole-file digest is checked at the end, so the kept part goes through it again
+    left = offset
+    while left:
+        data = file.read(min(FILE_BUFSIZE, left))
+        if not data:
+            break
+        incoming.sha256.update(data)
+        left -= len(data)
+    file.seek(offset)
+    incoming.received = incoming.verified = incoming.journaled = incoming.resumed_from = offset - left
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def receive_file_data(sock, incoming, payload):
+    if incoming.failed:
+        return
+    payload = payload[:incoming.file_size - incoming.received]
+    incoming.received += len(payload)
+    if incoming.digest is not None:
+        incoming.sha256.update(payload)
+    if incoming.file is not None:
+        try:
+            incoming.file.write(payload)
+        except OSError:
+            incoming.file.close()
+            remove_quietly(incoming.file.name)
+            incoming.file = None
+
+    if incoming.chunk_expected is not None: # checksum of the chunk being received
+        incoming.chunk_crc = zlib.crc32(payload, incoming.chunk_crc)
+        incoming.chunk_left -= len(payload)
+        if incoming.chunk_left <= 0:
+            if incoming.chunk_crc != incoming.chunk_expected:
+                finish_download(sock, incoming, False, True)
+                return
+            incoming.chunk_expected = None
+            incoming.verified = incoming.received
+            if incoming.verified - incoming.journaled >= JOURNAL_INTERVAL:
+                incoming.write_journal()
+    else:
+        incoming.verified = incoming.received
+
+    if incoming.received < incoming.file_size:
+        return
+
+    ok = incoming.file is not None
+    if ok and incoming.digest is not None and incoming.sha256.hexdigest() != incoming.digest:
+        ok = False
+    finish_download(sock, incoming, ok, False)
+
+def finish_download(sock, incoming, ok, keep):
+    # Report a failure before "Received", which completes the transfer on the server
+    incoming.failed = True
+    file = incoming.file
+    if ok:
+        incoming_files.pop(incoming.transfer_id, None)
+        try:
+            file.truncate()
+            file.close()
+            os.replace(file.name, incoming.basename)
+            remove_quietly(incoming.journal_path())
+        except OSError:
+            ok = False
+    if not ok:
+        incoming.close(keep)
+        message = "[Client Message] File Transfer Failed"
+        send_transfer_message(sock, message, incoming.transfer_id)
+    else:
+        report_throughput("Received", incoming.basename, incoming.file_size - incoming.resumed_from, incoming.started)
+
+    message = "[Client Message] Received"
+    send_transfer_message(sock, message, incoming.transfer_id)
+
+def report_throughput(action, name, file_size, started):
+    elapsed = max(time.monotonic() - started, 1e-6)
+    rate = file_size / elapsed / (1 << 20)
+    print(f"[Transfer] {action} \"{name}\": {file_size} bytes in {elapsed:.3f}s ({rate:.1f} MB/s)", file=sys.stderr, flush=True)
+
 def handle_mute(duration):
     global mute, mute_duration, mute_counter
     
@@ -259,6 +642,38 @@ def handle_mute(duration):
     unmute_thread.daemon = True
     unmute_thread.start()
 
+def handshake_response(sock):
+    # First reply to the username: a HELLO frame if the server agreed to framing, otherwise plain text
+    global protocol_version, decoder, pending_frames, compressor
+    data = sock.recv(BUFSIZE)
+    if not is_hello_reply(data):
+        return data.decode().strip()
+
+    decoder = FrameDecoder()
+    if COMPRESSION: # compressed frames may follow the reply in the same recv
+        decoder.start_inflating()
+    pending_frames = decoder.feed(data)
+    while not pending_frames:
+        pending_frames = decoder.feed(sock.recv(BUFSIZE))
+    frame_type, payload = pending_frames.pop(0)
+    protocol_version, codec = parse_hello_reply(payload)
+    if codec is not None:
+        compressor = Compressor()
+    return next_handshake_message(sock)
+
+def next_handshake_message(sock):
+    if protocol_version is None:
+        return sock.recv(BUFSIZE).decode().strip()
+
+    global pending_frames
+    while not pending_frames:
+        data = sock.recv(RECV_BUFSIZE)
+        if not data:
+            return ""
+        pending_frames = decoder.feed(data)
+    frame_type, payload = pending_frames.pop(0)
+    return payload.decode().strip()
+
 def main(): 
     usage_checking()
     # check port is integer here while converting
@@ -272,8 +687,13 @@ def main():
     client_username = sys.argv[2]
 
     sock = start_connection(port) # returns connected socket to send stuff on
-    sock.send(client_username.encode()) # send username to server
-    response = sock.recv(BUFSIZE).decode().strip() # server response - either username already exists or "welcome to chatclient"... - see spec
+    sock.sendall(encode_hello(client_username, channel=CHANNEL, codecs=COMPRESSION)) # send username to server, offering the framed protocol and compression
+    response = handshake_response(sock) # server response - either username already exists or "welcome to chatclient"... - see spec
+    if "\0" in response: # a server from before framing took the whole offer for the username, join again with just the username
+        sock.close()
+        sock = start_connection(port)
+        sock.sendall(client_username.encode())
+        response = handshake_response(sock)
 
     # flush either message (welcome message or username error message) to stdout
     print(response, file=sys.stdout, flush=True)
@@ -283,7 +703,11 @@ def main():
     if re.match(username_error_message, response):
         exit(EXIT_CODES.DUPLICATE_USERNAME_ERROR.value)
 
-    response = sock.recv(BUFSIZE).decode().strip() # server response - either you have joined channel or in queue
+    # on a shared port, the named channel may not exist
+    if CHANNEL is not None and re.match(r"^\[Server Message\] (Channel \".*\" does not exist|Name a channel to join on this port)\.$", response):
+        exit(EXIT_CODES.PORT_CHECK_ERROR.value)
+
+    response = next_handshake_message(sock) # server response - either you have joined channel or in queue
     print(response, file=sys.stdout)
     sys.stdout.flush()
 
@@ -0,0 +1,215 @@
+import struct
+import zlib
+
+# Framed wire protocol shared by chatclient and chatserver.
+#
+# Every frame is a 4 byte big-endian payload length, a 1 byte frame type and then the payload,
+# so any number of messages can be parsed out of one recv and file bytes are never read as text.
+#
+# Framing is negotiated in the username handshake: the client sends "username\0framed/1[,...]".
+# A server that supports one of the offered versions answers with a HELLO frame holding the
+# chosen version and frames everything after it. A server that answers with plain text
+# (or a client that sends a plain username) keeps using the original unframed protocol.
+# A server from before framing takes the whole handshake for the username and echoes it, NUL and offer
+# included, in its welcome; chatclient then reconnects and sends the bare username instead.
+#
+# A client of a server that serves every channel on one shared port names the channel to join after a
+# second NUL: "username\0framed/2,1\0channel", or "username\0\0channel" without framing. Channel ports
+# ignore the name, so the same client works with both layouts.
+#
+# From version 2 every file transfer has an ID chosen by the server so several can run at once on
+# one connection: FILE_DATA payloads start with the 4 byte transfer ID and the CRC-32 of the chunk,
+# and file transfer CONTROL messages end with the ID, e.g. "[FileSize] 123 <sha256> 7".
+# The whole-file SHA-256 lets a receiver that kept a partial file resume it: it answers
+# "[Client Message] Ready <offset> 7" and the sender continues from that offset.
+#
+# Compression is negotiated in the same handshake: the client appends the codecs it supports to its offer,
+# "framed/2,1;zlib", and the server's HELLO names the one it picked, "2;zlib" (or just "2" for none).
+# From then on either side may send COMPRESSED frames, whose payload inflates to one or more whole frames.
+# Each direction is one raw deflate stream for the whole connection, flushed at the end of every COMPRESSED
+# frame, so phrases repeated across messages compress and every frame can be inflated as soon as it
+# arrives. Small writes and data that does not compress (e.g. zip or jpeg files) go out as plain frames
+# and stay out of the stream. zlib is the only stdlib codec that can flush mid-stream.
+
+PROTOCOL_NAME = "framed"
+PROTOCOL_VERSIONS = (2, 1) # supported versions, most preferred first
+TRANSFER_ID_VERSION = 2 # first version with transfer IDs
+
+HEADER = struct.Struct("!IB") # payload length, frame type
+FILE_DATA_HEADER = struct.Struct("!II") # transfer ID, CRC-32 of the chunk: prefix of FILE_DATA payloads from version 2
+MAX_FRAME_SIZE = 1 << 24 # anything larger is a protocol error
+FILE_CHUNK_SIZE = 65536 # file bytes are sent as FILE_DATA frames of at most this size
+RECV_BUFSIZE = 65536 # framed connections read this much per recv and parse every frame in it
+COMPRESSION_CODECS = ("zlib",) # supported codecs, most preferred first
+COMPRESS_MIN_SIZE = 48 # bytes, smaller writes gain less than a COMPRESSED frame costs
+COMPRESS_SAMPLE_SIZE = 4096 # larger writes are compressed only if this much of them compresses well
+COMPRESS_SAMPLE_RATIO = 0.9
+INFLATE_WINDOW = 1 << 15 # deflate's history, what a receiver taking over a stream needs
+
+# Frame types
+HELLO = 0 # handshake reply, payload is the chosen protocol version
+TEXT = 1 # chat lines, commands and server messages (utf-8)
+CONTROL = 2 # file transfer control messages e.g. "[FileSize] 123", "[Client Message] Ready"
+FILE_DATA = 3 # raw file bytes
+COMPRESSED = 4 # deflated frames, once compression is agreed
+
+class ProtocolError(Exception):
+    pass
+
+def split_transfer_id(message):
+    # "[Client Message] Ready 7" -> ("[Client Message] Ready", 7), (message, None) without a valid ID
+    rest, _, transfer_id = message.rpartition(" ")
+    if not rest or not transfer_id.isdecimal():
+        return message, None
+    return rest, int(transfer_id)
+
+def encode_frame(frame_type, payload):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return HEADER.pack(len(payload), frame_type) + payload
+
+def encode_hello(username, versions=PROTOCOL_VERSIONS, channel=None, codecs=()):
+    # Username handshake offering framing and compression, naming the channel to join on a shared port
+    offer = ",".join(str(version) for version in versions)
+    if codecs:
+        offer += ";" + ",".join(codecs)
+    hello = f"{username}\0{PROTOCOL_NAME}/{offer}"
+    if channel is not None:
+        hello += f"\0{channel}"
+    return hello.encode()
+
+def parse_hello(data):
+    # Returns (username, version, channel, codecs) where version is None for a plain (unframed) handshake,
+    # channel is None if the client did not name one and codecs are the compression codecs it offered
+    username, _, offer = data.decode().partition("\0")
+    username = username.strip()
+    offer, _, channel = offer.partition("\0")
+    channel = channel.strip() or None
+    name, _, versions = offer.strip().partition("/")
+    if name != PROTOCOL_NAME:
+        return username, None, channel, ()
+
+    versions, _, codecs = versions.partition(";")
+    codecs = tuple(codec for codec in codecs.split(",") if codec)
+    offered = set()
+    for version in versions.split(","):
+        if version.isdecimal():
+            offered.add(int(version))
+    for version in PROTOCOL_VERSIONS:
+        if version in offered:
+            return username, version, channel, codecs
+    return username, None, channel, ()
+
+def encode_hello_reply(version, codec=None):
+    # HELLO frame with the chosen version and compression codec
+    return encode_frame(HELLO, str(version) if codec is None else f"{version};{codec}")
+
+def parse_hello_reply(payload):
+    # HELLO payload -> (version, codec), codec None without compression
+    version, _, codec = payload.decode().partition(";")
+    return int(version), codec or None
+
+def is_hello_reply(data):
+    # Plain text replies start with a printable character, a framed reply starts with a HELLO header
+    return len(data) >= HEADER.size and data[0] == 0 and data[HEADER.size - 1] == HELLO
+
+class Compressor:
+    # The sending half of a compressed connection, one raw deflate stream. Not locked: callers send what
+    # compress returns in the order they called it.
+    def __init__(self):
+        self.deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.raw_bytes = 0 # bytes that went into COMPRESSED frames
+        self.wire_bytes = 0 # size of those frames
+
+    def compress(self, data):
+        # data (whole frames) as one COMPRESSED frame, or unchanged if it is too small or does not compress.
+        # Once data is in the stream it has to be sent compressed, so the sample decides beforehand.
+        if len(data) < COMPRESS_MIN_SIZE:
+            return data
+        if len(data) > COMPRESS_SAMPLE_SIZE:
+            sample = data[:COMPRESS_SAMPLE_SIZE]
+            if len(zlib.compress(sample, 1)) > len(sample) * COMPRESS_SAMPLE_RATIO:
+                return data
+        frame = encode_frame(COMPRESSED, self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH))
+        self.raw_bytes += len(data)
+        self.wire_bytes += len(frame)
+        return frame
+
+class FrameDecoder:
+    # Incremental decoder: feed it whatever recv returned, get back every complete frame
+    def __init__(self):
+        self.buffer = bytearray()
+        self.inflater = None # set by start_inflating, COMPRESSED frames are a protocol error until then
+        self.window = None # the last INFLATE_WINDOW inflated bytes, if kept for handing the stream over
+        self.raw_bytes = 0 # bytes inflated from COMPRESSED frames
+        self.wire_bytes = 0 # size of those frames
+
+    def start_inflating(self, window=b"", keep_window=False):
+        # Inflate COMPRESSED frames from now on. window is the history of a stream another decoder started.
+        if window:
+            self.inflater = zlib.decompressobj(-zlib.MAX_WBITS, zdict=window)
+        else:
+            self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        if keep_window:
+            self.window = bytearray(window)
+
+    def inflate(self, payload):
+        # The frames of a COMPRESSED payload
+        if self.inflater is None:
+            raise ProtocolError("compressed frame without agreed compression")
+        try:
+            data = self.inflater.decompress(payload, MAX_FRAME_SIZE)
+        except zlib.error as error:
+            raise ProtocolError(f"compressed frame does not inflate: {error}")
+        if self.inflater.unconsumed_tail:
+            raise ProtocolError("compressed frame inflates too large")
+        self.raw_bytes += len(data)
+        self.wire_bytes += HEADER.size + len(payload)
+        if self.window is not None:
+            self.window += data
+            del self.window[:-INFLATE_WINDOW]
+
+        frames = []
+        offset = 0
+        while offset < len(data):
+            if len(data) - offset < HEADER.size:
+                raise ProtocolError("partial frame in a compressed frame")
+            length, frame_type = HEADER.unpack_from(data, offset)
+            end = offset + HEADER.size + length
+            if end > len(data) or frame_type == COMPRESSED:
+                raise ProtocolError("partial or nested frame in a compressed frame")
+            frames.append((frame_type, data[offset + HEADER.size:end]))
+            offset = end
+        return frames
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            length, frame_type = HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"frame of {length} bytes is too large")
+            end = offset + HEADER.size + length
+            if len(self.buffer) < end: # wait for the rest of the frame
+                break
+            if frame_type == COMPRESSED:
+                frames += self.inflate(bytes(self.buffer[offset + HEADER.size:end]))
+            else:
+                frames.append((frame_type, bytes(self.buffer[offset + HEADER.size:end])))
+            offset = end
+        del self.buffer[:offset]
+        return frames
+
+    def take_partial(self, frame_type, min_payload=0):
+        # Detach a partly received frame of frame_type from the buffer so the rest of its payload
+        # can be read straight off the socket. Returns (payload so far, payload bytes still to read),
+        # or None if fewer than min_payload bytes of the payload are buffered.
+        if len(self.buffer) < HEADER.size + min_payload:
+            return None
+        length, buffered_type = HEADER.unpack_from(self.buffer)
+        if buffered_type != frame_type or length > MAX_FRAME_SIZE:
+            return None
+        payload = bytes(self.buffer[HEADER.size:])
+        self.buffer.clear()
+        return payload, length - len(payload)
@@ -1,11 +1,28 @@
 import os
 import sys 
+import json
 from sys import stdin, stdout
 import re
+import zlib
+import selectors
+import time
+import mmap
+import traceback
+import signal
+import struct
+from bisect import bisect_left
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import active_count
+from collections import Counter, OrderedDict, deque
+from contextlib import ExitStack, contextmanager
+from functools import wraps
 from socket import *
-from threading import Event, Lock, Thread, Timer, current_thread
+from itertools import count, islice
+from threading import Condition, Event, Lock, Thread, Timer, current_thread, local
 from enum import Enum
-from queue import Queue
+from queue import Empty, Queue
+from chatprotocol import COMPRESSION_CODECS, CONTROL, FILE_CHUNK_SIZE, FILE_DATA, RECV_BUFSIZE, TEXT, FILE_DATA_HEADER, TRANSFER_ID_VERSION, Compressor, FrameDecoder, ProtocolError, encode_frame, encode_hello_reply, parse_hello, split_transfer_id
 
 class EXIT_CODES(Enum):
     CONFIG_FILE_ERROR = 5
@@ -14,49 +31,1166 @@ class EXIT_CODES(Enum):
 
 quit = False
 quit_from_queue = False
-failed_transfer = False
-failed_transfer_event = Event()
 
-# Shared resource (counter to count the number of data packets received)
-counter = 0
-counter_lock = Lock()
+# Locking: every Channel has its own lock guarding its member lists, queue and socket dicts, so
+# channels never serialize against each other. An operation that needs two channels (/switch) takes
+# both through lock_channels(), which acquires them in creation order. Connection.lock (the
+# outbound queue) may be taken while holding channel locks, never the other way round. Messages are
+# queued to clients inside the lock, which keeps their order, and written to sockets after it.
 
 BUFSIZE=1024
 
+def env_number(name, default, parse=int):
+    # Numeric environment variable, None if it is not a (finite) number: usage_checking reports that
+    try:
+        value = parse(os.environ.get(name, default))
+    except ValueError:
+        return None
+    return value if value == value and abs(value) != float("inf") else None
+
+# "thread" runs one thread per client, "eventloop" serves every listener and client from one selector loop
+SERVER_MODE = os.environ.get("CHATSERVER_MODE", "thread")
+SERVER_MODES = ("thread", "eventloop")
+
+# Every client has a bounded outbound queue so one slow reader cannot stall the others.
+# When it is full: "drop" discards the new message, "coalesce" merges the queued messages into one
+# buffer (up to OUTBOUND_QUEUE_BYTES, then drops) and "disconnect" disconnects the client.
+OUTBOUND_QUEUE_LIMIT = env_number("CHATSERVER_OUTBOUND_LIMIT", "256") # messages
+OUTBOUND_QUEUE_BYTES = env_number("CHATSERVER_OUTBOUND_BYTES", str(1 << 20))
+SLOW_CLIENT_POLICY = os.environ.get("CHATSERVER_SLOW_CLIENT_POLICY", "coalesce")
+SLOW_CLIENT_POLICIES = ("drop", "coalesce", "disconnect")
+CLOSE_LINGER = 5 # seconds a closed client gets to drain its outbound queue
+
+# /send is relayed to the target as it arrives: uploads are read into reusable buffers of
+# RELAY_BUFSIZE and at most RELAY_WINDOW bytes of a transfer wait for the target. Clients with
+# transfer IDs are granted that window per transfer ("[Server Message] Window <offset> <id>"),
+# older clients are paused (no longer read) while it is full.
+RELAY_BUFSIZE = 1 << 18
+RELAY_WINDOW = env_number("CHATSERVER_RELAY_WINDOW", str(1 << 20))
+
+# Queued clients hear about a new position at most once per QUEUE_NOTIFY_INTERVAL seconds and only when
+# it changed: queue churn marks the channel, a tick sends the positions. With "pull" nothing is pushed
+# after joining the queue and clients ask with /position.
+QUEUE_NOTIFY_INTERVAL = env_number("CHATSERVER_QUEUE_NOTIFY_INTERVAL", "0.1", float)
+QUEUE_UPDATES = os.environ.get("CHATSERVER_QUEUE_UPDATES", "push")
+QUEUE_UPDATE_MODES = ("push", "pull")
+
+# Every channel keeps its last chat lines, at most HISTORY_MESSAGES of them and HISTORY_BYTES in total.
+# Clients get the last HISTORY_REPLAY of them when they join (0: none) and can ask with /history N.
+HISTORY_MESSAGES = env_number("CHATSERVER_HISTORY_MESSAGES", "100")
+HISTORY_BYTES = env_number("CHATSERVER_HISTORY_BYTES", str(1 << 16))
+HISTORY_REPLAY = env_number("CHATSERVER_HISTORY_REPLAY", "0")
+
+# With CHATSERVER_ARCHIVE_DIR set, chat lines are also appended to a log per channel on disk that
+# survives restarts and answers /search and /history since. A new segment starts once one reaches
+# ARCHIVE_SEGMENT_BYTES; replies hold at most ARCHIVE_RESULTS lines.
+ARCHIVE_DIR = os.environ.get("CHATSERVER_ARCHIVE_DIR")
+ARCHIVE_SEGMENT_BYTES = env_number("CHATSERVER_ARCHIVE_SEGMENT_BYTES", str(1 << 24))
+ARCHIVE_RESULTS = 100
+ARCHIVE_RECORD = struct.Struct("!dI") # time.time(), length of the utf-8 line that follows
+ARCHIVE_INDEX_ENTRY = struct.Struct("!dQ") # time.time(), offset of the record in its segment
+
+# The server counts traffic, latencies and transfers at all times; /stats on stdin prints a summary and
+# with CHATSERVER_METRICS_PORT set they are served in the Prometheus text format on
+# http://127.0.0.1:<port>/metrics.
+METRICS_PORT = os.environ.get("CHATSERVER_METRICS_PORT")
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1) # seconds
+WAIT_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600)
+TRANSFER_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800)
+
+# Profiling is off unless CHATSERVER_PROFILE=on or "/profile on" is typed on stdin, and "/profile off" stops it
+# again. While on, channel locks record how long threads wait for and hold them, the busiest handlers are
+# timed and the stack of every thread is sampled each PROFILE_SAMPLE_INTERVAL seconds. Samples are written
+# to PROFILE_STACKS_FILE once a second in the folded format flame graph tools read ("frame;frame;frame count").
+PROFILE = os.environ.get("CHATSERVER_PROFILE", "off")
+PROFILE_MODES = ("off", "on")
+PROFILE_SAMPLE_INTERVAL = env_number("CHATSERVER_PROFILE_INTERVAL", "0.01", float)
+PROFILE_STACKS_FILE = os.environ.get("CHATSERVER_PROFILE_STACKS", "chatserver-stacks.txt")
+PROFILE_WRITE_INTERVAL = 1 # seconds between writes of the stack samples
+
+# With CHATSERVER_SHARED_PORT set every channel can also be joined on that one port: clients name the channel
+# in the handshake (see chatprotocol). Channel ports keep working, so both layouts can be used side by side.
+# In supervisor mode the supervisor accepts on it and passes each client's socket to the worker with its channel.
+SHARED_PORT = os.environ.get("CHATSERVER_SHARED_PORT")
+HANDSHAKE_TIMEOUT = 10 # seconds the supervisor waits for the handshake of a shared port client
+IPC_BUFSIZE = 65536 # largest message between the supervisor and a worker
+HANDOFF_TIMEOUT = 5 # seconds a /switch into another worker's channel waits for, and holds, the username there
+
+# With CHATSERVER_WORKERS above 1 the server is a supervisor: it binds every channel, then forks that many
+# worker processes that each serve a share of the channels (round robin in configuration file order) in
+# CHATSERVER_MODE, so the channels are not limited to one core by the GIL. The supervisor reads stdin and
+# hands admin commands over a unix socket to the worker with the channel, or to every worker for /stats,
+# /outbound and /profile. Workers write their log to a pipe the supervisor copies whole lines from, and keep
+# every channel's member and queue counts in a shared memory table (one OCCUPANCY slot per channel) for
+# /list. /switch into another worker's channel reserves the username there, then hands the client's socket
+# over (SCM_RIGHTS through the supervisor) with its pending buffers, so the client notices nothing.
+# Worker n serves its metrics on CHATSERVER_METRICS_PORT + n. On /reload the supervisor binds the ports of new
+# and moved channels and sends every worker the new configuration with the listeners of its channels, a new
+# channel going to the worker with the fewest.
+WORKERS = os.environ.get("CHATSERVER_WORKERS", "1")
+OCCUPANCY = struct.Struct("!II") # connected clients, queued clients
+OCCUPANCY_SLOTS = 1024 # room in the occupancy table for channels /reload adds
+WORKER_COMMANDS = ("kick_command", "mute_command", "empty_command", "stats_command", "outbound_command", "profile_command") # run for the supervisor
+
+AFK_TICK = 0.1 # seconds per AFK timer wheel slot
+AFK_WHEEL_SLOTS = 512
+
+UNFRAMED_CONTROL_MESSAGES = (b"[Client Message] Ready", b"[Client Message] Received", b"[Client Message] File Transfer Failed")
+# Unframed clients send the file straight after "[FileSize] <size>", often in the same recv. A file that starts
+# with a digit cannot be told apart from the size, as with the original server.
+UNFRAMED_FILE_SIZE = re.compile(rb"\[FileSize\] \d+")
+
+# The server's stdout is an event log written by a background thread. Events wait in a queue of at
+# most LOG_QUEUE_LIMIT lines (then the server waits for the writer) and are written in batches,
+# at most one write and flush per LOG_FLUSH_INTERVAL seconds. "json" writes one JSON object per line.
+LOG_FLUSH_INTERVAL = env_number("CHATSERVER_LOG_FLUSH_INTERVAL", "0.05", float)
+LOG_QUEUE_LIMIT = env_number("CHATSERVER_LOG_QUEUE_LIMIT", "10000")
+LOG_FORMAT = os.environ.get("CHATSERVER_LOG_FORMAT", "text")
+LOG_FORMATS = ("text", "json")
+
+SENDMSG_BUFFERS = 64 # framed connections write up to this many queued buffers with one sendmsg
+
+# Compression codecs the server agrees to (see chatprotocol), comma separated in order of preference, or "off".
+# A compressing connection deflates what is queued for it, each broadcast separately for every member.
+COMPRESSION = os.environ.get("CHATSERVER_COMPRESSION", ",".join(COMPRESSION_CODECS))
+
+# Channel capacities in the config file go up to CHATSERVER_MAX_CAPACITY. Channels with a capacity of at least
+# CHATSERVER_LARGE_CHANNEL (announcement channels with thousands of members) write each broadcast once into a
+# BroadcastRing of CHATSERVER_BROADCAST_RING messages instead of onto every member's outbound queue. Members read
+# it through their own cursor as their socket takes data; one that falls more than the ring behind skips the
+# overwritten messages (counted as dropped) whatever CHATSERVER_SLOW_CLIENT_POLICY says.
+MAX_CAPACITY = env_number("CHATSERVER_MAX_CAPACITY", "8")
+LARGE_CHANNEL_CAPACITY = env_number("CHATSERVER_LARGE_CHANNEL", "64")
+BROADCAST_RING_SIZE = env_number("CHATSERVER_BROADCAST_RING", "1024") # messages
+
+class EncodedMessage:
+    # A message sent to many clients, encoded once: every outbound queue it goes on shares the same
+    # bytes object, the plain bytes for unframed clients and the frame for framed ones
+    def __init__(self, message, frame_type=TEXT):
+        self.plain = message.encode()
+        self.frame_type = frame_type
+        self.framed = None
+
+    def encoded_for(self, conn):
+        if conn.protocol_version is None:
+            return self.plain
+        if self.framed is None:
+            self.framed = encode_frame(self.frame_type, self.plain)
+        return self.framed
+
+class Connection:
+    def __init__(self, sock, channel):
+        self.sock = sock
+        self.channel = channel # channel the client is currently connected or queued in
+        self.username = None # set once the username handshake is done
+        self.protocol_version = None # framed protocol version, None for unframed (original protocol) clients
+        self.decoder = None
+
+        self.uploads = {} # transfer ID -> FileRelay this client is sending, from "/send" on
+        self.downloads = {} # transfer ID -> FileRelay this client is receiving
+        self.paused = False # event loop mode: not read while an upload waits for the target
+
+        self.last_activity = 0 # time.monotonic() of the last message while connected
+        self.afk_scheduled = False # True while this connection sits in the AFK timer wheel
+        self.queue_position = None # position last sent to this client while queued
+        self.queued_at = None # time.monotonic() it joined its channel's queue
+
+        # Outbound queue, drained without blocking by whichever thread queues data and by the writer
+        self.lock = Lock()
+        self.outbound = deque() # bytes still to send, the first one may be partly sent
+        self.outbound_bytes = 0
+        self.outbound_max_depth = 0 # counters shown by the /outbound admin command
+        self.outbound_dropped = 0
+        self.outbound_coalesced = 0
+        self.write_watched = False # True while the writer waits for the socket to become writable
+        self.close_deadline = None # set once closed, the socket closes when the queue drains or this passes
+        self.handoff = None # name of another worker's channel this client is being switched to
+        self.reserving = None # event loop mode: that channel's name while its worker is asked for the username, not read meanwhile
+        self.held_messages = [] # what the client sent after that /switch, handled once the answer is in
+        self.ring = None # BroadcastRing of the large channel this client is a member of
+        self.ring_cursor = 0 # sequence number of the next broadcast in ring still to queue
+        self.codec = None # compression codec agreed in the handshake
+        self.compressor = None # chatprotocol.Compressor once compression is agreed, used with self.lock held
+
+    def recv_size(self):
+        if self.protocol_version is not None: # frames delimit themselves, read as much as is there
+            return RECV_BUFSIZE
+        # never read past the end of an upload so the next message is not swallowed
+        upload = self.active_upload()
+        if upload is not None:
+            return min(RELAY_BUFSIZE, upload.file_size - upload.received)
+        return BUFSIZE
+
+    def has_transfer_ids(self):
+        return self.protocol_version is not None and self.protocol_version >= TRANSFER_ID_VERSION
+
+    def active_upload(self):
+        # The upload whose bytes are arriving, clients without transfer IDs send one file at a time
+        for relay in list(self.uploads.values()):
+            if relay.file_size is not None:
+                return relay
+        return None
+
+    def receive(self, buffer):
+        # recv into a reusable buffer, returns a view of what was read (b"" once the client is gone)
+        try:
+            received = self.sock.recv_into(buffer, self.recv_size())
+        except OSError: # socket closed underneath us, e.g. kicked
+            return b""
+        return memoryview(buffer)[:received]
+
+    def queue_output(self, data, force=False):
+        # Queue data to send, False if the slow client policy says to disconnect this client. data is bytes, or
+        # for framed clients a list of buffers queued as they are for sendmsg to gather, one message to the policy.
+        # force skips the limit for data that must not be lost, e.g. file bytes.
+        buffers = data if isinstance(data, list) else [data]
+        size = sum(len(buffer) for buffer in buffers)
+        with self.lock:
+            if self.close_deadline is not None:
+                return True
+            self.catch_up() # after the broadcasts before it
+            if len(self.outbound) >= OUTBOUND_QUEUE_LIMIT and not force:
+                if SLOW_CLIENT_POLICY == "disconnect":
+                    return False
+                if SLOW_CLIENT_POLICY == "drop" or self.outbound_bytes + size > OUTBOUND_QUEUE_BYTES:
+                    self.outbound_dropped += 1
+                    return True
+                self.outbound = deque([b"".join(self.outbound)]) # coalesce
+                self.outbound_coalesced += 1
+
+            if self.compressor is not None: # only what is really sent goes into the stream
+                buffers = [self.compressor.compress(b"".join(buffers))]
+                size = len(buffers[0])
+            self.outbound.extend(buffers)
+            self.outbound_bytes += size
+            self.outbound_max_depth = max(self.outbound_max_depth, len(self.outbound))
+            return True
+
+    def flush_output(self):
+        # Send as much queued data as the socket takes without blocking, True once the queue is empty.
+        # Frames delimit themselves, so a framed connection's backlog goes out with one sendmsg;
+        # unframed clients read every recv as one message and get one send per message.
+        with self.lock:
+            while self.outbound or self.catch_up(SENDMSG_BUFFERS): # a ring is read as the socket takes data
+                try:
+                    if self.protocol_version is not None and len(self.outbound) > 1:
+                        sent = self.sock.sendmsg(list(islice(self.outbound, SENDMSG_BUFFERS)), (), MSG_DONTWAIT)
+                    else:
+                        sent = self.sock.send(self.outbound[0], MSG_DONTWAIT)
+                except (BlockingIOError, InterruptedError):
+                    return False
+                except OSError: # client gone, its reader handles the disconnect
+                    self.outbound.clear()
+                    self.outbound_bytes = 0
+                    self.ring = None
+                    return True
+
+                self.outbound_bytes -= sent
+                while sent:
+                    data = self.outbound[0]
+                    if sent < len(data):
+                        self.outbound[0] = memoryview(data)[sent:]
+                        return False
+                    sent -= len(data)
+                    self.outbound.popleft()
+            return True
+
+    def subscribe(self, ring):
+        # Start reading ring's broadcasts from the next one, call with the channel's lock held
+        with self.lock:
+            self.catch_up()
+            self.ring = ring
+            self.ring_cursor = ring.head
+
+    def unsubscribe(self):
+        # Stop reading the ring, keeping the broadcasts sent while still a member. Call with the channel's lock held.
+        if self.ring is None:
+            return
+        with self.lock:
+            self.catch_up()
+            self.ring = None
+
+    def catch_up(self, limit=None):
+        # Call with self.lock held: queue up to limit (all by default) of the ring's broadcasts this client has
+        # not got yet, as references to the ring's bytes. True if any were queued.
+        if self.ring is None or self.ring_cursor == self.ring.head or self.close_deadline is not None:
+            return False
+        messages, skipped = self.ring.read(self.ring_cursor, limit or self.ring.size)
+        self.ring_cursor += skipped + len(messages)
+        self.outbound_dropped += skipped
+        if self.compressor is not None and messages: # one COMPRESSED frame for the batch
+            buffers = [self.compressor.compress(b"".join(message.encoded_for(self) for message in messages))]
+        else:
+            buffers = [message.encoded_for(self) for message in messages]
+        for data in buffers:
+            self.outbound.append(data)
+            self.outbound_bytes += len(data)
+        self.outbound_max_depth = max(self.outbound_max_depth, len(self.outbound))
+        return bool(buffers)
+
+    def pending_broadcasts(self):
+        # Broadcasts of the ring not queued for this client yet and not overwritten
+        return 0 if self.ring is None else min(self.ring.head - self.ring_cursor, self.ring.size)
+
+    def dropped_messages(self):
+        # outbound_dropped, plus broadcasts the ring overwrote before this client read them; those are
+        # only skipped, and added to outbound_dropped, once the client's socket takes data again
+        lapped = 0 if self.ring is None else max(0, self.ring.head - self.ring.size - self.ring_cursor)
+        return self.outbound_dropped + lapped
+
+    def start_framing(self, version):
+        self.protocol_version = version
+        self.decoder = FrameDecoder()
+
+    def start_compression(self, codec, window=b"", keep_window=False):
+        # Compress what is queued from now on and inflate the client's COMPRESSED frames. window and
+        # keep_window carry the client's stream over to another worker, see hand_off_client.
+        self.codec = codec
+        with self.lock:
+            self.compressor = Compressor()
+        self.decoder.start_inflating(window, keep_window)
+
+    def buffered_messages(self):
+        # Complete frames already in the decoder, e.g. sent before another worker handed the client over
+        if self.decoder is None:
+            return []
+        try:
+            frames = self.decoder.feed(b"")
+        except ProtocolError:
+            return [(TEXT, b"")]
+        return [frame for frame in frames if frame[1]]
+
+    def split_messages(self, data):
+        # Turn one recv into a list of (frame type, payload), an empty payload means the client disconnected
+        if not data:
+            return [(TEXT, b"")]
+        if self.protocol_version is not None:
+            try:
+                frames = self.decoder.feed(data)
+            except ProtocolError:
+                return [(TEXT, b"")]
+            return [frame for frame in frames if frame[1]] # empty frames carry nothing, keep b"" for disconnects
+
+        # Unframed client: every read is one message, classified by its content
+        if self.active_upload() is not None:
+            return [(FILE_DATA, data)]
+        data = bytes(data)
+        if data in UNFRAMED_CONTROL_MESSAGES:
+            return [(CONTROL, data)]
+        file_size = UNFRAMED_FILE_SIZE.match(data)
+        if file_size is not None: # the rest is the start of the file
+            messages = [(CONTROL, file_size.group())]
+            if file_size.end() < len(data):
+                messages.append((FILE_DATA, data[file_size.end():]))
+            return messages
+        return [(TEXT, data)]
+
+class BroadcastRing:
+    # The broadcasts of a large channel (see LARGE_CHANNEL_CAPACITY), each encoded and stored once. Broadcast n
+    # is at n % size until it is overwritten; every member's Connection keeps the cursor of its next one.
+    def __init__(self, size):
+        self.size = size
+        self.entries = [] # EncodedMessages, grows to size on first use
+        self.head = 0 # sequence number of the next broadcast
+        self.lock = Lock() # taken after Connection.lock, never the other way round
+
+    def publish(self, message):
+        with self.lock:
+            if len(self.entries) < self.size:
+                self.entries.append(message)
+            else:
+                self.entries[self.head % self.size] = message
+            self.head += 1
+
+    def read(self, cursor, limit):
+        # (up to limit broadcasts from cursor on, how many before them were overwritten and are skipped)
+        with self.lock:
+            skipped = max(0, self.head - self.size - cursor)
+            cursor += skipped
+            stop = min(self.head, cursor + limit)
+            return [self.entries[n % self.size] for n in range(cursor, stop)], skipped
+
+class FileRelay:
+    # One /send, streamed from the sender to the target as it arrives
+    def __init__(self, transfer_id, sender, target_client, file_path):
+        self.transfer_id = transfer_id
+        self.sender = sender
+        self.target = None # set on "[FileSize]", stays None if the target is gone and the upload is discarded
+        self.target_client = target_client
+        self.file_path = file_path
+        self.file_size = None # None until the sender sends "[FileSize]"
+        self.digest = None # whole-file SHA-256 from a sender with transfer IDs, lets the target resume
+        self.received = 0 # bytes read from the sender
+        self.ready = False # target answered "[Client Message] Ready"
+        self.failed = False # target answered "[Client Message] File Transfer Failed"
+        self.granted = 0 # clients with transfer IDs may send up to this offset
+        self.backlog = deque() # bytes that arrived before the target was ready
+        self.backlog_bytes = 0
+        self.finished = False
+        self.condition = Condition() # guards the fields above, thread mode senders wait on it
+        self.started = time.monotonic()
+
+class OutboundWriter:
+    # Thread mode: one thread finishes every send that would have blocked a client or channel thread
+    def __init__(self, on_drained):
+        self.on_drained = on_drained # called with each connection the writer made progress on
+        self.selector = selectors.DefaultSelector()
+        self.watch_requests = Queue()
+        self.wakeup_recv, self.wakeup_send = socketpair()
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+
+    def watch(self, conn):
+        self.watch_requests.put(conn)
+        self.wakeup_send.send(b"\0")
+
+    def run(self):
+        watched = set()
+        while True:
+            for key, mask in self.selector.select(1):
+                if key.data is None:
+                    self.wakeup_recv.recv(BUFSIZE)
+                    while not self.watch_requests.empty():
+                        conn = self.watch_requests.get()
+                        if conn not in watched:
+                            watched.add(conn)
+                            self.selector.register(conn.sock, selectors.EVENT_WRITE, conn)
+                    continue
+
+            now = time.monotonic()
+            for conn in list(watched):
+                expired = conn.close_deadline is not None and conn.close_deadline <= now
+                flushed = conn.flush_output()
+                self.on_drained(conn)
+                if not flushed and not expired:
+                    continue
+                watched.discard(conn)
+                self.selector.unregister(conn.sock)
+                with conn.lock:
+                    conn.write_watched = False
+                    drained = not conn.outbound and not conn.pending_broadcasts()
+                if conn.close_deadline is not None:
+                    conn.sock.close()
+                elif not drained: # more was queued while unregistering
+                    self.watch(conn)
+
+class EventLog:
+    # Server stdout. Lines are written straight away until start(), then by the writer thread.
+    def __init__(self, stream):
+        self.stream = stream
+        self.lines = Queue(LOG_QUEUE_LIMIT)
+        self.started = False
+
+    def start(self):
+        self.started = True
+        Thread(target=self.run, daemon=True).start()
+
+    def forward(self, line):
+        # A line another process already formatted, e.g. a worker's in supervisor mode
+        self.lines.put(line)
+
+    def write(self, message, event="server", **fields):
+        # event is the kind of line (server, admin, join, leave, chat, whisper, afk, transfer, error),
+        # fields e.g. channel and user are only written in the json format
+        if LOG_FORMAT == "json":
+            line = json.dumps({"time": round(time.time(), 6), "event": event, **fields, "message": message})
+        else:
+            line = message
+        if not self.started:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+            return
+        self.lines.put(line)
+
+    def close(self):
+        # Wait until every queued line is written, e.g. before /shutdown exits
+        if self.started:
+            self.lines.join()
+
+    def run(self):
+        last_flush = 0
+        while True:
+            batch = [self.lines.get()] # wait for the next event
+            time.sleep(max(0, last_flush + LOG_FLUSH_INTERVAL - time.monotonic()))
+            while True:
+                try:
+                    batch.append(self.lines.get_nowait())
+                except Empty:
+                    break
+
+            try:
+                self.stream.write("\n".join(batch) + "\n")
+                self.stream.flush()
+            except (OSError, ValueError): # stdout closed, nothing left to log to
+                pass
+            last_flush = time.monotonic()
+            for line in batch:
+                self.lines.task_done()
+
+class ChannelArchive:
+    # One channel's append-only log on disk. Segment <n>.log holds records (ARCHIVE_RECORD, then the
+    # line) starting with the channel's nth line, <n>.idx one ARCHIVE_INDEX_ENTRY per record. Only the
+    # archive's writer thread appends; readers memory-map an index and read just the records it points at.
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".idx") and name[:-4].isdigit())
+        self.log_file = None
+        self.index_file = None
+        self.log_size = 0
+        self.records = 0 # lines in every segment
+        self.open_segment(self.segments[-1] if self.segments else 0)
+
+    def path(self, first, suffix):
+        return os.path.join(self.directory, f"{first:012d}{suffix}")
+
+    def open_segment(self, first):
+        # Append to segment first, cutting off a partly written entry or a record its index never got
+        index_path, log_path = self.path(first, ".idx"), self.path(first, ".log")
+        if first not in self.segments:
+            self.segments.append(first)
+        entries, log_size = 0, 0
+        if os.path.exists(index_path) and os.path.exists(log_path):
+            entries = os.path.getsize(index_path) // ARCHIVE_INDEX_ENTRY.size
+            if entries:
+                with open(index_path, "rb") as index, open(log_path, "rb") as log:
+                    index.seek((entries - 1) * ARCHIVE_INDEX_ENTRY.size)
+                    timestamp, offset = ARCHIVE_INDEX_ENTRY.unpack(index.read(ARCHIVE_INDEX_ENTRY.size))
+                    log.seek(offset)
+                    timestamp, length = ARCHIVE_RECORD.unpack(log.read(ARCHIVE_RECORD.size))
+                log_size = offset + ARCHIVE_RECORD.size + length
+        self.log_file = open(log_path, "ab")
+        self.index_file = open(index_path, "ab")
+        self.log_file.truncate(log_size)
+        self.index_file.truncate(entries * ARCHIVE_INDEX_ENTRY.size)
+        self.log_size = log_size
+        self.records = first + entries
+
+    def append(self, timestamp, line):
+        if self.log_size >= ARCHIVE_SEGMENT_BYTES:
+            self.log_file.close()
+            self.index_file.close()
+            self.open_segment(self.records)
+        self.log_file.write(ARCHIVE_RECORD.pack(timestamp, len(line)) + line)
+        self.index_file.write(ARCHIVE_INDEX_ENTRY.pack(timestamp, self.log_size))
+        self.log_size += ARCHIVE_RECORD.size + len(line)
+        self.records += 1
+
+    def flush(self):
+        # The log first, so every index entry a reader sees points at a complete record
+        self.log_file.flush()
+        self.index_file.flush()
+
+    def entries(self, first):
+        return os.path.getsize(self.path(first, ".idx")) // ARCHIVE_INDEX_ENTRY.size
+
+    def map_index(self, first):
+        # (mmap of the segment's index, number of entries), None for an empty segment
+        with open(self.path(first, ".idx"), "rb") as index:
+            entries = os.fstat(index.fileno()).st_size // ARCHIVE_INDEX_ENTRY.size
+            if not entries:
+                return None
+            return mmap.mmap(index.fileno(), entries * ARCHIVE_INDEX_ENTRY.size, access=mmap.ACCESS_READ), entries
+
+    def read_records(self, first, start, stop):
+        # (time, line) of records start..stop-1 of a segment, read sequentially from the first one's offset
+        mapped, entries = self.map_index(first)
+        with mapped:
+            offset = ARCHIVE_INDEX_ENTRY.unpack_from(mapped, start * ARCHIVE_INDEX_ENTRY.size)[1]
+        records = []
+        with open(self.path(first, ".log"), "rb") as log:
+            log.seek(offset)
+            for i in range(start, stop):
+                timestamp, length = ARCHIVE_RECORD.unpack(log.read(ARCHIVE_RECORD.size))
+                records.append((timestamp, log.read(length)))
+        return records
+
+    def last(self, count):
+        # The last count records, oldest first
+        records = []
+        for first in reversed(list(self.segments)):
+            if len(records) >= count:
+                break
+            entries = self.entries(first)
+            if entries:
+                records[:0] = self.read_records(first, max(0, entries - (count - len(records))), entries)
+        return records
+
+    def since(self, timestamp, limit):
+        # Up to limit records from timestamp on, oldest first, and whether there are more
+        records = []
+        for first in list(self.segments):
+            mapped = self.map_index(first)
+            if mapped is None:
+                continue
+            mapped, entries = mapped
+            with mapped:
+                if ARCHIVE_INDEX_ENTRY.unpack_from(mapped, (entries - 1) * ARCHIVE_INDEX_ENTRY.size)[0] < timestamp:
+                    continue # all older
+                low, high = 0, entries # binary search for the first entry at or after timestamp
+                while low < high:
+                    middle = (low + high) // 2
+                    if ARCHIVE_INDEX_ENTRY.unpack_from(mapped, middle * ARCHIVE_INDEX_ENTRY.size)[0] < timestamp:
+                        low = middle + 1
+                    else:
+                        high = middle
+            records += self.read_records(first, low, min(entries, low + limit + 1 - len(records)))
+            if len(records) > limit:
+                return records[:limit], True
+        return records, False
+
+    def search(self, text, limit):
+        # The last limit records whose line contains text, oldest first, and whether there are more.
+        # Segments are memory-mapped and searched from the end, the index maps a match to its record.
+        needle = text.encode()
+        found = []
+        for first in reversed(list(self.segments)):
+            mapped = self.map_index(first)
+            if mapped is None:
+                continue
+            index, entries = mapped
+            with index, open(self.path(first, ".log"), "rb") as log:
+                end_timestamp, end = ARCHIVE_INDEX_ENTRY.unpack_from(index, (entries - 1) * ARCHIVE_INDEX_ENTRY.size)
+                log.seek(end)
+                end += ARCHIVE_RECORD.size + ARCHIVE_RECORD.unpack(log.read(ARCHIVE_RECORD.size))[1] # end of the last indexed record
+                with mmap.mmap(log.fileno(), end, access=mmap.ACCESS_READ) as segment:
+                    while True:
+                        position = segment.rfind(needle, 0, end)
+                        if position < 0:
+                            break
+                        low, high = 0, entries - 1 # binary search for the record holding position
+                        while low < high:
+                            middle = (low + high + 1) // 2
+                            if ARCHIVE_INDEX_ENTRY.unpack_from(index, middle * ARCHIVE_INDEX_ENTRY.size)[1] <= position:
+                                low = middle
+                            else:
+                                high = middle - 1
+                        timestamp, offset = ARCHIVE_INDEX_ENTRY.unpack_from(index, low * ARCHIVE_INDEX_ENTRY.size)
+                        start = offset + ARCHIVE_RECORD.size
+                        stop = start + ARCHIVE_RECORD.unpack_from(segment, offset)[1]
+                        if position < start or position + len(needle) > stop: # not inside one line, look further back
+                            end = position + len(needle) - 1
+                            continue
+                        found.append((timestamp, segment[start:stop]))
+                        if len(found) > limit:
+                            return found[limit - 1::-1], True
+                        end = offset # the rest of this record is already a match
+        return found[::-1], False
+
+class ChatArchive:
+    # Chat lines of every channel on disk. print_message only queues a line, a writer thread
+    # appends them in batches and flushes each touched channel once per batch. /search and
+    # /history since scan the disk too, a query thread runs them so no client handling waits.
+    def __init__(self, directory, channel_names):
+        self.directory = directory
+        self.channels = {name: ChannelArchive(os.path.join(directory, name)) for name in channel_names}
+        self.lines = Queue(LOG_QUEUE_LIMIT)
+        self.queries = Queue()
+
+    def start(self):
+        Thread(target=self.run, daemon=True).start()
+        Thread(target=self.run_queries, daemon=True).start()
+
+    def add_channel(self, name):
+        # Archive of a channel /reload added, still open if the channel was configured before
+        if name not in self.channels:
+            self.channels[name] = ChannelArchive(os.path.join(self.directory, name))
+        return self.channels[name]
+
+    def append(self, channel_name, timestamp, line):
+        self.lines.put((channel_name, timestamp, line))
+
+    def close(self):
+        # Wait until every queued line is written, e.g. before /shutdown exits
+        self.lines.join()
+
+    def query(self, channel_name, method, args, reply):
+        # Run ChannelArchive.<method>(*args) on the query thread and call reply(records, more) there,
+        # with None records if the archive cannot be read
+        self.queries.put((channel_name, method, args, reply))
+
+    def run_queries(self):
+        while True:
+            channel_name, method, args, reply = self.queries.get()
+            try:
+                records, more = getattr(self.channels[channel_name], method)(*args)
+            except (OSError, ValueError, struct.error) as error: # ValueError: mmap of a file truncated meanwhile
+                print(f"Error: unable to read the archive of \"{channel_name}\": {error}", file=sys.stderr, flush=True)
+                records, more = None, False
+            reply(records, more)
+
+    def run(self):
+        while True:
+            batch = [self.lines.get()]
+            while True:
+                try:
+                    batch.append(self.lines.get_nowait())
+                except Empty:
+                    break
+
+            touched = set()
+            for channel_name, timestamp, line in batch:
+                archive = self.channels[channel_name]
+                try:
+                    archive.append(timestamp, line)
+                except OSError as error: # e.g. disk full, keep serving
+                    print(f"Error: unable to archive a line of \"{channel_name}\": {error}", file=sys.stderr, flush=True)
+                touched.add(archive)
+            for archive in touched:
+                try:
+                    archive.flush()
+                except OSError:
+                    pass
+            for item in batch:
+                self.lines.task_done()
+
+class AfkScheduler:
+    # Hashed timer wheel for AFK timeouts. Receiving a message only updates conn.last_activity;
+    # each connection sits in at most one slot and is re-slotted lazily when its deadline comes up.
+    def __init__(self, afk_time):
+        self.afk_time = afk_time
+        self.lock = Lock()
+        self.slots = [[] for i in range(AFK_WHEEL_SLOTS)] # lists of (deadline, connection)
+        self.current_tick = int(time.monotonic() / AFK_TICK)
+        self.scheduled = 0
+
+    def record_activity(self, conn):
+        conn.last_activity = time.monotonic()
+        if not conn.afk_scheduled:
+            with self.lock:
+                if not conn.afk_scheduled:
+                    self.schedule(conn, conn.last_activity + self.afk_time)
+
+    def schedule(self, conn, deadline):
+        conn.afk_scheduled = True
+        tick = max(int(deadline / AFK_TICK) + 1, self.current_tick + 1)
+        self.slots[tick % AFK_WHEEL_SLOTS].append((deadline, conn))
+        self.scheduled += 1
+
+    def next_tick_in(self):
+        # Seconds until the next tick, None when nothing is scheduled
+        if not self.scheduled:
+            return None
+        return max(0, (self.current_tick + 1) * AFK_TICK - time.monotonic())
+
+    def advance(self):
+        # Run every tick up to now and return the connections that have been idle for afk_time
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            target_tick = int(now / AFK_TICK)
+            if target_tick - self.current_tick > AFK_WHEEL_SLOTS: # fell far behind, one revolution visits every slot
+                self.current_tick = target_tick - AFK_WHEEL_SLOTS
+            while self.current_tick < target_tick:
+                self.current_tick += 1
+                index = self.current_tick % AFK_WHEEL_SLOTS
+                slot = self.slots[index]
+                if not slot:
+                    continue
+                self.slots[index] = []
+                for deadline, conn in slot:
+                    self.scheduled -= 1
+                    if deadline > now: # due in a later revolution
+                        self.schedule(conn, deadline)
+                    elif conn.last_activity + self.afk_time > now: # active since it was slotted
+                        self.schedule(conn, conn.last_activity + self.afk_time)
+                    else:
+                        conn.afk_scheduled = False
+                        expired.append(conn)
+        return expired
+
+channel_order = count() # Channel.order, ports can change on /reload
+
+def lock_channels(*channels):
+    # Lock several channels without deadlocking: always in the order they were created
+    stack = ExitStack()
+    for channel in sorted(set(channels), key=lambda channel: channel.order):
+        stack.enter_context(channel.lock)
+    return stack
+
+class WaitingQueue:
+    # Clients waiting to join a channel, in arrival order, with a Fenwick tree over arrival tickets
+    # (1 for every ticket still waiting). Membership checks are O(1); joining, being promoted, leaving
+    # from the middle and looking up a position are O(log n), where n counts the tickets handed out
+    # since the last renumbering. Joining renumbers, O(n), once departed tickets far outnumber the
+    # waiting ones, and push_front always renumbers.
+    def __init__(self):
+        self.sockets = OrderedDict() # username -> socket, in queue order
+        self.tickets = {} # username -> arrival ticket, an index into tree
+        self.tree = [0] # Fenwick tree, tree[0] unused
+
+    def __len__(self):
+        return len(self.sockets)
+
+    def __contains__(self, username):
+        return username in self.sockets
+
+    def __iter__(self):
+        return iter(self.sockets)
+
+    def items(self):
+        return self.sockets.items()
+
+    def get(self, username):
+        return self.sockets.get(username)
+
+    def put(self, username, sock):
+        if len(self.tree) > 2 * len(self.sockets) + 1024: # mostly departed tickets, start again
+            self.renumber()
+        self.tickets[username] = self.append_ticket()
+        self.sockets[username] = sock
+
+    def pop(self):
+        # (username, socket) at the front
+        username, sock = self.sockets.popitem(last=False)
+        self.add(self.tickets.pop(username), -1)
+        return username, sock
+
+    def remove(self, username):
+        # Socket of a client leaving from anywhere in the queue, None if it is not queued
+        sock = self.sockets.pop(username, None)
+        if sock is not None:
+            self.add(self.tickets.pop(username), -1)
+        return sock
+
+    def position(self, username):
+        # Number of clients ahead of username
+        ticket = self.tickets[username]
+        ahead = 0
+        ticket -= 1
+        while ticket:
+            ahead += self.tree[ticket]
+            ticket -= ticket & -ticket
+        return ahead
+
+    def append_ticket(self):
+        # New last index holding 1, its node also covers the earlier indexes below its lowest set bit
+        index = len(self.tree)
+        total = 1
+        child = index - 1
+        while child > index - (index & -index):
+            total += self.tree[child]
+            child -= child & -child
+        self.tree.append(total)
+        return index
+
+    def add(self, index, delta):
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def push_front(self, username, sock):
+        # Put a client back at the front, e.g. a member a smaller capacity after /reload has no room for. O(n).
+        self.sockets[username] = sock
+        self.sockets.move_to_end(username, last=False)
+        self.renumber()
+
+    def renumber(self):
+        self.tree = [0]
+        for username in self.sockets:
+            self.tickets[username] = self.append_ticket()
+
+class Histogram:
+    # Cumulative-bucket histogram, not locked: callers hold the lock of whatever owns it
+    def __init__(self, buckets):
+        self.buckets = buckets # upper bounds, a last bucket catches the rest
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        # Upper bound of the bucket holding the fraction quantile, None without observations
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def exposition(self, name, labels=""):
+        # Prometheus text format lines for this histogram, labels e.g. 'channel="c1"'
+        lines = []
+        seen = 0
+        separator = "," if labels else ""
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            seen += bucket_count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {seen}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}" if labels else f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}" if labels else f"{name}_count {self.count}")
+        return lines
+
+class ChannelStats:
+    # Per channel counters, updated with the channel's lock held
+    def __init__(self):
+        self.messages_in = 0 # chat lines and whispers from members
+        self.messages_out = 0 # copies queued to members
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.afk_evictions = 0
+        self.broadcast_seconds = Histogram(LATENCY_BUCKETS) # time to queue a chat line for every member
+        self.queue_wait_seconds = Histogram(WAIT_BUCKETS) # time from joining the queue to being promoted
+
+class TransferStats:
+    # Server wide file transfer counters, transfers finish rarely enough for one lock
+    def __init__(self):
+        self.lock = Lock()
+        self.sent = 0
+        self.failed = 0
+        self.bytes = 0
+        self.seconds = Histogram(TRANSFER_BUCKETS) # /send to finished, successful transfers
+
+class CompressionStats:
+    # Bytes in and out of COMPRESSED frames of closed connections, open ones count their own
+    def __init__(self):
+        self.lock = Lock()
+        self.raw_out = 0 # before compressing
+        self.wire_out = 0 # as sent
+        self.raw_in = 0 # inflated
+        self.wire_in = 0 # as received
+
+class Profiler:
+    # Opt-in instrumentation, see PROFILE. Handler timings and stack samples live here, lock timings
+    # in each ProfiledLock. enabled is read without the lock, a stale read only loses a sample.
+    def __init__(self):
+        self.enabled = False
+        self.lock = Lock() # guards handlers and stacks
+        self.handlers = {} # handler name -> Histogram of call durations
+        self.stacks = Counter() # folded stack -> samples
+        self.stacks_changed = False
+        self.generation = 0 # bumped on every start so an older sampler thread knows to stop
+        self.stacks_file = PROFILE_STACKS_FILE # one per worker in supervisor mode
+
+    def start(self):
+        if self.enabled:
+            return False
+        self.generation += 1
+        self.enabled = True
+        Thread(target=self.sample_stacks, args=(self.generation, ), daemon=True).start()
+        return True
+
+    def stop(self):
+        if not self.enabled:
+            return False
+        self.enabled = False
+        self.write_stacks()
+        return True
+
+    def reset(self):
+        with self.lock:
+            self.handlers = {}
+            self.stacks = Counter()
+            self.stacks_changed = True
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.handlers.get(name)
+            if histogram is None:
+                histogram = self.handlers[name] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+
+    def sample_stacks(self, generation):
+        # Sampler thread: fold the stack of every other thread into self.stacks until stopped
+        me = current_thread().ident
+        written = time.monotonic()
+        while self.enabled and self.generation == generation:
+            samples = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+                    frame = frame.f_back
+                samples.append(";".join(reversed(frames)))
+            with self.lock:
+                self.stacks.update(samples)
+                self.stacks_changed = True
+            if time.monotonic() - written >= PROFILE_WRITE_INTERVAL:
+                self.write_stacks()
+                written = time.monotonic()
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+
+    def write_stacks(self):
+        # Replace the stacks file with every sample so far, most frequent stack first
+        with self.lock:
+            if not self.stacks_changed:
+                return
+            lines = [f"{stack} {samples}\n" for stack, samples in self.stacks.most_common()]
+            self.stacks_changed = False
+        temporary = self.stacks_file + ".tmp"
+        try:
+            with open(temporary, "w") as file:
+                file.writelines(lines)
+            os.replace(temporary, self.stacks_file)
+        except OSError as error:
+            print(f"Error: unable to write {self.stacks_file}: {error}", file=sys.stderr, flush=True)
+
+profiler = Profiler()
+
+def profiled(method):
+    # Time a handler in profiler.handlers while profiling is on. Times are inclusive, so
+    # handle_message also counts the handler it dispatches to.
+    name = method.__name__
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        if not profiler.enabled:
+            return method(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            profiler.observe(name, time.perf_counter() - started)
+    return wrapper
+
+class ProfiledLock:
+    # A Lock that, while profiling is on, records how long acquiring it waited and how long it was held.
+    # The histograms are only touched with the lock held, so they need no lock of their own.
+    def __init__(self):
+        self.lock = Lock()
+        self.wait_seconds = Histogram(LATENCY_BUCKETS)
+        self.hold_seconds = Histogram(LATENCY_BUCKETS)
+        self.acquired_at = None # perf_counter() when the current holder got it, None when not timed
+
+    def __enter__(self):
+        if not profiler.enabled:
+            self.lock.acquire()
+            return True
+        started = time.perf_counter()
+        self.lock.acquire()
+        self.acquired_at = time.perf_counter()
+        self.wait_seconds.observe(self.acquired_at - started)
+        return True
+
+    def __exit__(self, *exc_info):
+        if self.acquired_at is not None:
+            self.hold_seconds.observe(time.perf_counter() - self.acquired_at)
+            self.acquired_at = None
+        self.lock.release()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # GET /metrics for the optional metrics endpoint
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.chat_server.render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # keep stdout for the event log
+        pass
+
+class Worker:
+    # The supervisor's handle on one worker process
+    def __init__(self, index, pid, sock, output, channels):
+        self.index = index
+        self.pid = pid
+        self.sock = sock # unix socket the worker reads admin commands from, one JSON object per line
+        self.output = output # read end of the worker's stdout pipe
+        self.channels = channels
+        self.forwarder = None # thread copying output to the supervisor's log
+        self.stopping = False
+
 class Channel: 
     def __init__(self, name, port, capacity, socket):
         self.name = name
         self.port = port
         self.capacity = capacity
         self.socket = socket
+        self.order = next(channel_order)
+        self.lock = ProfiledLock() # guards everything below
+        self.closed = False # removed by /reload, takes no more clients
+
+        self.connected_clients = {} # connected client -> socket, in joining order, see add_member
+        self.ring = BroadcastRing(BROADCAST_RING_SIZE) if capacity >= LARGE_CHANNEL_CAPACITY else None
+
+        self.queue = WaitingQueue() # clients waiting to join -> socket
+        self.positions_due = None # time.monotonic() when changed queue positions are next sent, None if unchanged
+
+        self.disconnected_clients = set() # clients that should be disconnected after afk timeout
+        self.reserved = {} # username -> time.monotonic() deadline, held for a /switch from another worker
+
+        self.stats = ChannelStats()
+        self.slot = None # index in the shared occupancy table, see WORKERS
 
-        self.connected_clients = [] # connected clients
-        self.client_sockets = {} # client -> socket
+        self.history = deque() # recent chat lines as EncodedMessages, oldest first
+        self.history_bytes = 0
 
-        self.queue = Queue() # clients waiting to join
-        self.queue_sockets = {} # client -> socket
-        self.queue_clients = 0 # number of clients in queue
-        self.queue_clients_usernames = [] # list of queue client usernames
+    def has_user(self, username):
+        # Connected, queued or reserved by a /switch on its way from another worker
+        if username in self.connected_clients or username in self.queue:
+            return True
+        deadline = self.reserved.get(username)
+        return deadline is not None and deadline > time.monotonic()
 
-        self.disconnected_clients = [] # stores client -> True for clients that should be disconnected after afk timeout
+    def remember(self, message):
+        # Add a broadcast EncodedMessage to the history, dropping the oldest lines past either limit
+        self.history.append(message)
+        self.history_bytes += len(message.plain)
+        while self.history and (len(self.history) > HISTORY_MESSAGES or self.history_bytes > HISTORY_BYTES):
+            self.history_bytes -= len(self.history.popleft().plain)
 
 class Server: 
     def __init__(self, afk_time, config_file): 
         self.afk_time = afk_time
         self.config_file = config_file
-        self.channels = []
-        self.channel_names = []
-        self.channel_ports = []
-
-    def load_config(self): # load the config file and check invalid lines
-        names = []
-        ports = []
+        self.channels = [] # in configuration file order, only this worker's share in a worker
+        self.all_channels = self.channels # every configured channel, for /list
+        self.remote_channels = {} # name -> index of the worker serving it, other workers' channels in a worker
+        self.channels_by_name = {} # name -> Channel
+        self.channels_by_port = {} # port -> Channel
+        self.shared_socket = None # listener for every channel, see SHARED_PORT
+        self.connections = {} # socket -> Connection
+        self.writer = None # OutboundWriter in thread mode
+        self.log = EventLog(sys.stdout)
+        self.archive = None # ChatArchive when CHATSERVER_ARCHIVE_DIR is set
+
+        self.afk_scheduler = AfkScheduler(afk_time)
+
+        # Supervisor mode state, see WORKERS
+        self.workers = [] # Worker per process in the supervisor
+        self.channel_workers = {} # channel name -> Worker in the supervisor
+        self.supervisor = None # unix socket to the supervisor in a worker
+        self.pending_requests = {} # request ID -> function called with the reply from another worker, see answer_request
+        self.request_ids = count(1)
+        self.worker_index = None
+        self.occupancy = None # shared mmap of every channel's OCCUPANCY, None in a single process
+        self.free_slots = [] # occupancy slots of no channel, in the supervisor
+        self.reload_lock = Lock() # one /reload at a time
+
+        # Event loop mode state
+        self.selector = None
+        self.admin_calls = Queue() # admin commands from stdin, run on the loop thread
+        self.wakeup_recv, self.wakeup_send = None, None
+        self.recv_buffer = bytearray(RELAY_BUFSIZE) # the loop thread's reusable receive buffer
+        self.deferred_flushes = local() # per thread: .conns is the dict of connections batched_flush holds back
+        self.transfer_ids = count(1)
+        self.transfer_stats = TransferStats()
+        self.compression_stats = CompressionStats()
+
+    def read_config(self):
+        # Check every line of the config file: [(name, port, capacity)] in file order, None if it is invalid
+        names = {} # dicts as ordered sets: constant time uniqueness checks, file order kept
+        ports = {}
         capacities = []
 
         # Check if file empty
-        if os.path.getsize(self.config_file) == 0:
-            print("Error: Invalid configuration file.", file=sys.stderr)
-            exit(EXIT_CODES.CONFIG_FILE_ERROR.value)
+        try:
+            if os.path.getsize(self.config_file) == 0:
+                return None
+        except OSError: # e.g. removed since the server started
+            return None
 
         with open(self.config_file, 'r') as file: 
             while True:
@@ -71,104 +1205,152 @@ class Server:
                 #     exit(EXIT_CODES.CONFIG_FILE_ERROR.value)
 
                 if '\r\n' in line: # '\r\n' in line or '^M' in line: # check for trailing characters e.g. ^M #  
-                    print("Error: Invalid configuration file.", file=sys.stderr)
-                    exit(EXIT_CODES.CONFIG_FILE_ERROR.value)
+                    return None
 
                 line = line.strip() # remove leading or trailing whitespace
                 channel = line.split(" ")
 
                 if not len(channel) == 4: # too little/many arguments
-                    print("Error: Invalid configuration file.", file=sys.stderr)
-                    exit(EXIT_CODES.CONFIG_FILE_ERROR.value)
+                    return None
 
                 if not channel[0] == "channel":
-                    print("Error: Invalid configuration file.", file=sys.stderr)
-                    exit(EXIT_CODES.CONFIG_FILE_ERROR.value)
+                    return None
                 
                 channel_name = channel[1] # TODO: check any args empty strings???, check if config file None or empty???
                 channel_port = channel[2]
                 channel_capacity = channel[3]
 
                 if not re.match("^[A-Za-z0-9_]*$", channel_name): # check channel only letters, numbers, underscores
-                    print("Error: Invalid configuration file.", file=sys.stderr)
-                    exit(EXIT_CODES.CONFIG_FILE_ERROR.value)
+                    return None
 
-                if channel_name in self.channel_names: # check channel name unique
-                    print("Error: Invalid configuration file.", file=sys.stderr)
-                    exit(EXIT_CODES.CONFIG_FILE_ERROR.value)
+                if channel_name in names: # check channel name unique
+                    return None
 
                 if not channel_port.isdigit(): # check port is integer
-                    print("Error: Invalid configuration file.", file=sys.stderr)
-                    exit(EXIT_CODES.CONFIG_FILE_ERROR.value)
+                    return None
 
                 channel_port = int(channel[2]) # convert to int after checking
 
                 if not (1024 <= channel_port <= 65535): # port out of range
-                    print("Error: Invalid configuration file.", file=sys.stderr)
-                    exit(EXIT_CODES.CONFIG_FILE_ERROR.value)
+                    return None
 
-                if channel_port in self.channel_ports: # check channel port unique
-                    print("Error: Invalid configuration file.", file=sys.stderr)
-                    exit(EXIT_CODES.CONFIG_FILE_ERROR.value)
+                if channel_port in ports: # check channel port unique
+                    return None
 
                 if not channel_capacity.isdigit(): # check capacity is integer
-                    print("Error: Invalid configuration file.", file=sys.stderr)
-                    exit(EXIT_CODES.CONFIG_FILE_ERROR.value)
+                    return None
 
                 channel_capacity = int(channel[3]) # convert to int after checking
 
-                if not (1 <= channel_capacity <= 8): # capacity out of range
-                    print("Error: Invalid configuration file.", file=sys.stderr)
-                    exit(EXIT_CODES.CONFIG_FILE_ERROR.value)
+                if not (1 <= channel_capacity <= MAX_CAPACITY): # capacity out of range
+                    return None
 
-                names.append(channel_name)
-                ports.append(channel_port)
+                names[channel_name] = None
+                ports[channel_port] = None
                 capacities.append(channel_capacity)
 
+        return list(zip(names, ports, capacities))
+
+    def load_config(self): # load the config file and check invalid lines
+        entries = self.read_config()
+        if entries is None:
+            print("Error: Invalid configuration file.", file=sys.stderr)
+            exit(EXIT_CODES.CONFIG_FILE_ERROR.value)
+
         # check each port is connectable and open a socket for it
-        length = len(names)
+        length = len(entries)
 
-        for i in range(0, length):
-            listening_socket = self.start_server(ports[i])
+        for name, port, capacity in entries:
+            listening_socket = self.start_server(port, self.listen_backlog(capacity))
 
-            new_channel = Channel(names[i], ports[i], capacities[i], listening_socket)
+            new_channel = Channel(name, port, capacity, listening_socket)
             self.channels.append(new_channel)
-            self.channel_names.append(names[i])
-            self.channel_ports.append(ports[i])
+            self.channels_by_name[name] = new_channel
+            self.channels_by_port[port] = new_channel
+
+        if SHARED_PORT:
+            self.shared_socket = self.start_server(int(SHARED_PORT), SOMAXCONN) # one port takes every channel's clients
 
         # print that channels created successfully
         for i in range(0, length):
-            print(f"Channel \"{self.channels[i].name}\" is created on port {self.channels[i].port}, with a capacity of {self.channels[i].capacity}.", file=sys.stdout)
-            sys.stdout.flush()
+            self.log.write(f"Channel \"{self.channels[i].name}\" is created on port {self.channels[i].port}, with a capacity of {self.channels[i].capacity}.")
         
-        print("Welcome to chatserver.", file=sys.stdout)
-        sys.stdout.flush()
-        
-        file.close()
+        if self.shared_socket is not None:
+            self.log.write(f"Every channel can be joined on port {SHARED_PORT}.")
+        self.log.write("Welcome to chatserver.")
         return
 
-    def start_server(self, port):
-        listening_socket = socket(AF_INET, SOCK_STREAM)
-        listening_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        try:
-            listening_socket.bind(('', port))
-        except Exception:
+    def start_server(self, port, backlog=5):
+        listening_socket = self.open_listener(port, backlog)
+        if listening_socket is None:
             print(f"Error: unable to listen on port {port}.", file=sys.stderr, flush=True)
             
             exit(EXIT_CODES.PORT_ERROR.value)
-        listening_socket.listen(5)
         
         return listening_socket 
+
+    def listen_backlog(self, capacity):
+        # Large channels take thousands of clients, which must not be refused while they are being accepted
+        return SOMAXCONN if capacity >= LARGE_CHANNEL_CAPACITY else 5
+
+    def open_listener(self, port, backlog=5):
+        # Listening socket on port, None if it cannot be bound
+        listening_socket = socket(AF_INET, SOCK_STREAM)
+        listening_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        try:
+            listening_socket.bind(('', port))
+        except Exception:
+            listening_socket.close()
+            return None
+        listening_socket.listen(backlog)
+        return listening_socket
     
-    # Create a new thread for each channel
+    # Create a new thread for each channel, or serve all channels from one event loop
     def process_connections(self):
+        self.log.start()
+        if PROFILE == "on":
+            profiler.start()
+        if METRICS_PORT:
+            self.start_metrics_server(int(METRICS_PORT) + (self.worker_index or 0))
+        if self.archive is not None:
+            self.archive.start()
+
+        if SERVER_MODE == "eventloop":
+            self.selector = selectors.DefaultSelector()
+            self.wakeup_recv, self.wakeup_send = socketpair()
+
+        if self.supervisor is not None:
+            admin_thread = Thread(target=self.handle_supervisor, daemon=True)
+        else:
+            admin_thread = Thread(target=self.handle_stdin, daemon=True)
+        admin_thread.start()
+
+        if SERVER_MODE == "eventloop":
+            self.run_event_loop()
+            return
+
+        self.writer = OutboundWriter(self.relay_drained)
+        writer_thread = Thread(target=self.writer.run, daemon=True)
+        writer_thread.start()
 
-        stdin_thread = Thread(target=self.handle_stdin, daemon=True)
-        stdin_thread.start()
+        afk_thread = Thread(target=self.run_afk_scheduler, daemon=True)
+        afk_thread.start()
 
         for channel in self.channels:
-            client_thread = Thread(target=self.handle_channel, args=(channel, ))
-            client_thread.start()
+            self.start_accepting(channel)
+        if self.shared_socket is not None:
+            Thread(target=self.handle_shared_port).start()
+
+    def run_admin(self, command, *args):
+        # Event loop mode owns all client state on the loop thread, so hand admin commands (and archive
+        # replies) over to it
+        if self.workers: # supervisor: the workers own the clients
+            self.route_admin(command.__name__, args)
+        elif SERVER_MODE == "eventloop":
+            self.admin_calls.put((command, args))
+            self.wakeup_send.send(b"\0")
+        else:
+            command(*args)
 
     def handle_stdin(self):
         while True:
@@ -179,63 +1361,447 @@ class Server:
                     if commands[0] == "/kick" or commands[0] == "/kick\n":
                         commands = line.split(" ", maxsplit=2)
                         if len(commands) != 3: 
-                            print("Usage: /kick channel_name client_username", file=sys.stdout, flush=True)
+                            self.log.write("Usage: /kick channel_name client_username", "admin")
                         elif commands[1] == "" or commands[1] == " " or commands[2] == "" or commands[2] == " ":
-                            print("Usage: /kick channel_name client_username", file=sys.stdout, flush=True)
+                            self.log.write("Usage: /kick channel_name client_username", "admin")
                         elif " " in commands[1] or " " in commands[2]:
-                            print("Usage: /kick channel_name client_username", file=sys.stdout, flush=True)
+                            self.log.write("Usage: /kick channel_name client_username", "admin")
                         elif not re.match(r'^[\x21-\x7E]*$', commands[1]) or not re.match(r'^[\x21-\x7E]*$', commands[2]): # does not allow space, allows new lines # \n after *
-                            print("Usage: /kick channel_name client_username", file=sys.stdout, flush=True)
+                            self.log.write("Usage: /kick channel_name client_username", "admin")
                         else:
-                            self.kick_command(commands[1], commands[2])
+                            self.run_admin(self.kick_command, commands[1], commands[2])
                     elif commands[0] == "/shutdown" or commands[0] == "/shutdown\\n": # or commands[0] == "/shutdown\n":
                         if len(commands) != 1: 
-                            print("Usage: /shutdown", file=sys.stdout, flush=True)
+                            self.log.write("Usage: /shutdown", "admin")
                         elif not re.match(r'^[\x21-\x7E]*$', commands[0]) or "\\n" in commands[0]: # does not allow space, allows new lines # \n after *
-                            print("Usage: /shutdown", file=sys.stdout, flush=True)
+                            self.log.write("Usage: /shutdown", "admin")
                         else:
-                            print(f"[Server Message] Server shuts down.", file=sys.stdout, flush=True)
-                            os._exit(0)
+                            self.shutdown()
                     elif commands[0] == "/mute" or commands[0] == "/mute\\n" or commands[0] == "\mute\n":
                         commands = line.split(" ", maxsplit=4)
                         if len(commands) != 4:
-                            print("Usage: /mute channel_name client_username duration", file=sys.stdout, flush=True)
+                            self.log.write("Usage: /mute channel_name client_username duration", "admin")
                         elif commands[1] == "" or " " in commands[1] or commands[2] == "" or " " in commands[2] or commands[3] == "" or " " in commands[3]:
-                            print("Usage: /mute channel_name client_username duration", file=sys.stdout, flush=True)
+                            self.log.write("Usage: /mute channel_name client_username duration", "admin")
                         elif not re.match(r'^[\x21-\x7E]*$', commands[1]) or not re.match(r'^[\x21-\x7E]*$', commands[2]) or not re.match(r'^[\x21-\x7E]*$', commands[3]):
-                            print("Usage: /mute channel_name client_username duration", file=sys.stdout, flush=True)
+                            self.log.write("Usage: /mute channel_name client_username duration", "admin")
+                        else:
+                            self.run_admin(self.mute_command, commands[1], commands[2], commands[3])
+                    elif commands[0] == "/outbound":
+                        if len(commands) != 1:
+                            self.log.write("Usage: /outbound", "admin")
                         else:
-                            self.mute_command(commands[1], commands[2], commands[3])
+                            self.run_admin(self.outbound_command)
+                    elif commands[0] == "/stats":
+                        if len(commands) != 1:
+                            self.log.write("Usage: /stats", "admin")
+                        else:
+                            self.run_admin(self.stats_command)
+                    elif commands[0] == "/reload":
+                        if len(commands) != 1:
+                            self.log.write("Usage: /reload", "admin")
+                        else:
+                            self.reload()
+                    elif commands[0] == "/profile":
+                        if len(commands) > 2 or (len(commands) == 2 and commands[1] not in ("on", "off", "reset")):
+                            self.log.write("Usage: /profile [on|off|reset]", "admin")
+                        else:
+                            self.run_admin(self.profile_command, commands[1] if len(commands) == 2 else None)
                     elif commands[0] == "/empty" or commands[0] == "/empty\\n" or commands[0] == "/empty\n":
                         commands = line.split(" ", maxsplit=1)
                         if len(commands) != 2:
-                            print("Usage: /empty channel_name", file=sys.stdout, flush=True)
+                            self.log.write("Usage: /empty channel_name", "admin")
                         elif commands[1] == "" or commands[1] == " ": # channel name is space
-                            print("Usage: /empty channel_name", file=sys.stdout, flush=True)
+                            self.log.write("Usage: /empty channel_name", "admin")
                         elif " " in commands[1]:
-                            print("Usage: /empty channel_name", file=sys.stdout, flush=True)
+                            self.log.write("Usage: /empty channel_name", "admin")
                         elif not re.match(r'^[\x21-\x7E]*$', commands[1]): # does not allow space, allows new lines # \n after *
-                            print("Usage: /empty channel_name", file=sys.stdout, flush=True)
+                            self.log.write("Usage: /empty channel_name", "admin")
                         # elif commands[1].rstrip("\n") != commands[1].rstrip():
                         #     print("Usage: /empty channel_name", file=sys.stdout, flush=True)
                         else:
-                            self.empty_command(commands[1])
+                            self.run_admin(self.empty_command, commands[1])
             except KeyboardInterrupt:
                 # TODO: server disconnect
                 pass
 
+    def shutdown(self):
+        if self.workers: # let every worker write the rest of its log first
+            for worker in self.workers:
+                worker.stopping = True
+                self.send_to_worker(worker, "shutdown", ())
+            for worker in self.workers:
+                worker.forwarder.join()
+        self.log.write(f"[Server Message] Server shuts down.")
+        self.log.close() # everything logged so far is written before exiting
+        if self.archive is not None:
+            self.archive.close()
+        os._exit(0)
+
+    def supervise(self, worker_count):
+        # Fork the workers, then serve stdin. Called before any thread is started, so forking is safe.
+        slots = max(len(self.channels), OCCUPANCY_SLOTS)
+        self.occupancy = mmap.mmap(-1, OCCUPANCY.size * slots) # shared with the workers
+        for slot, channel in enumerate(self.channels):
+            channel.slot = slot
+        self.free_slots = list(range(slots - 1, len(self.channels) - 1, -1)) # lowest last, for pop()
+        owners = {channel.name: position % worker_count for position, channel in enumerate(self.channels)}
+        sys.stdout.flush()
+
+        for index in range(worker_count):
+            channels = self.channels[index::worker_count]
+            supervisor_sock, worker_sock = socketpair(AF_UNIX, SOCK_SEQPACKET) # message boundaries keep passed sockets with their command
+            output, worker_output = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                supervisor_sock.close()
+                os.close(output)
+                self.run_worker(index, channels, worker_sock, worker_output, owners)
+            worker_sock.close()
+            os.close(worker_output)
+            worker = Worker(index, pid, supervisor_sock, output, channels)
+            self.workers.append(worker)
+            for channel in channels:
+                self.channel_workers[channel.name] = worker
+
+        for channel in self.channels: # the workers accept on their own copies
+            channel.socket.close()
+
+        self.log.start()
+        for worker in self.workers:
+            worker.forwarder = Thread(target=self.forward_output, args=(worker, ), daemon=True)
+            worker.forwarder.start()
+            Thread(target=self.relay_worker_messages, args=(worker, ), daemon=True).start()
+        if self.shared_socket is not None:
+            Thread(target=self.handle_shared_port, daemon=True).start()
+        self.handle_stdin()
+
+    def run_worker(self, index, channels, supervisor_sock, output, owners):
+        # In the forked worker: serve channels like a single process server and never return
+        os.dup2(output, sys.stdout.fileno())
+        os.close(output)
+        for worker in self.workers: # the supervisor's ends for the workers forked before this one
+            worker.sock.close()
+            os.close(worker.output)
+        self.workers = []
+        self.channel_workers = {}
+        signal.signal(signal.SIGHUP, signal.SIG_IGN) # the supervisor reloads, then tells this worker
+        if self.shared_socket is not None: # the supervisor accepts on it
+            self.shared_socket.close()
+            self.shared_socket = None
+        for channel in self.channels:
+            if channel not in channels:
+                channel.socket.close()
+        self.channels = channels
+        self.channels_by_name = {channel.name: channel for channel in channels}
+        self.channels_by_port = {channel.port: channel for channel in channels}
+        self.remote_channels = {name: owner for name, owner in owners.items() if owner != index}
+        self.supervisor = supervisor_sock
+        self.worker_index = index
+        if ARCHIVE_DIR:
+            self.open_archive()
+        profiler.stacks_file = f"{PROFILE_STACKS_FILE}.{index}"
+        try:
+            self.process_connections()
+            while True: # thread mode serves from other threads, this one has nothing left to do
+                time.sleep(3600)
+        except SystemExit as error: # e.g. the metrics port is taken
+            os._exit(error.code)
+        except BaseException:
+            traceback.print_exc()
+            os._exit(1)
+
+    def send_to_worker(self, worker, command, args, fds=()):
+        # One command per message, fds (e.g. a client socket) travel with it
+        message = json.dumps({"command": command, "args": list(args)}).encode()
+        try:
+            if fds:
+                send_fds(worker.sock, [message], fds)
+            else:
+                worker.sock.send(message)
+        except OSError: # the worker is gone, forward_output reports it
+            pass
+
+    def route_admin(self, command, args):
+        # Supervisor: run an admin command on the worker with its channel, or on every worker
+        if command in ("kick_command", "mute_command", "empty_command"):
+            # an unknown channel goes to any worker, which reports that it does not exist
+            self.send_to_worker(self.channel_workers.get(args[0], self.workers[0]), command, args)
+        else:
+            for worker in self.workers:
+                self.send_to_worker(worker, command, args)
+
+    def forward_output(self, worker):
+        # Supervisor thread: copy whole lines from a worker's stdout to the log until the worker exits
+        with os.fdopen(worker.output, "r") as output:
+            for line in output:
+                self.log.forward(line.rstrip("\n"))
+        os.waitpid(worker.pid, 0)
+        if not worker.stopping:
+            names = ", ".join(f"\"{channel.name}\"" for channel in worker.channels)
+            self.log.write(f"[Server Message] Worker {worker.index} exited, channels {names} are no longer served.")
+
+    def handle_supervisor(self):
+        # Worker thread: run the admin commands and adopt the clients the supervisor sends
+        while True:
+            message, fds, flags, address = recv_fds(self.supervisor, IPC_BUFSIZE, 2)
+            if not message:
+                break
+            request = json.loads(message)
+            if request["command"] == "shutdown":
+                break
+            if request["command"] == "adopt_client" and fds:
+                self.run_admin(self.adopt_client, socket(fileno=fds[0]), request["args"][0].encode("latin-1"))
+            elif request["command"] == "switch_in" and len(fds) == 2:
+                channel_name, client_username, version, codec, outbound_size, window_size = request["args"]
+                with open(fds[1], "rb") as state: # what hand_off_client wrote, the offset is shared with the sender
+                    state.seek(0)
+                    pending = state.read()
+                window_start = len(pending) - window_size
+                self.run_admin(self.adopt_switched_client, socket(fileno=fds[0]), channel_name, client_username, version, codec,
+                               pending[:outbound_size], pending[outbound_size:window_start], pending[window_start:])
+            elif request["command"] == "apply_config":
+                config, names = request["args"]
+                self.run_admin(self.apply_worker_config, config, {name: socket(fileno=fd) for name, fd in zip(names, fds)})
+            elif request["command"] == "reserve": # answered here, not by the event loop, which may be waiting for a reservation itself
+                self.reserve_username(*request["args"])
+            elif request["command"] == "reserved":
+                self.answer_request(*request["args"])
+            elif request["command"] in WORKER_COMMANDS:
+                self.run_admin(getattr(self, request["command"]), *request["args"])
+            else:
+                for fd in fds: # not what the command expects
+                    os.close(fd)
+        # shut down, or the supervisor is gone
+        self.log.close()
+        if self.archive is not None:
+            self.archive.close()
+        os._exit(0)
+
+    def send_to_supervisor(self, command, args, fds=(), **route):
+        # Worker: a message for another worker, routed by channel= (its owner) or worker= (an index)
+        message = json.dumps({"command": command, "args": list(args), **route}).encode()
+        try:
+            send_fds(self.supervisor, [message], fds)
+        except OSError: # the supervisor is gone, handle_supervisor shuts this worker down
+            pass
+
+    def relay_worker_messages(self, worker):
+        # Supervisor thread: pass what a worker sends on to the worker it is for, with any descriptors
+        while True:
+            try:
+                message, fds, flags, address = recv_fds(worker.sock, IPC_BUFSIZE, 2)
+            except OSError:
+                return
+            if not message:
+                return
+            request = json.loads(message)
+            if "channel" in request:
+                target = self.channel_workers.get(request["channel"])
+            else:
+                target = self.workers[request["worker"]]
+            if target is not None:
+                self.send_to_worker(target, request["command"], request["args"], fds)
+            for fd in fds: # the target has its own copies
+                os.close(fd)
+
+    def reserve_remote(self, conn, channel_name, client_username):
+        # Worker: the duplicate username check of a /switch into another worker's channel. The owner
+        # reserves the username for HANDOFF_TIMEOUT seconds if it is free. Thread mode waits for the answer,
+        # True if it did. The event loop cannot wait without holding up every client, so it stops reading
+        # this one and returns False; remote_reserved carries on with the /switch once the answer is in.
+        request_id = next(self.request_ids)
+        if SERVER_MODE == "eventloop":
+            conn.reserving = channel_name
+            self.update_events(conn)
+            self.pending_requests[request_id] = lambda reserved: self.run_admin(self.remote_reserved, conn, channel_name, reserved)
+            timeout = Timer(HANDOFF_TIMEOUT, self.answer_request, (request_id, None))
+            timeout.daemon = True
+            timeout.start()
+            self.send_to_supervisor("reserve", [channel_name, client_username, request_id, self.worker_index], channel=channel_name)
+            return False
+
+        waiting = [Event(), None]
+        def answered(reserved):
+            waiting[1] = reserved
+            waiting[0].set()
+        self.pending_requests[request_id] = answered
+        self.send_to_supervisor("reserve", [channel_name, client_username, request_id, self.worker_index], channel=channel_name)
+        waiting[0].wait(HANDOFF_TIMEOUT)
+        self.answer_request(request_id, None) # forget it if no answer came
+        if not waiting[1]:
+            self.refuse_remote_switch(conn, channel_name, waiting[1])
+        return bool(waiting[1])
+
+    def answer_request(self, request_id, answer):
+        # Worker: a reply from another worker, None when none came in time. Only the first one counts.
+        answered = self.pending_requests.pop(request_id, None)
+        if answered is not None:
+            answered(answer)
+
+    def refuse_remote_switch(self, conn, channel_name, reserved):
+        if reserved is None: # no answer, e.g. that worker has exited
+            message = f"[Server Message] Channel \"{channel_name}\" is not available."
+        else:
+            message = f"[Server Message] Channel \"{channel_name}\" already has user {conn.username}."
+        self.send_message(conn.sock, message)
+
+    def remote_reserved(self, conn, channel_name, reserved):
+        # Event loop worker: the answer to reserve_remote. Hand the client over, or tell it why not and
+        # read it again, starting with what it sent after the /switch.
+        conn.reserving = None
+        messages, conn.held_messages = conn.held_messages, []
+        if self.connections.get(conn.sock) is not conn: # gone meanwhile, a reservation expires by itself
+            return
+        if reserved:
+            conn.handoff = channel_name
+            self.hand_off_client(conn, messages)
+            return
+        self.refuse_remote_switch(conn, channel_name, reserved)
+        self.update_events(conn)
+        if not self.handle_messages(conn, messages):
+            self.forget_connection(conn.sock)
+
+    def reserve_username(self, channel_name, client_username, request_id, worker_index):
+        # Worker: answer reserve_remote for one of this worker's channels
+        channel = self.channels_by_name.get(channel_name)
+        reserved = False
+        if channel is not None:
+            with channel.lock:
+                if not channel.has_user(client_username):
+                    channel.reserved[client_username] = time.monotonic() + HANDOFF_TIMEOUT
+                    reserved = True
+        self.send_to_supervisor("reserved", [request_id, reserved], worker=worker_index)
+
+    def hand_off_client(self, conn, messages):
+        # Worker: /switch into another worker's channel (conn.handoff), whose owner has reserved the username.
+        # The client leaves its channel here and its socket goes to the owner together with what is still
+        # queued for it, what it sent after the /switch and the history of its compressed stream, so it needs
+        # no reconnect or new handshake. Its file transfers fail as if it had disconnected.
+        channel, client_username = conn.channel, conn.username
+        flush = []
+        with channel.lock:
+            self.detach_client(channel, client_username, True, flush)
+        self.flush_connections(flush)
+
+        with conn.lock:
+            outbound = b"".join(conn.outbound)
+            conn.outbound.clear()
+            conn.outbound_bytes = 0
+            conn.close_deadline = time.monotonic() # nothing more is sent from here
+            writer_has_it = conn.write_watched
+            conn.write_watched = SERVER_MODE != "eventloop" and writer_has_it
+        self.forget_connection(conn.sock)
+
+        pending = b"".join(encode_frame(frame_type, message) for frame_type, message in messages)
+        window = b""
+        if conn.decoder is not None:
+            pending += bytes(conn.decoder.buffer)
+            if conn.decoder.window is not None:
+                window = bytes(conn.decoder.window)
+        state = os.memfd_create("chatserver-handoff") # no size limit, unlike the messages between processes
+        try:
+            with open(state, "wb", closefd=False) as file:
+                file.write(outbound + pending + window)
+            self.send_to_supervisor("switch_in", [conn.handoff, client_username, conn.protocol_version, conn.codec, len(outbound), len(window)],
+                                    [conn.sock.fileno(), state], channel=conn.handoff)
+        finally:
+            os.close(state)
+        if SERVER_MODE == "eventloop" or not writer_has_it: # otherwise the writer closes it, this process's copy only
+            conn.sock.close()
+
+        self.promote_from_queue(channel)
+
+    def adopt_switched_client(self, client_socket, channel_name, client_username, version, codec, outbound, pending, window):
+        # Worker: take over a client hand_off_client sent into one of this worker's channels
+        client_socket.setblocking(True)
+        channel = self.channels_by_name.get(channel_name)
+        if channel is None: # removed by /reload while the client was on its way
+            channel = Channel(channel_name, None, 0, None)
+            channel.closed = True
+        conn = Connection(client_socket, channel)
+        conn.username = client_username
+        if version is not None:
+            conn.start_framing(version)
+            conn.decoder.buffer += pending
+        if outbound: # sent before anything this worker queues, and already compressed
+            conn.queue_output(outbound, True)
+        if codec is not None: # a new deflate stream, the client inflates it with the one it has
+            conn.start_compression(codec, window, True)
+        self.connections[client_socket] = conn
+
+        flush = []
+        with channel.lock:
+            channel.reserved.pop(client_username, None)
+            attached = self.attach_client(conn, channel, flush)
+        if not attached:
+            self.close_client_socket(client_socket)
+            return
+        self.flush_connections(flush)
+        if client_username in channel.connected_clients:
+            self.record_activity(conn)
+
+        if SERVER_MODE == "eventloop":
+            self.selector.register(client_socket, selectors.EVENT_READ, conn)
+            if not self.handle_messages(conn, conn.buffered_messages()):
+                self.forget_connection(client_socket)
+        else:
+            Thread(target=self.handle_communication, args=(conn, )).start()
+
+    def handle_shared_port(self):
+        # Accept clients that name their channel in the handshake
+        while True:
+            client_socket, client_address = self.shared_socket.accept()
+            if self.workers:
+                Thread(target=self.route_shared_client, args=(client_socket, ), daemon=True).start()
+            else:
+                Thread(target=self.handle_client, args=(None, client_socket, None, False)).start()
+
+    def route_shared_client(self, client_socket):
+        # Supervisor: read a shared port client's handshake and pass its socket to the worker with the channel.
+        # An unknown channel goes to any worker, which tells the client it does not exist.
+        client_socket.settimeout(HANDSHAKE_TIMEOUT)
+        try:
+            hello = client_socket.recv(BUFSIZE)
+            channel_name = parse_hello(hello)[2]
+        except (OSError, ValueError): # timed out, reset or not a handshake
+            client_socket.close()
+            return
+        if not hello:
+            client_socket.close()
+            return
+        worker = self.channel_workers.get(channel_name, self.workers[0])
+        self.send_to_worker(worker, "adopt_client", [hello.decode("latin-1")], [client_socket.fileno()])
+        client_socket.close() # the worker has its own copy
+
+    def adopt_client(self, client_socket, hello):
+        # Worker: serve a client the supervisor accepted on the shared port, hello is the handshake it read
+        client_socket.setblocking(True)
+        if SERVER_MODE == "eventloop":
+            conn = Connection(client_socket, None)
+            self.connections[client_socket] = conn
+            self.selector.register(client_socket, selectors.EVENT_READ, conn)
+            self.admit_hello(conn, hello)
+        else:
+            Thread(target=self.handle_client, args=(None, client_socket, None, False, hello)).start()
+
+    def publish_occupancy(self, channel):
+        # Update channel's slot in the shared occupancy table, call with channel.lock held
+        if self.occupancy is not None and not channel.closed: # a removed channel's slot may be another's by now
+            OCCUPANCY.pack_into(self.occupancy, channel.slot * OCCUPANCY.size, len(channel.connected_clients), len(channel.queue))
+
+    def occupancy_of(self, channel):
+        # (connected clients, queued clients) of any configured channel
+        if self.occupancy is None:
+            return len(channel.connected_clients), len(channel.queue)
+        return OCCUPANCY.unpack_from(self.occupancy, channel.slot * OCCUPANCY.size)
+
     def get_channel(self, channel_name): 
         # Check channel exists
-        if not channel_name in self.channel_names:
-            print(f"[Server Message] Channel \"{channel_name}\" does not exist.", file=sys.stdout, flush=True)
-    
-        # Get channel object and return
-        channel = None
-        for current_channel in self.channels:
-            if current_channel.name == channel_name:
-                channel = current_channel
-                break
-        
+        channel = self.channels_by_name.get(channel_name)
+        if channel is None:
+            self.log.write(f"[Server Message] Channel \"{channel_name}\" does not exist.", "admin")
+
         return channel
 
     def mute_command(self, channel_name, client_username, duration):
@@ -245,10 +1811,11 @@ class Server:
             return
         
         # Check connected client in channel
-        with counter_lock:
-            if not client_username in channel.connected_clients:
-                print(f"[Server Message] {client_username} is not in the channel.", file=sys.stdout, flush=True)
-                return
+        with channel.lock:
+            connected = client_username in channel.connected_clients
+        if not connected:
+            self.log.write(f"[Server Message] {client_username} is not in the channel.", "admin")
+            return
         
         # Check duration positive integer
         try:
@@ -256,23 +1823,24 @@ class Server:
             if duration <= 0: 
                 raise ValueError
         except ValueError:
-            print("[Server Message] Invalid mute duration.", file=sys.stdout, flush=True)
+            self.log.write("[Server Message] Invalid mute duration.", "admin")
             return
     
         # Print to stdout
-        print(f"[Server Message] Muted {client_username} for {duration} seconds.", file=sys.stdout, flush=True)
+        self.log.write(f"[Server Message] Muted {client_username} for {duration} seconds.", "admin")
 
         # Notify client and connected clients
+        flush = []
         message = f"[Server Message] You have been muted for {duration} seconds."
-        with counter_lock:
-            socket = channel.client_sockets.get(client_username)
-            socket.sendall(message.encode())
+        with channel.lock:
+            socket = channel.connected_clients.get(client_username)
+            flush.append(self.queue_message(socket, message))
 
-            message = f"[Server Message] {client_username} has been muted for {duration} seconds."
-            for other_client in channel.connected_clients:
+            message = EncodedMessage(f"[Server Message] {client_username} has been muted for {duration} seconds.")
+            for other_client, other_socket in channel.connected_clients.items():
                 if not other_client == client_username:
-                    other_socket = channel.client_sockets.get(other_client)
-                    other_socket.sendall(message.encode())
+                    flush.append(self.queue_message(other_socket, message))
+        self.flush_connections(flush)
 
         # Client handles mute functionality   
 
@@ -282,35 +1850,37 @@ class Server:
         if channel is None:
             return
 
-        # Check connected client in channel
-        with counter_lock:
-            if not client_username in channel.connected_clients:
-                print(f"[Server Message] {client_username} is not in the channel.", file=sys.stdout, flush=True)
-                return
-            
-        # Notify kicked user
+        flush = []
         message = "[Server Message] You are removed from the channel."
-        with counter_lock:
-            socket = channel.client_sockets.get(client_username) # Get kicked client socket
-            socket.sendall(message.encode())
+        with channel.lock:
+            # Check connected client in channel
+            connected = client_username in channel.connected_clients
+            if connected:
+                # Notify kicked user
+                socket = channel.connected_clients.get(client_username) # Get kicked client socket
+                self.queue_message(socket, message)
+
+                # Handle kicking - Remove client
+                self.remove_member(channel, client_username) # remove from connected clients
+                self.publish_occupancy(channel)
+
+                message = EncodedMessage(f"[Server Message] {client_username} has left the channel.")
+                for other_client, other_socket in channel.connected_clients.items(): # Notify connected clients
+                    flush.append(self.queue_message(other_socket, message))
+            
+                for other_client, other_socket in channel.queue.items(): # Notify queue'd clients
+                    flush.append(self.queue_message(other_socket, message))
 
-            # Handle kicking - Remove client from list and from socket dict
-            channel.connected_clients.remove(client_username) # remove from connected clients list
-            channel.client_sockets.pop(client_username) # remove from connected sockets list
-            socket.close() # close socket
+        if not connected:
+            self.log.write(f"[Server Message] {client_username} is not in the channel.", "admin")
+            return
+
+        self.close_client_socket(socket) # close socket once the removed message is sent
 
         # Print to stdout
-        print(f"[Server Message] Kicked {client_username}.", file=sys.stdout, flush=True)
+        self.log.write(f"[Server Message] Kicked {client_username}.", "admin")
 
-        message = f"[Server Message] {client_username} has left the channel."
-        with counter_lock:
-            for other_client in channel.connected_clients: # Notify connected clients
-                other_socket = channel.client_sockets.get(other_client)
-                other_socket.sendall(message.encode())
-        
-            for other_client in channel.queue_clients_usernames: # Notify queue'd clients
-                other_socket = channel.queue_sockets.get(other_client)
-                other_socket.sendall(message.encode())  
+        self.flush_connections(flush)
 
     def empty_command(self, channel_name):
         # Check channel exists
@@ -320,357 +1890,1410 @@ class Server:
         
         message = "[Server Message] You are removed from the channel."
         # Disconnect each client
-        with counter_lock:
+        removed_sockets = []
+        with channel.lock:
             for client_username in list(channel.connected_clients):
                 # Get socket
-                socket = channel.client_sockets[client_username]
-                socket.sendall(message.encode())
-
-                # Remove client from list and from socket dict
-                channel.connected_clients.remove(client_username) # remove from connected clients list
-                socket = channel.client_sockets[client_username] # get socket for each client
-                channel.client_sockets.pop(client_username) # remove from connected sockets list
-                socket.close() # close socket
+                socket = channel.connected_clients[client_username]
+                self.queue_message(socket, message)
+
+                # Remove client
+                self.remove_member(channel, client_username) # remove from connected clients
+                removed_sockets.append(socket)
+            self.publish_occupancy(channel)
+
+        for socket in removed_sockets:
+            self.close_client_socket(socket) # close socket once the removed message is sent
         
-        print(f"[Server Message] \"{channel_name}\" has been emptied.", file=sys.stdout, flush=True)
+        self.log.write(f"[Server Message] \"{channel_name}\" has been emptied.", "admin")
 
         # Promote clients from queue
-        with counter_lock:
-            for i in range(0, channel.capacity):
-                self.promote_from_queue(channel)
+        for i in range(0, channel.capacity):
+            self.promote_from_queue(channel)
+
+    def reload(self):
+        # /reload and SIGHUP. The supervisor keeps the configuration itself and sends each worker its share.
+        if self.workers:
+            self.reload_command()
+        else:
+            self.run_admin(self.reload_command)
+
+    def handle_sighup(self, signum, frame):
+        # Reload on another thread, the main thread may be holding any lock when the signal arrives
+        Thread(target=self.reload, daemon=True).start()
+
+    def reload_command(self):
+        # Re-read the config file, checked like at startup, and apply what changed without a restart: removed
+        # channels are closed, new ones start accepting, and changed ports and capacities are applied in place.
+        # Clients of unchanged channels notice nothing. An invalid file changes nothing.
+        with self.reload_lock:
+            try:
+                entries = self.read_config()
+            except (OSError, ValueError): # unreadable, or not text
+                entries = None
+            if entries is None:
+                self.log.write("[Server Message] Invalid configuration file, nothing is reloaded.", "admin")
+                return
+            if self.workers:
+                self.reload_workers(entries)
+            else:
+                self.apply_config(entries)
+            self.log.write("[Server Message] Configuration reloaded.", "admin")
+
+    def apply_config(self, entries, listeners=None, slots=None):
+        # Make this process's channels those of entries, [(name, port, capacity)] in file order. In a worker
+        # listeners holds what the supervisor bound for new and moved channels and slots their occupancy slots.
+        wanted = {name for name, port, capacity in entries}
+        for channel in self.channels:
+            if channel.name not in wanted:
+                self.close_channel(channel)
+
+        channels = []
+        for name, port, capacity in entries:
+            channel = self.channels_by_name.get(name)
+            listening_socket = None
+            if channel is None or channel.port != port:
+                listening_socket = self.reload_listener(name, port, capacity, listeners)
+            if channel is None:
+                if listening_socket is None:
+                    continue
+                channel = self.open_channel(name, port, capacity, listening_socket, slots and slots.get(name))
+            else:
+                if listening_socket is not None:
+                    self.move_channel(channel, port, listening_socket)
+                if channel.capacity != capacity:
+                    self.resize_channel(channel, capacity)
+            channels.append(channel)
+
+        # new lists rather than changed ones, other threads may be iterating over the old
+        self.channels = channels
+        self.channels_by_name = {channel.name: channel for channel in channels}
+        self.channels_by_port = {channel.port: channel for channel in channels}
+        if self.occupancy is None:
+            self.all_channels = channels
+
+    def apply_worker_config(self, config, listeners):
+        # Worker: the configuration reload_workers sent, [name, port, capacity, slot, worker index] per channel.
+        # Applies this worker's share and keeps the other workers' channels for /list and /switch.
+        own = [(name, port, capacity) for name, port, capacity, slot, index in config if index == self.worker_index]
+        self.apply_config(own, listeners, {name: slot for name, port, capacity, slot, index in config})
+        all_channels = []
+        for name, port, capacity, slot, index in config:
+            channel = self.channels_by_name.get(name)
+            if channel is None:
+                channel = Channel(name, port, capacity, None)
+                channel.slot = slot
+            all_channels.append(channel)
+        self.all_channels = all_channels
+        self.remote_channels = {name: index for name, port, capacity, slot, index in config if index != self.worker_index}
+        for listening_socket in listeners.values(): # none are left unless this worker's channels changed meanwhile
+            listening_socket.close()
+
+    def reload_workers(self, entries):
+        # Supervisor: bind the ports of new and moved channels here, where a failure can still be left out of
+        # the configuration, then send every worker the whole configuration with its own channels' listeners.
+        # A port freed by this reload is still bound by its worker, so it can only be taken by a later one.
+        wanted = {name for name, port, capacity in entries}
+        removed = [channel for channel in self.channels if channel.name not in wanted]
+        for channel in removed:
+            self.channel_workers.pop(channel.name).channels.remove(channel)
+
+        channels = []
+        listeners = {worker: {} for worker in self.workers} # channel name -> listening socket, per worker
+        for name, port, capacity in entries:
+            channel = self.channels_by_name.get(name)
+            listening_socket = None
+            if channel is None or channel.port != port:
+                listening_socket = self.reload_listener(name, port, capacity, None)
+            if channel is None:
+                if listening_socket is None:
+                    continue
+                if not self.free_slots:
+                    self.log.write(f"[Server Message] No room for channel \"{name}\", it is not created.", "admin")
+                    listening_socket.close()
+                    continue
+                channel = Channel(name, port, capacity, None)
+                channel.slot = self.free_slots.pop()
+                worker = min(self.workers, key=lambda worker: len(worker.channels))
+                worker.channels.append(channel)
+                self.channel_workers[name] = worker
+            elif listening_socket is not None:
+                channel.port = port
+            channel.capacity = capacity
+            if listening_socket is not None:
+                listeners[self.channel_workers[name]][name] = listening_socket
+            channels.append(channel)
+
+        self.channels = self.all_channels = channels
+        self.channels_by_name = {channel.name: channel for channel in channels}
+        self.channels_by_port = {channel.port: channel for channel in channels}
+        config = [[channel.name, channel.port, channel.capacity, channel.slot, self.channel_workers[channel.name].index] for channel in channels]
+        for worker, sockets in listeners.items():
+            self.send_to_worker(worker, "apply_config", [config, list(sockets)], [sock.fileno() for sock in sockets.values()])
+            for sock in sockets.values(): # the worker has its own copy
+                sock.close()
+        for channel in removed: # only now, so no new channel shares a slot with one still closing
+            self.free_slots.append(channel.slot)
+
+    def reload_listener(self, name, port, capacity, listeners):
+        # Listener of a channel /reload adds or moves: taken from listeners in a worker, bound here otherwise
+        if listeners is not None:
+            listening_socket = listeners.pop(name, None)
+        else:
+            listening_socket = self.open_listener(port, self.listen_backlog(capacity))
+        if listening_socket is None:
+            self.log.write(f"[Server Message] Unable to listen on port {port} for channel \"{name}\".", "admin")
+        return listening_socket
+
+    def open_channel(self, name, port, capacity, listening_socket, slot=None):
+        # Start serving a channel /reload added
+        channel = Channel(name, port, capacity, listening_socket)
+        channel.slot = slot
+        if self.archive is not None:
+            try:
+                for timestamp, line in self.archive.add_channel(name).last(HISTORY_MESSAGES):
+                    channel.remember(EncodedMessage(line.decode()))
+            except (OSError, struct.error) as error:
+                print(f"Error: unable to archive \"{name}\": {error}", file=sys.stderr, flush=True)
+        with channel.lock:
+            self.publish_occupancy(channel) # the slot may hold the counts of a removed channel
+        self.start_accepting(channel)
+        self.log.write(f"Channel \"{name}\" is created on port {port}, with a capacity of {capacity}.")
+        return channel
+
+    def close_channel(self, channel):
+        # /reload removed channel: stop accepting and remove every member and queued client
+        self.stop_accepting(channel.socket)
+        message = "[Server Message] You are removed from the channel."
+        with channel.lock:
+            removed_sockets = list(channel.connected_clients.values()) + [sock for client_username, sock in channel.queue.items()]
+            for socket in removed_sockets:
+                self.queue_message(socket, message)
+            for client_username in list(channel.connected_clients):
+                self.remove_member(channel, client_username)
+            channel.queue = WaitingQueue()
+            channel.positions_due = None
+            self.publish_occupancy(channel)
+            channel.closed = True
+
+        for socket in removed_sockets:
+            self.close_client_socket(socket) # close socket once the removed message is sent
+
+        self.log.write(f"[Server Message] Channel \"{channel.name}\" has been removed.", "admin")
+
+    def move_channel(self, channel, port, listening_socket):
+        # /reload changed channel's port: accept on the new listener, clients already in the channel stay
+        old_socket = channel.socket
+        channel.socket = listening_socket
+        channel.port = port
+        self.stop_accepting(old_socket)
+        self.start_accepting(channel)
+        self.log.write(f"[Server Message] Channel \"{channel.name}\" has moved to port {port}.", "admin")
+
+    def resize_channel(self, channel, capacity):
+        # /reload changed channel's capacity. Members past a smaller one (the last to join) go back to the front
+        # of the queue in joining order, places a larger one frees are filled from the queue.
+        flush = []
+        with channel.lock:
+            channel.capacity = capacity
+            demoted = list(channel.connected_clients)[capacity:]
+            for client_username in reversed(demoted):
+                channel.queue.push_front(client_username, self.remove_member(channel, client_username))
+            now = time.monotonic()
+            for users_ahead, client_username in enumerate(demoted):
+                socket = channel.queue.get(client_username)
+                conn = self.connections.get(socket)
+                if conn is not None:
+                    conn.queue_position = users_ahead
+                    conn.queued_at = now
+                message = f"[Server Message] You are in the waiting queue and there are {users_ahead} user(s) ahead of you."
+                flush.append(self.queue_message(socket, message))
+            if demoted: # the rest of the queue moved back
+                self.queue_changed(channel)
+            self.set_broadcast_ring(channel)
+            self.publish_occupancy(channel)
+        self.flush_connections(flush)
+
+        self.log.write(f"[Server Message] Channel \"{channel.name}\" now has a capacity of {capacity}.", "admin")
+
+        for i in range(0, capacity):
+            self.promote_from_queue(channel)
+
+    def start_accepting(self, channel):
+        # Accept channel's clients on channel.socket: a thread of its own, or the event loop's selector
+        if SERVER_MODE == "eventloop":
+            channel.socket.setblocking(False)
+            self.selector.register(channel.socket, selectors.EVENT_READ, channel)
+        else:
+            Thread(target=self.handle_channel, args=(channel, )).start()
+
+    def stop_accepting(self, listening_socket):
+        # Close a channel listener /reload removed or moved, ending its accept thread
+        if SERVER_MODE == "eventloop":
+            self.selector.unregister(listening_socket)
+        else:
+            try:
+                listening_socket.shutdown(SHUT_RDWR) # wakes the thread blocked in accept
+            except OSError:
+                pass
+        listening_socket.close()
 
     # Create a new thread for each client
     def handle_channel(self, channel):
+        listening_socket = channel.socket # /reload may move the channel to another listener
         while True: 
-            client_socket, client_address = channel.socket.accept()
+            try:
+                client_socket, client_address = listening_socket.accept()
+            except OSError: # closed by stop_accepting
+                return
             client_thread = Thread(target=self.handle_client, args=(channel, client_socket, None, False)) # removed client_address command
             client_thread.start() 
 
-    def handle_client(self, channel, client_socket, switch_client_username, switch): # removed client_address arg
-        client_username = None
+    def handle_client(self, channel, client_socket, switch_client_username, switch, hello=None): # removed client_address arg
+        # channel is None for clients of the shared port, hello the handshake if it was already read
+        conn = Connection(client_socket, channel)
+        self.connections[client_socket] = conn
+
         if switch:
-            client_username = switch_client_username
-            switch = False
-        else: 
-            client_username = client_socket.recv(BUFSIZE).decode().strip() # get client username, sent automatically by client after connection
+            if not self.admit_client(conn, channel, switch_client_username):
+                return
+        else:
+            if hello is None:
+                hello = client_socket.recv(BUFSIZE) # get client username, sent automatically by client after connection
+            if not self.admit_hello(conn, hello):
+                return
 
-        # check username not already in channel
-        with counter_lock:
-            if client_username in channel.connected_clients or channel.queue_sockets.get(client_username) is not None: # client_username in channel.queue: # duplicate username in connected list or queue
-                duplicate_username_message = f"[Server Message] Channel \"{channel.name}\" already has user {client_username}."
-                client_socket.sendall(duplicate_username_message.encode())  
-                client_socket.close()
+        self.handle_communication(conn)
+        return
+
+    def handshake(self, conn, data):
+        # Read the username and agree on the framed protocol if the client offered it. Returns the username
+        # and the channel to join: the one whose port the client connected to, or on the shared port the
+        # one it named (None, with the client told and disconnected, if there is no such channel).
+        try:
+            client_username, version, channel_name, codecs = parse_hello(data)
+        except UnicodeDecodeError: # not a username, a protocol error
+            self.close_client_socket(conn.sock)
+            return None, None
+        if version is not None:
+            conn.start_framing(version)
+            codec = next((codec for codec in codecs if codec in COMPRESSION_CODECS and codec in COMPRESSION.split(",")), None)
+            self.queue_output(conn.sock, encode_hello_reply(version, codec))
+            if codec is not None: # the client compresses once it has the reply
+                conn.start_compression(codec, keep_window=self.supervisor is not None)
+
+        channel = conn.channel
+        if channel is None:
+            channel = self.channels_by_name.get(channel_name)
+            if channel is None:
+                if channel_name is None:
+                    message = "[Server Message] Name a channel to join on this port."
+                else:
+                    message = f"[Server Message] Channel \"{channel_name}\" does not exist."
+                self.send_message(conn.sock, message)
+                self.close_client_socket(conn.sock)
+        return client_username, channel
+
+    def admit_hello(self, conn, data):
+        # Handshake, then connect or queue the client in its channel. False if rejected
+        client_username, channel = self.handshake(conn, data)
+        if channel is None:
+            return False
+        return self.admit_client(conn, channel, client_username)
+
+    def send_message(self, sock, message, frame_type=TEXT):
+        # Send a server/chat message to a client in whichever protocol it speaks
+        conn = self.queue_message(sock, message, frame_type)
+        if conn is not None:
+            self.flush_output(conn)
+
+    def queue_message(self, sock, message, frame_type=TEXT):
+        # Queue a message without writing to the socket, for use inside a channel lock.
+        # Returns the connection to pass to flush_connections once the lock is released.
+        # Broadcasts pass an EncodedMessage so the message is encoded once for all recipients.
+        conn = self.connections.get(sock)
+        if conn is None: # already disconnected
+            return None
+        if isinstance(message, EncodedMessage):
+            data = message.encoded_for(conn)
+        elif conn.protocol_version is not None:
+            data = encode_frame(frame_type, message)
+        else:
+            data = message.encode()
+        if not conn.queue_output(data):
+            self.drop_slow_client(conn)
+            return None
+        return conn
+
+    def flush_connections(self, conns):
+        pending = getattr(self.deferred_flushes, "conns", None)
+        if pending is not None: # inside batched_flush, write once the whole recv is handled
+            for conn in conns:
+                if conn is None:
+                    continue
+                if len(conn.outbound) >= min(SENDMSG_BUFFERS, OUTBOUND_QUEUE_LIMIT - 1): # before the slow client policy sees a full queue
+                    self.flush_output(conn)
+                else:
+                    pending[conn] = None
+            return
+        for conn in conns:
+            if conn is not None:
+                self.flush_output(conn)
+
+    @contextmanager
+    def batched_flush(self):
+        # Hold back the flushes of every message parsed from one recv, so a burst of chat lines
+        # reaches each recipient in one write (sendmsg for framed clients) instead of one per line
+        self.deferred_flushes.conns = {}
+        try:
+            yield
+        finally:
+            self.flush_deferred()
+            self.deferred_flushes.conns = None
+
+    def flush_deferred(self):
+        # Write what batched_flush is holding back, e.g. before blocking on a relay window
+        pending = getattr(self.deferred_flushes, "conns", None)
+        if pending:
+            self.deferred_flushes.conns = {}
+            for conn in pending:
+                self.flush_output(conn)
+
+    def queue_file_data(self, sock, transfer_id, file_data, crc=None):
+        # Queue file bytes (never dropped by the slow client policy), the caller flushes.
+        # file_data may be a view of a reused receive buffer, so what is queued is always a copy.
+        # crc is the sender's checksum of file_data, one chunk; without it the chunks are checksummed here.
+        conn = self.connections.get(sock)
+        if conn is None:
+            return
+        if conn.has_transfer_ids():
+            if crc is not None:
+                conn.queue_output(encode_frame(FILE_DATA, FILE_DATA_HEADER.pack(transfer_id, crc) + file_data), True)
                 return
-            else:      
-                connected_message = f"Welcome to chatclient, {client_username}."
-                client_socket.sendall(connected_message.encode())
-
-                # Check capacity and queue/connect client
-                if len(channel.connected_clients) == channel.capacity: # Maximum capacity, queue client
-                    channel.queue.put(client_username)
-                    channel.queue_sockets[client_username] = client_socket
-                    users_ahead = channel.queue.qsize() - 1
-                    channel.queue_clients += 1 # increment number of clients in Queue
-                    channel.queue_clients_usernames.append(client_username)
-
-                    # Notify client
-                    message = f"[Server Message] You are in the waiting queue and there are {users_ahead} user(s) ahead of you."
-                    client_socket.sendall(message.encode())
+            for offset in range(0, len(file_data), FILE_CHUNK_SIZE):
+                chunk = file_data[offset:offset + FILE_CHUNK_SIZE]
+                conn.queue_output(encode_frame(FILE_DATA, FILE_DATA_HEADER.pack(transfer_id, zlib.crc32(chunk)) + chunk), True)
+        elif conn.protocol_version is not None:
+            for offset in range(0, len(file_data), FILE_CHUNK_SIZE):
+                conn.queue_output(encode_frame(FILE_DATA, file_data[offset:offset + FILE_CHUNK_SIZE]), True)
+        else:
+            conn.queue_output(bytes(file_data), True)
+
+    def queue_output(self, sock, data, force=False):
+        # Queue data on the client's outbound queue and send what can be sent right away
+        conn = self.connections.get(sock)
+        if conn is None: # already disconnected
+            return
+        if not conn.queue_output(data, force):
+            self.drop_slow_client(conn)
+            return
+        self.flush_output(conn)
+
+    @profiled
+    def flush_output(self, conn):
+        if conn.flush_output():
+            return
+        with conn.lock: # hand the rest to the writer
+            if conn.write_watched:
+                return
+            conn.write_watched = True
+        if SERVER_MODE == "eventloop":
+            self.update_events(conn)
+        else:
+            self.writer.watch(conn)
+
+    def update_events(self, conn):
+        # Event loop mode: register conn for reading unless it is closing, paused or reserving, and for writing while it has a backlog
+        events = 0
+        if self.connections.get(conn.sock) is conn and not conn.paused and conn.reserving is None:
+            events |= selectors.EVENT_READ
+        if conn.write_watched:
+            events |= selectors.EVENT_WRITE
+
+        registered = self.selector.get_map().get(conn.sock) is not None
+        if not events:
+            if registered:
+                self.selector.unregister(conn.sock)
+        elif registered:
+            self.selector.modify(conn.sock, events, conn)
+        else:
+            self.selector.register(conn.sock, events, conn)
+
+    def write_connection(self, conn):
+        # Event loop mode: socket became writable
+        expired = conn.close_deadline is not None and conn.close_deadline <= time.monotonic()
+        flushed = conn.flush_output()
+        self.relay_drained(conn)
+        if not flushed and not expired:
+            return
+        conn.write_watched = False
+        if conn.close_deadline is not None:
+            self.selector.unregister(conn.sock)
+            conn.sock.close()
+        else:
+            self.update_events(conn)
+
+    def drop_slow_client(self, conn):
+        # Disconnect policy: shut the socket so the client's reader sees the disconnect and cleans up
+        with conn.lock:
+            conn.outbound.clear()
+            conn.outbound_bytes = 0
+            conn.ring = None
+        try:
+            conn.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
 
-                else: # Connect client
-                    channel.connected_clients.append(client_username)
-                    channel.client_sockets[client_username] = client_socket
+    def stats_command(self):
+        # Admin command: a summary of the metrics, one line per channel and one for the server
+        def milliseconds(seconds):
+            return "-" if seconds is None else f"{seconds * 1000:g}ms"
 
-                    # Notify client and server stdout
-                    self.notify_connected_client(client_username, channel.name, client_socket)
+        def seconds(value):
+            return "-" if value is None else f"{value:g}s"
 
-                sys.stdout.flush()
+        def ratio(raw, wire):
+            return "-" if not wire else f"{raw / wire:.2f}x"
 
-        self.handle_communication(channel, client_username)
-        return
+        for channel in self.channels:
+            with channel.lock:
+                stats = channel.stats
+                line = (f"[Stats] {channel.name} Clients: {len(channel.connected_clients)}/{channel.capacity}, Queue: {len(channel.queue)}, "
+                        f"In: {stats.messages_in} ({stats.bytes_in} B), Out: {stats.messages_out} ({stats.bytes_out} B), "
+                        f"Broadcast p50/p99: {milliseconds(stats.broadcast_seconds.quantile(0.5))}/{milliseconds(stats.broadcast_seconds.quantile(0.99))}, "
+                        f"Queue wait p50/p99: {seconds(stats.queue_wait_seconds.quantile(0.5))}/{seconds(stats.queue_wait_seconds.quantile(0.99))}, "
+                        f"AFK: {stats.afk_evictions}")
+            self.log.write(line, "admin")
+
+        transfers = self.transfer_stats
+        with transfers.lock:
+            line = (f"[Stats] server Connections: {len(self.connections)}, Threads: {active_count()}, "
+                    f"Transfers: {transfers.sent} sent, {transfers.failed} failed, {transfers.bytes} B, "
+                    f"Transfer p50/p99: {seconds(transfers.seconds.quantile(0.5))}/{seconds(transfers.seconds.quantile(0.99))}")
+        raw_out, wire_out, raw_in, wire_in = self.compression_totals()
+        line += f", Compression out/in: {ratio(raw_out, wire_out)}/{ratio(raw_in, wire_in)}"
+        self.log.write(line, "admin")
+
+    def compression_totals(self):
+        # [uncompressed out, compressed out, inflated in, compressed in] bytes of every connection so far
+        stats = self.compression_stats
+        with stats.lock:
+            totals = [stats.raw_out, stats.wire_out, stats.raw_in, stats.wire_in]
+        for conn in list(self.connections.values()):
+            if conn.compressor is not None:
+                totals[0] += conn.compressor.raw_bytes
+                totals[1] += conn.compressor.wire_bytes
+                totals[2] += conn.decoder.raw_bytes
+                totals[3] += conn.decoder.wire_bytes
+        return totals
+
+    def profile_command(self, action):
+        # Admin command: turn profiling on or off, forget what it recorded, or without an action report it
+        if action == "on":
+            started = profiler.start()
+            self.log.write(f"[Profile] {'Started' if started else 'Already running'}, stack samples go to {profiler.stacks_file}.", "admin")
+            return
+        if action == "off":
+            stopped = profiler.stop()
+            self.log.write(f"[Profile] {'Stopped' if stopped else 'Not running'}.", "admin")
+            return
+        if action == "reset":
+            for channel in self.channels:
+                with channel.lock:
+                    channel.lock.wait_seconds = Histogram(LATENCY_BUCKETS)
+                    channel.lock.hold_seconds = Histogram(LATENCY_BUCKETS)
+            profiler.reset()
+            self.log.write("[Profile] Reset.", "admin")
+            return
+
+        def summary(histogram):
+            if not histogram.count:
+                return "-"
+            return (f"{histogram.count} x, p50/p99: {histogram.quantile(0.5) * 1000:g}ms/{histogram.quantile(0.99) * 1000:g}ms, "
+                    f"total: {histogram.sum * 1000:.3f}ms")
+
+        self.log.write(f"[Profile] {'Running' if profiler.enabled else 'Stopped'}", "admin")
+        for channel in self.channels:
+            with channel.lock:
+                line = f"[Profile] lock {channel.name} Wait: {summary(channel.lock.wait_seconds)}; Hold: {summary(channel.lock.hold_seconds)}"
+            self.log.write(line, "admin")
+        with profiler.lock:
+            lines = [f"[Profile] handler {name} {summary(histogram)}" for name, histogram in sorted(profiler.handlers.items())]
+        for line in lines:
+            self.log.write(line, "admin")
+        profiler.write_stacks()
+
+    def render_metrics(self):
+        # Every metric in the Prometheus text exposition format
+        lines = []
+        channel_metrics = (
+            ("chatserver_messages_in_total", "counter", "Chat lines and whispers received from members", lambda channel: channel.stats.messages_in),
+            ("chatserver_messages_out_total", "counter", "Chat lines and whispers queued to members", lambda channel: channel.stats.messages_out),
+            ("chatserver_bytes_in_total", "counter", "Bytes of chat lines and whispers received", lambda channel: channel.stats.bytes_in),
+            ("chatserver_bytes_out_total", "counter", "Bytes of chat lines and whispers queued", lambda channel: channel.stats.bytes_out),
+            ("chatserver_afk_evictions_total", "counter", "Clients disconnected for being AFK", lambda channel: channel.stats.afk_evictions),
+            ("chatserver_connected_clients", "gauge", "Clients connected to the channel", lambda channel: len(channel.connected_clients)),
+            ("chatserver_queue_depth", "gauge", "Clients waiting in the channel's queue", lambda channel: len(channel.queue)),
+        )
+        snapshots = []
+        for channel in self.channels:
+            with channel.lock:
+                values = [value(channel) for name, kind, help_text, value in channel_metrics]
+                histograms = (channel.stats.broadcast_seconds.exposition("chatserver_broadcast_seconds", f'channel="{channel.name}"'),
+                              channel.stats.queue_wait_seconds.exposition("chatserver_queue_wait_seconds", f'channel="{channel.name}"'),
+                              channel.lock.wait_seconds.exposition("chatserver_lock_wait_seconds", f'channel="{channel.name}"'),
+                              channel.lock.hold_seconds.exposition("chatserver_lock_hold_seconds", f'channel="{channel.name}"'))
+            snapshots.append((channel.name, values, histograms))
+
+        for i, (name, kind, help_text, value) in enumerate(channel_metrics):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            lines += [f'{name}{{channel="{channel_name}"}} {values[i]}' for channel_name, values, histograms in snapshots]
+        for i, (name, help_text) in enumerate((("chatserver_broadcast_seconds", "Time to queue a chat line for every member"),
+                                               ("chatserver_queue_wait_seconds", "Time from joining a channel's queue to being promoted"),
+                                               ("chatserver_lock_wait_seconds", "Time spent waiting for the channel lock while profiling"),
+                                               ("chatserver_lock_hold_seconds", "Time the channel lock was held while profiling"))):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for channel_name, values, histograms in snapshots:
+                lines += histograms[i]
+
+        with profiler.lock:
+            lines += ["# HELP chatserver_handler_seconds Time spent in message handlers while profiling", "# TYPE chatserver_handler_seconds histogram"]
+            for handler, histogram in sorted(profiler.handlers.items()):
+                lines += histogram.exposition("chatserver_handler_seconds", f'handler="{handler}"')
+
+        transfers = self.transfer_stats
+        with transfers.lock:
+            lines += ["# HELP chatserver_transfers_total File transfers by result", "# TYPE chatserver_transfers_total counter",
+                      f'chatserver_transfers_total{{result="sent"}} {transfers.sent}', f'chatserver_transfers_total{{result="failed"}} {transfers.failed}',
+                      "# HELP chatserver_transfer_bytes_total File bytes relayed", "# TYPE chatserver_transfer_bytes_total counter",
+                      f"chatserver_transfer_bytes_total {transfers.bytes}",
+                      "# HELP chatserver_transfer_seconds Duration of successful file transfers", "# TYPE chatserver_transfer_seconds histogram"]
+            lines += transfers.seconds.exposition("chatserver_transfer_seconds")
+
+        raw_out, wire_out, raw_in, wire_in = self.compression_totals()
+        lines += ["# HELP chatserver_compression_bytes_total Bytes of compressed frames before and after compression", "# TYPE chatserver_compression_bytes_total counter",
+                  f'chatserver_compression_bytes_total{{direction="out",stage="uncompressed"}} {raw_out}', f'chatserver_compression_bytes_total{{direction="out",stage="compressed"}} {wire_out}',
+                  f'chatserver_compression_bytes_total{{direction="in",stage="uncompressed"}} {raw_in}', f'chatserver_compression_bytes_total{{direction="in",stage="compressed"}} {wire_in}',
+                  "# HELP chatserver_compression_ratio Uncompressed bytes per compressed byte, 0 before any", "# TYPE chatserver_compression_ratio gauge",
+                  f'chatserver_compression_ratio{{direction="out"}} {raw_out / wire_out if wire_out else 0:g}',
+                  f'chatserver_compression_ratio{{direction="in"}} {raw_in / wire_in if wire_in else 0:g}']
+
+        connections = list(self.connections.values())
+        lines += ["# HELP chatserver_connections Open client connections", "# TYPE chatserver_connections gauge", f"chatserver_connections {len(connections)}",
+                  "# HELP chatserver_threads Live server threads", "# TYPE chatserver_threads gauge", f"chatserver_threads {active_count()}",
+                  "# HELP chatserver_outbound_dropped_total Messages dropped for slow clients still connected", "# TYPE chatserver_outbound_dropped_total counter",
+                  f"chatserver_outbound_dropped_total {sum(conn.dropped_messages() for conn in connections)}",
+                  "# HELP chatserver_outbound_bytes Bytes waiting in outbound queues", "# TYPE chatserver_outbound_bytes gauge",
+                  f"chatserver_outbound_bytes {sum(conn.outbound_bytes for conn in connections)}"]
+        return "\n".join(lines) + "\n"
+
+    def start_metrics_server(self, port):
+        # Serve render_metrics on http://127.0.0.1:<port>/metrics from its own threads
+        try:
+            httpd = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+        except OSError:
+            print(f"Error: unable to listen on port {port}.", file=sys.stderr, flush=True)
+            exit(EXIT_CODES.PORT_ERROR.value)
+        httpd.daemon_threads = True
+        httpd.chat_server = self
+        Thread(target=httpd.serve_forever, daemon=True).start()
 
-    def handle_communication(self, channel, client_username):
+    def outbound_command(self):
+        # Admin command: outbound queue counters for every client
+        for channel in self.channels:
+            with channel.lock:
+                usernames = list(channel.connected_clients) + list(channel.queue)
+                sockets = [channel.connected_clients.get(name) or channel.queue.get(name) for name in usernames]
+            for client_username, sock in zip(usernames, sockets):
+                conn = self.connections.get(sock)
+                if conn is None:
+                    continue
+                self.log.write(f"[Outbound] {channel.name} {client_username} Depth: {len(conn.outbound) + conn.pending_broadcasts()}, Max: {conn.outbound_max_depth}, Bytes: {conn.outbound_bytes}, Dropped: {conn.dropped_messages()}, Coalesced: {conn.outbound_coalesced}", "admin")
+
+    def admit_client(self, conn, channel, client_username):
+        # Connect or queue a client that has sent its username, False if rejected
+        conn.username = client_username
+        flush = []
+        with channel.lock:
+            admitted = self.attach_client(conn, channel, flush)
+
+        if not admitted:
+            self.close_client_socket(conn.sock)
+            return False
+
+        self.flush_connections(flush)
+        if client_username in channel.connected_clients:
+            self.record_activity(conn)
+        return True
+
+    def add_member(self, channel, client_username, sock):
+        # Connect a client in channel, call with channel.lock held. Members of a large channel read its ring.
+        channel.connected_clients[client_username] = sock
+        conn = self.connections.get(sock)
+        if channel.ring is not None and conn is not None:
+            conn.subscribe(channel.ring)
+
+    def remove_member(self, channel, client_username):
+        # Disconnect a client from channel's members, call with channel.lock held. Returns its socket.
+        sock = channel.connected_clients.pop(client_username)
+        conn = self.connections.get(sock)
+        if conn is not None:
+            conn.unsubscribe()
+        return sock
+
+    def set_broadcast_ring(self, channel):
+        # Give channel a BroadcastRing if its capacity makes it large, or take it away, e.g. after /reload.
+        # Call with channel.lock held.
+        large = channel.capacity >= LARGE_CHANNEL_CAPACITY
+        if large == (channel.ring is not None):
+            return
+        conns = [self.connections.get(sock) for sock in channel.connected_clients.values()]
+        for conn in conns:
+            if conn is not None:
+                conn.unsubscribe()
+        channel.ring = BroadcastRing(BROADCAST_RING_SIZE) if large else None
+        for conn in conns:
+            if conn is not None and large:
+                conn.subscribe(channel.ring)
+
+    def broadcast(self, channel, message, flush):
+        # Queue an EncodedMessage to every member of channel, call with channel.lock held. Adds their connections
+        # to flush and returns how many members there are. A large channel only stores it in its ring, the
+        # members' flushes pick it up.
+        if channel.ring is None:
+            for sock in channel.connected_clients.values():
+                flush.append(self.queue_message(sock, message))
+        else:
+            channel.ring.publish(message)
+            flush.extend(self.connections.get(sock) for sock in channel.connected_clients.values())
+        return len(channel.connected_clients)
+
+    def attach_client(self, conn, channel, flush):
+        # Connect or queue conn.username in channel, call with channel.lock held. False if the username is taken.
+        conn.channel = channel
+        client_username = conn.username
+        client_socket = conn.sock
+        flush.append(conn)
+
+        if channel.closed: # removed by /reload while the client was connecting
+            self.queue_message(client_socket, f"[Server Message] Channel \"{channel.name}\" does not exist.")
+            return False
+
+        # check username not already in channel
+        if channel.has_user(client_username): # duplicate username in connected list, queue or reserved
+            duplicate_username_message = f"[Server Message] Channel \"{channel.name}\" already has user {client_username}."
+            self.queue_message(client_socket, duplicate_username_message)
+            return False
+
+        connected_message = f"Welcome to chatclient, {client_username}."
+        self.queue_message(client_socket, connected_message)
+
+        # Check capacity and queue/connect client
+        if len(channel.connected_clients) == channel.capacity: # Maximum capacity, queue client
+            channel.queue.put(client_username, client_socket)
+            users_ahead = len(channel.queue) - 1
+
+            # Notify client
+            conn.queue_position = users_ahead
+            conn.queued_at = time.monotonic()
+            message = f"[Server Message] You are in the waiting queue and there are {users_ahead} user(s) ahead of you."
+            self.queue_message(client_socket, message)
+
+        else: # Connect client
+            self.add_member(channel, client_username, client_socket)
+
+            # Notify client and server stdout
+            self.notify_connected_client(client_username, channel, client_socket)
+
+        self.publish_occupancy(channel)
+        return True
+
+    def switch_client(self, conn, channel, new_channel):
+        # Move a client to another channel. Both channels stay locked for the whole move so the
+        # duplicate username check cannot go stale between leaving one channel and joining the other.
+        client_username = conn.username
+        flush = []
+        with lock_channels(channel, new_channel):
+            duplicate = new_channel.closed or new_channel.has_user(client_username)
+            if new_channel.closed: # removed by /reload since switch_command looked it up
+                message = f"[Server Message] Channel \"{new_channel.name}\" does not exist."
+                flush.append(self.queue_message(conn.sock, message))
+            elif duplicate:
+                message = f"[Server Message] Channel \"{new_channel.name}\" already has user {client_username}."
+                flush.append(self.queue_message(conn.sock, message))
+            else:
+                self.detach_client(channel, client_username, True, flush)
+                self.attach_client(conn, new_channel, flush)
+        self.flush_connections(flush)
+
+        if not duplicate:
+            self.promote_from_queue(channel)
+            if client_username in new_channel.connected_clients:
+                self.record_activity(conn)
+
+    def handle_communication(self, conn):
         # Continuously listen and send data to other clients in channel
+        buffer = bytearray(RELAY_BUFSIZE)
+        messages = conn.buffered_messages()
+        while True:
+            if not self.handle_messages(conn, messages):
+                return
+            messages = conn.split_messages(conn.receive(buffer))
+
+    def handle_messages(self, conn, messages):
+        # Handle the messages of one recv. False once the connection is no longer read here: the client
+        # has gone, or /switch is handing it to another worker together with the messages after the /switch.
+        with self.batched_flush():
+            for i, (frame_type, message) in enumerate(messages):
+                if not self.handle_message(conn, frame_type, message):
+                    break
+            else:
+                return True
+        if conn.handoff is not None:
+            self.hand_off_client(conn, messages[i + 1:])
+        elif conn.reserving is not None: # still read here, see remote_reserved
+            conn.held_messages = messages[i + 1:]
+            return True
+        return False
+
+    @profiled
+    def handle_message(self, conn, frame_type, data):
+        # Handle one message (or upload chunk) from a client, shared by thread and event loop modes.
+        # Returns False once the client has gone and its connection should no longer be read.
         global quit
         global quit_from_queue
-        global failed_transfer
-        target_client = None
-        file_path = None
-        
-        # Get client socket
-        sock = None
-        with counter_lock:
-            if client_username in channel.connected_clients: # connected
-                sock = channel.client_sockets[client_username]
-            else: # queued
-                sock = channel.queue_sockets[client_username]
-
-        data = None
-
-        while True: # Queue Client 
-            with counter_lock:
-                if channel.queue_sockets.get(client_username) is None: # left queue TODO: redundant because how would it be removed
-                    break
+        channel = conn.channel
+        client_username = conn.username
+        sock = conn.sock
+
+        if frame_type == FILE_DATA: # client file sending
+            crc = None
+            if conn.has_transfer_ids():
+                if len(data) < FILE_DATA_HEADER.size:
+                    return True
+                transfer_id, crc = FILE_DATA_HEADER.unpack_from(data)
+                relay = conn.uploads.get(transfer_id)
+                data = memoryview(data)[FILE_DATA_HEADER.size:]
+            else:
+                relay = conn.active_upload()
+            if relay is not None and relay.file_size is not None:
+                self.handle_file_transfer(relay, data, crc)
+            return True
+
+        try:
+            data_decoded = data.decode()
+        except UnicodeDecodeError: # not utf-8, a protocol error like a bad frame: disconnect the client
+            data = b""
 
-            data = sock.recv(BUFSIZE)
+        with channel.lock:
+            queued = client_username in channel.queue
+            connected = client_username in channel.connected_clients
 
+        if queued: # Queue Client 
             if not data: # client disconnected
                 self.disconnect(channel, client_username, False) 
                 self.promote_from_queue(channel)
-                channel.queue_clients -= 1 # decrement number of clients in Queue
-                return
-            else:
-                # data_decoded = data.decode() # .strip()
-                data_decoded = data.decode().strip()
-                commands = data_decoded.split(" ")
-                if data_decoded == "/quit" or data_decoded == "/quit\n":
-                    quit_from_queue = True
-                    self.disconnect(channel, client_username)
-                    self.promote_from_queue(channel)
-                    return
-                elif data_decoded == "/list" or data_decoded == "/list\n":
-                    self.list_command(sock)
-                elif commands[0] == "/switch":
-                    self.switch_command(sock, channel, commands, client_username, True)
-            
-        # Check if somehow disconnected while being moved from queue - connected 
-        with counter_lock:
-            if client_username not in channel.connected_clients: 
+                return False
+            if frame_type != TEXT:
+                return True
+
+            data_decoded = data_decoded.strip()
+            commands = data_decoded.split(" ")
+            if data_decoded == "/quit" or data_decoded == "/quit\n":
+                quit_from_queue = True
                 self.disconnect(channel, client_username, False)
                 self.promote_from_queue(channel)
-                return  
-            
-        # if anything sent since promoted to queue: print it out, TODO: problem is that if this is a command itll just print it
-        if data is not None:
-            self.print_message(data, client_username, channel)
+                return False
+            elif data_decoded == "/list" or data_decoded == "/list\n":
+                self.list_command(sock)
+            elif data_decoded == "/position":
+                self.position_command(conn, channel)
+            elif commands[0] == "/switch":
+                if self.switch_command(sock, channel, commands, client_username, True):
+                    if commands[1] not in self.channels_by_name: # another worker's, the username is reserved there
+                        conn.handoff = commands[1]
+                        return False
+                    self.switch_client(conn, channel, self.get_channel(commands[1]))
+                elif conn.reserving is not None: # the rest waits for the answer
+                    return False
+            return True
+
+        if not connected or not data: # disconnected, kicked or emptied
+            # handle disconnection, update queue, etc.
+            self.disconnect(channel, client_username, False)
+            self.promote_from_queue(channel)
+            return False
 
-        while True: # Connected Client
-            # Start timer for afk
-            timer = Timer(self.afk_time, self.timeout, args=(channel, client_username))
-            timer.start()
+        self.record_activity(conn)
 
-            if client_username in channel.disconnected_clients: # client to be disconnected due to AFK
-                self.disconnect(channel, client_username, False)
-                self.promote_from_queue(channel)
-                return
+        commands = data_decoded.split(" ")
 
-            data = sock.recv(BUFSIZE)
-            timer.cancel() # Cancel AFK timer since data received
+        if frame_type == CONTROL:
+            self.handle_control_message(conn, data_decoded)
+        elif data_decoded == "/quit" or data_decoded == "/quit\n":
+            quit = True
+            self.disconnect(channel, client_username, False)
+            self.promote_from_queue(channel)
+            return False
+        elif data_decoded == "/list" or data_decoded == "/list\n":
+            self.list_command(sock)
+        elif commands[0] == "/whisper":
+            self.whisper_command(sock, channel, commands, client_username)
+        elif commands[0] == "/switch":
+            if self.switch_command(sock, channel, commands, client_username, False):
+                if commands[1] not in self.channels_by_name: # another worker's, the username is reserved there
+                    conn.handoff = commands[1]
+                    return False
+                self.switch_client(conn, channel, self.get_channel(commands[1]))
+            elif conn.reserving is not None: # the rest waits for the answer
+                return False
+        elif commands[0] == "/send":
+            self.send_command(sock, channel, commands, client_username)
+        elif commands[0] == "/history":
+            self.history_command(conn, channel, commands)
+        elif commands[0] == "/search":
+            self.search_command(conn, channel, data_decoded)
+        else: 
+            self.print_message(data, client_username, channel)
 
-            if not data:
-                break
+        # Client timed out while this message was being received
+        if client_username in channel.disconnected_clients:
+            self.disconnect(channel, client_username, False)
+            self.promote_from_queue(channel)
+            return False
 
-            data_decoded = data.decode() # .strip()
-            commands = data_decoded.split(" ")
+        return True
 
-            if data_decoded == "/quit" or data_decoded == "/quit\n":
-                quit = True
-                self.disconnect(channel, client_username, False)
-                self.promote_from_queue(channel)
+    def handle_control_message(self, conn, data_decoded):
+        # File transfer messages, clients with transfer IDs name the transfer as the last word
+        transfer_id = None
+        if conn.has_transfer_ids():
+            data_decoded, transfer_id = split_transfer_id(data_decoded)
+            if transfer_id is None:
                 return
-            elif data_decoded == "/list" or data_decoded == "/list\n":
-                self.list_command(sock)
-            elif commands[0] == "/whisper":
-                self.whisper_command(sock, channel, commands, client_username)
-            elif commands[0] == "/switch":
-                if not self.switch_command(sock, channel, commands, client_username, False):
-                    # didn't work
-                    continue
-                else:
-                    new_channel = commands[1]
-                    for channels in self.channels:
-                        if channels.name == new_channel:
-                            new_channel = channels
-                            break
-                        
-                    self.disconnect(channel, client_username, True)
-                    self.handle_client(new_channel, sock, client_username, True)
+
+        commands = data_decoded.split(" ")
+        if commands[0] == "[FileSize]": # client file sending handled in send function
+            relay = conn.uploads.get(transfer_id) if transfer_id is not None else self.pending_upload(conn)
+            if relay is None or relay.file_size is not None or not commands[1:] or not commands[1].isdecimal():
+                return
+            if transfer_id is not None: # "[FileSize] <size> <sha256>"
+                if len(commands) != 3 or not re.match(r"^[0-9a-f]{64}$", commands[2]):
                     return
-            elif commands[0] == "/send":
-                target_client = commands[1] # store the target client username
-                file_path = commands[2].strip()
-                self.send_command(sock, channel, commands, client_username)
-                continue
-            elif data_decoded == "[Client Message] Received" or data_decoded == "[Client Message] Ready":
-                continue  
-            elif data_decoded == "[Client Message] File Transfer Failed":
-                failed_transfer_event.set()
-                failed_transfer = True
-                continue
-            elif commands[0] == "[FileSize]": # client file sending handled in send function
-                self.handle_file_transfer(channel, commands, target_client, file_path, sock, client_username)
-            
-            else: 
-                self.print_message(data, client_username, channel)
+                relay.digest = commands[2]
+            self.start_upload(relay, int(commands[1]))
+            return
 
-        # handle disconnection, update queue, etc.
-        self.disconnect(channel, client_username, False)
-        self.promote_from_queue(channel)
-        return
-    
+        if transfer_id is not None:
+            relay = conn.downloads.get(transfer_id)
+        else: # clients without transfer IDs receive one file at a time
+            relay = next(iter(conn.downloads.values()), None)
+        if relay is None:
+            return
+        if commands[:3] == ["[Client", "Message]", "Ready"]: # "[Client Message] Ready [offset]"
+            offset = int(commands[3]) if len(commands) == 4 and commands[3].isdecimal() else 0
+            self.relay_ready(relay, offset)
+        elif data_decoded == "[Client Message] File Transfer Failed":
+            relay.failed = True
+        elif data_decoded == "[Client Message] Received":
+            self.finish_relay(relay, not relay.failed and relay.received == relay.file_size)
+
+    def pending_upload(self, conn):
+        # Clients without transfer IDs: the "/send" the next "[FileSize]" belongs to
+        for relay in list(conn.uploads.values()):
+            if relay.file_size is None:
+                return relay
+        return None
+
+    def start_upload(self, relay, file_size):
+        # Offer the file to the target straight away, the bytes are relayed as they arrive
+        conn = relay.sender
+        relay.file_size = file_size
+
+        with conn.channel.lock:
+            target_socket = conn.channel.connected_clients.get(relay.target_client)
+        target_conn = self.connections.get(target_socket)
+        if target_conn is not None and target_conn.downloads and not target_conn.has_transfer_ids():
+            target_conn = None # already receiving a file and cannot tell two apart
+
+        if target_conn is not None:
+            relay.target = target_conn
+            target_conn.downloads[relay.transfer_id] = relay
+
+            parts = relay.file_path.split('/')
+            basename = parts[-1]
+            message = f"[Server Message] FileSize {basename} {file_size}"
+            if target_conn.has_transfer_ids():
+                message += f" {relay.digest or '-'} {relay.transfer_id}"
+            self.send_message(target_socket, message, CONTROL) # Send file size
+
+        # Senders with transfer IDs wait for the target's "Ready", which says where to start
+        if file_size == 0 or (relay.target is None and conn.has_transfer_ids()):
+            self.upload_complete(relay)
+
+    def handle_file_transfer(self, relay, data, crc=None):
+        # Relay one piece of an upload: to the target if it is ready, otherwise into the bounded backlog.
+        # crc is the CRC-32 of the chunk from senders with transfer IDs, passed on for the target to check.
+        if len(data) > relay.file_size - relay.received:
+            data, crc = data[:relay.file_size - relay.received], None
+        relay.received += len(data)
+
+        target = relay.target if self.relay_target_alive(relay) else None
+        if target is not None:
+            with relay.condition:
+                if relay.ready:
+                    self.queue_file_data(target.sock, relay.transfer_id, data, crc)
+                else:
+                    relay.backlog.append(bytes(data))
+                    relay.backlog_bytes += len(data)
+            self.flush_output(target)
+
+        if relay.received == relay.file_size:
+            self.upload_complete(relay)
+        elif relay.sender.has_transfer_ids():
+            self.grant_window(relay)
+        else:
+            self.wait_for_relay_window(relay)
+
+    def upload_complete(self, relay):
+        # Every byte is in, the transfer finishes when the target says "Received" (or leaves)
+        relay.sender.uploads.pop(relay.transfer_id, None)
+        if not self.relay_target_alive(relay):
+            self.finish_relay(relay, False)
+
+    def relay_ready(self, relay, offset):
+        # Target client is ready, send it the backlog and relay the rest as it arrives.
+        # A target that kept part of this file asks for the rest from offset, senders with
+        # transfer IDs have not sent anything yet and are told where to resume.
+        if relay.ready:
+            return
+        target_conn = relay.target
+        if relay.sender.has_transfer_ids():
+            if relay.digest is not None and relay.received == 0 and offset <= relay.file_size:
+                relay.received = offset
+            message = f"[Server Message] Resume {relay.received} {relay.transfer_id}"
+            self.send_message(relay.sender.sock, message, CONTROL)
+            if relay.received == relay.file_size:
+                relay.ready = True
+                self.upload_complete(relay)
+                return
+        with relay.condition:
+            relay.ready = True
+            for data in relay.backlog:
+                self.queue_file_data(target_conn.sock, relay.transfer_id, data)
+            relay.backlog.clear()
+            relay.backlog_bytes = 0
+            relay.condition.notify_all()
+        self.flush_output(target_conn)
+        if relay.sender.has_transfer_ids():
+            self.grant_window(relay)
+        else:
+            self.resume_relay_sender(relay.sender)
+
+    def relay_target_alive(self, relay):
+        return relay.target is not None and self.connections.get(relay.target.sock) is relay.target
+
+    def relay_window_full(self, relay):
+        if not self.relay_target_alive(relay): # bytes are discarded, never wait
+            return False
+        if not relay.ready:
+            return relay.backlog_bytes >= RELAY_WINDOW
+        return relay.target.outbound_bytes >= RELAY_WINDOW
+
+    def grant_window(self, relay):
+        # Let a client with transfer IDs send more of the file while the target keeps up. The sender's
+        # connection is never paused, so chat and its other transfers keep flowing.
+        with relay.condition:
+            if relay.finished or self.relay_window_full(relay):
+                return
+            limit = min(relay.file_size, relay.received + RELAY_WINDOW)
+            if limit <= relay.granted or (limit - relay.granted < RELAY_WINDOW // 2 and limit < relay.file_size):
+                return # batch small grants
+            relay.granted = limit
+        message = f"[Server Message] Window {limit} {relay.transfer_id}"
+        self.send_message(relay.sender.sock, message, CONTROL)
+
+    def wait_for_relay_window(self, relay):
+        # Bound the bytes in flight: thread mode blocks the sender's thread, event loop mode stops reading it
+        if SERVER_MODE == "eventloop":
+            if self.relay_window_full(relay):
+                relay.sender.paused = True
+                self.update_events(relay.sender)
+            return
 
-    def handle_file_transfer(self, channel, commands, target_client, file_path, sock, client_username):
-        global failed_transfer
-        file_size = int(commands[1])
+        self.flush_deferred()
+        with relay.condition:
+            while self.relay_window_full(relay) and self.connections.get(relay.sender.sock) is relay.sender:
+                relay.condition.wait(0.5)
 
-        file_data = b""
+    def relay_drained(self, conn):
+        # The target's outbound queue made progress, let the senders of its downloads continue
+        for relay in list(conn.downloads.values()):
+            if self.relay_window_full(relay):
+                continue
+            if relay.sender.has_transfer_ids():
+                self.grant_window(relay)
+            elif SERVER_MODE == "eventloop":
+                self.resume_relay_sender(relay.sender)
+            else:
+                with relay.condition:
+                    relay.condition.notify_all()
+
+    def resume_relay_sender(self, sender):
+        # Event loop mode: read the sender again once none of its uploads is waiting for its target
+        if SERVER_MODE != "eventloop" or not sender.paused:
+            return
+        if any(self.relay_window_full(relay) for relay in list(sender.uploads.values())):
+            return
+        sender.paused = False
+        self.update_events(sender)
 
-        while len(file_data) < file_size: 
-            current = sock.recv(min(BUFSIZE, file_size - len(file_data)))
-            if not current: # Failed
-                message = f"[Server Message] Failed to send \"{file_path}\" to {target_client}"
-                sock.sendall(message.encode())
-                # continue
+    def finish_relay(self, relay, sent):
+        # Report the outcome of one transfer to its sender (and on success to the target and stdout)
+        with relay.condition:
+            if relay.finished:
                 return
-            file_data += current
+            relay.finished = True
+        relay.sender.uploads.pop(relay.transfer_id, None)
+        target_conn = relay.target
+        if target_conn is not None:
+            target_conn.downloads.pop(relay.transfer_id, None)
+
+        file_path, target_client = relay.file_path, relay.target_client
+        sock = relay.sender.sock
+
+        with self.transfer_stats.lock:
+            self.transfer_stats.bytes += relay.received
+            if sent:
+                self.transfer_stats.sent += 1
+                self.transfer_stats.seconds.observe(time.monotonic() - relay.started)
+            else:
+                self.transfer_stats.failed += 1
+
+        if not sent:
+            if relay.sender.has_transfer_ids() and relay.received < relay.file_size: # stop the upload
+                message = f"[Server Message] File Transfer Failed {relay.transfer_id}"
+                self.send_message(sock, message, CONTROL)
+            message = f"[Server Message] Failed to send \"{file_path}\" to {target_client}"
+            self.send_message(sock, message)
+            return
+
+        # Send sent message to client
+        message = f"[Server Message] Sent \"{file_path}\" to {target_client}."
+        self.send_message(sock, message)
 
-        # Received, transfer to target client now
+        # Send message to server stdout and receiver
         parts = file_path.split('/')
         basename = parts[-1]
 
-        target_socket = channel.client_sockets.get(target_client)
-        message = f"[Server Message] FileSize {basename} {file_size}"
-        target_socket.sendall(message.encode()) # Send file size
+        message = f"[Server Message] {relay.sender.username} sent \"{basename}\" to {target_client}."
+        self.log.write(message, "transfer", channel=relay.sender.channel.name, user=relay.sender.username, target=target_client)
+        self.send_message(target_conn.sock, message)
+
+    def abandon_relays(self, conn):
+        # conn has gone: fail the transfers it was receiving, drop the ones it was sending
+        for relay in list(conn.uploads.values()):
+            with relay.condition:
+                relay.finished = True
+            target_conn = relay.target
+            if target_conn is not None and target_conn.downloads.pop(relay.transfer_id, None) is not None:
+                if target_conn.has_transfer_ids(): # let the target discard its partial file
+                    message = f"[Server Message] File Transfer Failed {relay.transfer_id}"
+                    self.send_message(target_conn.sock, message, CONTROL)
+        conn.uploads.clear()
+
+        for relay in list(conn.downloads.values()):
+            if relay.file_size == relay.received or relay.sender.has_transfer_ids(): # report the failure now
+                self.finish_relay(relay, False)
+            else: # the sender finds out when its upload completes
+                self.resume_relay_sender(relay.sender)
+                with relay.condition:
+                    relay.condition.notify_all()
+
+    def run_event_loop(self):
+        # Serve every channel listener and client connection from this thread
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+        for channel in self.channels:
+            self.start_accepting(channel)
+        if self.shared_socket is not None:
+            self.shared_socket.setblocking(False)
+            self.selector.register(self.shared_socket, selectors.EVENT_READ, None)
 
-        # wait for response from client
-        ack = target_socket.recv(BUFSIZE).decode().strip()
-        if ack == "[Client Message] Ready":
-            target_socket.sendall(file_data)
+        while True:
+            timeout = self.afk_scheduler.next_tick_in()
+            notify_in = self.next_queue_notify_in()
+            if notify_in is not None and (timeout is None or notify_in < timeout):
+                timeout = notify_in
+
+            for key, mask in self.selector.select(timeout):
+                if key.fileobj is self.shared_socket:
+                    self.accept_connection(self.shared_socket, None)
+                elif key.data is None: # admin command from stdin, or an archive reply
+                    self.wakeup_recv.recv(BUFSIZE)
+                    while not self.admin_calls.empty():
+                        command, args = self.admin_calls.get()
+                        command(*args)
+                elif isinstance(key.data, Channel):
+                    self.accept_connection(key.fileobj, key.data)
+                else:
+                    conn = key.data
+                    if mask & selectors.EVENT_WRITE:
+                        self.write_connection(conn)
+                    if mask & selectors.EVENT_READ and self.connections.get(conn.sock) is conn:
+                        self.read_connection(conn)
 
-            if failed_transfer_event.is_set():
-                message = f"[Server Message] Failed to send \"{file_path}\" to {target_client}"
-                sock.sendall(message.encode())
-                failed_transfer_event.clear()
-                return
+            self.check_afk()
+            self.notify_queue_positions()
 
-            # Send sent message to client
-            message = f"[Server Message] Sent \"{file_path}\" to {target_client}."
-            sock.sendall(message.encode())
+    def accept_connection(self, listening_socket, channel):
+        # channel is None for the shared port, the handshake names it
+        try:
+            client_socket, client_address = listening_socket.accept()
+        except BlockingIOError:
+            return
+        conn = Connection(client_socket, channel)
+        self.connections[client_socket] = conn
+        self.selector.register(client_socket, selectors.EVENT_READ, conn)
 
-            # Send message to server stdout and receiver
-            parts = file_path.split('/')
-            basename = parts[-1]
+    def read_connection(self, conn):
+        # One client's error must not end the loop every other client is served from
+        try:
+            data = conn.receive(self.recv_buffer)
 
-            message = f"[Server Message] {client_username} sent \"{basename}\" to {target_client}."
-            print(message, file=sys.stdout, flush=True)
-            target_socket.sendall(message.encode())
+            if conn.username is None: # username handshake
+                if not data:
+                    self.close_client_socket(conn.sock)
+                    return
+                self.admit_hello(conn, bytes(data))
+                return
 
-            target_client = None
-            file_path = None
-        else: 
-            self.print_message(ack, client_username, channel)
+            if not self.handle_messages(conn, conn.split_messages(data)):
+                self.forget_connection(conn.sock)
+        except Exception as error:
+            self.log.write(f"[Server Message] Dropped a client after an error: {error!r}", "error", user=conn.username)
+            self.drop_client(conn)
+
+    def drop_client(self, conn):
+        # Disconnect a client whose message could not be handled, as if it had gone
+        channel = conn.channel
+        if conn.username is not None and channel is not None:
+            self.disconnect(channel, conn.username, False)
+            self.promote_from_queue(channel)
+        if self.connections.get(conn.sock) is conn: # not in the channel, e.g. during the handshake
+            self.close_client_socket(conn.sock)
+
+    def record_activity(self, conn):
+        # Hot path of AFK tracking, just a timestamp unless the connection is not in the wheel yet
+        self.afk_scheduler.record_activity(conn)
+
+    def run_afk_scheduler(self):
+        # Thread mode: one thread ticks the AFK wheel and sends queue positions for every client
+        while True:
+            time.sleep(AFK_TICK)
+            self.check_afk()
+            self.notify_queue_positions()
+
+    def check_afk(self):
+        for conn in self.afk_scheduler.advance():
+            channel, client_username = conn.channel, conn.username
+            with channel.lock:
+                connected = self.connections.get(conn.sock) is conn and client_username in channel.connected_clients
+            if not connected: # left, or back in a queue
+                continue
+            if conn.active_upload() is not None: # uploading counts as activity
+                self.record_activity(conn)
+                continue
+            self.timeout(channel, client_username)
 
-        failed_transfer = False
+    def forget_connection(self, sock):
+        conn = self.connections.pop(sock, None)
+        if conn is None:
+            return
+        if self.selector is not None:
+            self.update_events(conn)
+        self.abandon_relays(conn)
+        if conn.compressor is not None:
+            stats = self.compression_stats
+            with stats.lock:
+                stats.raw_out += conn.compressor.raw_bytes
+                stats.wire_out += conn.compressor.wire_bytes
+                stats.raw_in += conn.decoder.raw_bytes
+                stats.wire_in += conn.decoder.wire_bytes
+
+    def close_client_socket(self, sock):
+        # Unregister before closing, the selector cannot unregister a closed socket
+        conn = self.connections.get(sock)
+        self.forget_connection(sock)
+        if conn is None:
+            sock.close()
+            return
+
+        # Close once the last messages (e.g. "You are removed from the channel.") are sent
+        drained = conn.flush_output()
+        with conn.lock:
+            conn.close_deadline = time.monotonic() + CLOSE_LINGER
+            writer_has_it = conn.write_watched
+            conn.write_watched = True
+        if drained and not writer_has_it:
+            if SERVER_MODE == "eventloop":
+                conn.write_watched = False
+                self.update_events(conn)
+            sock.close()
+        elif SERVER_MODE == "eventloop":
+            self.update_events(conn)
+        elif not writer_has_it:
+            self.writer.watch(conn)
 
     def disconnect(self, channel, client_username, switch):
+        flush = []
+        with channel.lock:
+            socket = self.detach_client(channel, client_username, switch, flush)
+        if socket is not None and not switch: # don't close socket in switching
+            self.close_client_socket(socket) # close socket
+        self.flush_connections(flush)
+
+    def detach_client(self, channel, client_username, switch, flush):
+        # Remove a client from channel, call with channel.lock held. Queues the "left" messages,
+        # adding their connections to flush, and returns the client's socket (None if not in the channel).
         message = f"[Server Message] {client_username} has left the channel."
 
         # If not emptied
-        with counter_lock:
-            if not client_username in channel.disconnected_clients: # if not AFK client
-                if client_username in channel.connected_clients or client_username in channel.queue_clients_usernames: 
-                    print(message)
-                    sys.stdout.flush()
+        if not client_username in channel.disconnected_clients: # if not AFK client
+            if client_username in channel.connected_clients or client_username in channel.queue: 
+                self.log.write(message, "leave", channel=channel.name, user=client_username)
 
         global quit
         global quit_from_queue
 
-        with counter_lock:
-            # send to all clients in channel
-            if quit_from_queue: 
-                pass
-            elif quit:
-                for other_client in channel.connected_clients: 
-                    if other_client == client_username:
-                        continue
-                    current_socket = channel.client_sockets.get(other_client)
-                    current_socket.sendall(message.encode())
-            elif client_username in channel.disconnected_clients:
-                pass # don't send "left" message to other clients if AFK
-            elif switch:
-                for other_client in channel.connected_clients: # don't inform switching client in switch
-                    if not other_client == client_username: 
-                        current_socket = channel.client_sockets.get(other_client)
-                        current_socket.sendall(message.encode())
-            elif client_username in channel.connected_clients: # or client_username in channel.queue_clients_usernames:
-                for other_client in channel.connected_clients: 
-                    current_socket = channel.client_sockets.get(other_client)
-                    current_socket.sendall(message.encode())
-
-            # Remove from disconnected client list in case later on another client with same name disconnects
-            if client_username in channel.disconnected_clients:
-                channel.disconnected_clients.remove(client_username)
-            # If client disconnected from connected list
-            if client_username in channel.connected_clients:
-                # Remove client from list and from socket dict
-                channel.connected_clients.remove(client_username) # remove from connected clients list
-                socket = channel.client_sockets[client_username] # get socket for each client
-                channel.client_sockets.pop(client_username) # remove from connected sockets list
-                if not switch: # don't close socket in switching
-                    socket.close() # close socket
-            elif client_username in channel.queue_clients_usernames: # Client disconnected from queue
-                # remove from queue by dequeueing and enqueing all except removed client
-                queued_clients = []
-                channel.queue_clients_usernames.remove(client_username)
-                # channel.queue_clients -= 1 this is done in handle comms function
-                while not channel.queue.empty():
-                    current = channel.queue.get()
-                    if not current == client_username:
-                        queued_clients.append(current)
-                for item in queued_clients: # re-enqueue remaining clients in order
-                    channel.queue.put(item)
-
-                # channel.queue.queue.remove(client_username) # remove from queue
-                socket = channel.queue_sockets[client_username]
-                channel.queue_sockets.pop(client_username) # remove from queue sockets
-                if not switch: # don't close socket in switching
-                    socket.close() # close socket
+        # send to all clients in channel
+        message = EncodedMessage(message)
+        if quit_from_queue: 
+            pass
+        elif quit:
+            for other_client, current_socket in channel.connected_clients.items():
+                if other_client == client_username:
+                    continue
+                flush.append(self.queue_message(current_socket, message))
+        elif client_username in channel.disconnected_clients:
+            pass # don't send "left" message to other clients if AFK
+        elif switch:
+            for other_client, current_socket in channel.connected_clients.items(): # don't inform switching client in switch
+                if not other_client == client_username: 
+                    flush.append(self.queue_message(current_socket, message))
+        elif client_username in channel.connected_clients: # or client_username in channel.queue:
+            for other_client, current_socket in channel.connected_clients.items():
+                flush.append(self.queue_message(current_socket, message))
+
+        # Remove from disconnected client list in case later on another client with same name disconnects
+        if client_username in channel.disconnected_clients:
+            channel.disconnected_clients.remove(client_username)
+
+        socket = None
+        # If client disconnected from connected list
+        if client_username in channel.connected_clients:
+            # Remove client
+            socket = self.remove_member(channel, client_username) # remove from connected clients
+        elif client_username in channel.queue: # Client disconnected from queue
+            socket = channel.queue.remove(client_username)
+            self.queue_changed(channel)
+        self.publish_occupancy(channel)
+
+        return socket
                 
+    @profiled
     def promote_from_queue(self, channel):
         # If empty spot in channel (connected client disconnected) and queue not empty, promote client from queue
-        if len(channel.connected_clients) < channel.capacity and not channel.queue.empty(): # If there is client in queue
-            new_client_username = channel.queue.get() # remove from queue
-            new_client_socket = channel.queue_sockets[new_client_username] # get socket from dict
-            channel.queue_sockets.pop(new_client_username) # remove from dict
-            channel.queue_clients -= 1 # decrement number of clients in Queue
-            channel.queue_clients_usernames.remove(new_client_username)
-
-            # add to connected list
-            channel.connected_clients.append(new_client_username)
-            channel.client_sockets[new_client_username] = new_client_socket
-
-            # Notify client and server stdout that new client joined channel
-            self.notify_connected_client(new_client_username, channel.name, new_client_socket)
-
-            # Update user ahead message to queue clients
-            users_ahead = 0 
-
-            queued_clients = []
-            while not channel.queue.empty():
-                current = channel.queue.get()
-                queued_clients.append(current)
-
-                sock = channel.queue_sockets[current] # get socket
-                message = f"[Server Message] You are in the waiting queue and there are {users_ahead} user(s) ahead of you."
-                sock.sendall(message.encode())
-                
-                users_ahead += 1 # increment number of users ahead
+        flush = []
+        new_conn = None
+        with channel.lock:
+            if len(channel.connected_clients) < channel.capacity and channel.queue: # If there is client in queue
+                new_client_username, new_client_socket = channel.queue.pop() # remove from queue
+
+                # add to connected list
+                self.add_member(channel, new_client_username, new_client_socket)
+
+                # Notify client and server stdout that new client joined channel
+                new_conn = self.notify_connected_client(new_client_username, channel, new_client_socket)
+                flush.append(new_conn)
+                if new_conn is not None and new_conn.queued_at is not None:
+                    channel.stats.queue_wait_seconds.observe(time.monotonic() - new_conn.queued_at)
+                    new_conn.queued_at = None
+
+                # Queue clients hear their new position on the next tick
+                self.queue_changed(channel)
+                self.publish_occupancy(channel)
+
+        self.flush_connections(flush)
+        if new_conn is not None:
+            self.record_activity(new_conn)
+
+    def queue_changed(self, channel):
+        # Call with channel.lock held after clients left the queue. Changes until the update is due
+        # are coalesced into it, the event loop picks the deadline up in next_queue_notify_in.
+        if QUEUE_UPDATES == "push" and channel.positions_due is None and channel.queue:
+            channel.positions_due = time.monotonic() + QUEUE_NOTIFY_INTERVAL
+
+    def next_queue_notify_in(self):
+        # Seconds until the next queue position update is due, None when none is
+        due = [channel.positions_due for channel in self.channels if channel.positions_due is not None]
+        if not due:
+            return None
+        return max(0, min(due) - time.monotonic())
+
+    def notify_queue_positions(self):
+        # Send every queued client whose position changed since it was last told its new position,
+        # one pass over each changed queue and one flush for all of them
+        now = time.monotonic()
+        flush = []
+        for channel in self.channels:
+            if channel.positions_due is None or channel.positions_due > now:
+                continue
+            with channel.lock:
+                channel.positions_due = None
+                for users_ahead, (client_username, sock) in enumerate(channel.queue.items()):
+                    conn = self.connections.get(sock)
+                    if conn is None or conn.queue_position == users_ahead:
+                        continue
+                    conn.queue_position = users_ahead
+                    message = f"[Server Message] You are in the waiting queue and there are {users_ahead} user(s) ahead of you."
+                    flush.append(self.queue_message(sock, message))
+        self.flush_connections(flush)
 
-            for item in queued_clients: # re-enqueue remaining clients in order
-                channel.queue.put(item)
+    def position_command(self, conn, channel):
+        # /position from a queued client: its exact position right now
+        with channel.lock:
+            if conn.username not in channel.queue:
+                return
+            users_ahead = channel.queue.position(conn.username)
+            conn.queue_position = users_ahead
+            message = f"[Server Message] You are in the waiting queue and there are {users_ahead} user(s) ahead of you."
+            self.queue_message(conn.sock, message)
+        self.flush_connections([conn])
     
+    @profiled
     def print_message(self, data, client_username, channel):
         message = data.decode().strip()
         start_of_message = f"[{client_username}]"
         message_to_send = start_of_message + " " + message
         # send to all clients in channel
-        for other_client in channel.connected_clients: 
-            current_socket = channel.client_sockets.get(other_client)
-            current_socket.sendall(message_to_send.encode())
+        encoded = EncodedMessage(message_to_send)
+        flush = []
+        started = time.perf_counter()
+        with channel.lock:
+            channel.remember(encoded)
+            if self.archive is not None: # same order as the broadcast
+                self.archive.append(channel.name, time.time(), encoded.plain)
+            recipients = self.broadcast(channel, encoded, flush)
+            stats = channel.stats
+            stats.messages_in += 1
+            stats.bytes_in += len(data)
+            stats.messages_out += recipients
+            stats.bytes_out += recipients * len(encoded.plain)
+            stats.broadcast_seconds.observe(time.perf_counter() - started)
+        self.flush_connections(flush)
 
         # print to stdout of server
-        print(message_to_send, file=sys.stdout)
-        sys.stdout.flush()
+        self.log.write(message_to_send, "chat", channel=channel.name, user=client_username)
         
         return
 
@@ -678,99 +3301,242 @@ class Server:
         afk_message = f"[Server Message] {client_username} went AFK in channel \"{channel.name}\"."
         
         # Send message to chatserver stdout
-        print(afk_message, file=sys.stdout, flush=True)
+        self.log.write(afk_message, "afk", channel=channel.name, user=client_username)
 
-        with counter_lock:
+        flush = []
+        encoded = EncodedMessage(afk_message)
+        with channel.lock:
             # Send message to connected clients (including client about to be disconnected)
-            for client in channel.connected_clients:
-                socket = channel.client_sockets[client] # get socket for each client
-                socket.sendall(afk_message.encode()) # send   
+            self.broadcast(channel, encoded, flush)
 
-            channel.disconnected_clients.append(client_username) # assign it as disconnected due to AFK so disconnect function called in handle_comms  
+            channel.stats.afk_evictions += 1
+            channel.disconnected_clients.add(client_username) # assign it as disconnected due to AFK so disconnect function called in handle_comms  
+        self.flush_connections(flush)
         
         return # disconnect and socket and thread close handled in disconnect function
 
-    def notify_connected_client(self, username, channel_name, socket):
-        print(f"[Server Message] {username} has joined the channel \"{channel_name}\".", file=sys.stdout)
-        sys.stdout.flush()
+    def search_command(self, conn, channel, data_decoded):
+        # /search text: the channel's most recent archived chat lines containing text
+        text = data_decoded.partition(" ")[2].strip()
+        if not text:
+            self.send_message(conn.sock, "[Server Message] Usage: /search text")
+        elif self.archive_available(conn):
+            more_message = f"[Server Message] Showing the last {ARCHIVE_RESULTS} matches."
+            self.query_archive(conn, channel, "search", (text, ARCHIVE_RESULTS), more_message,
+                               f"[Server Message] No messages in channel \"{channel.name}\" contain \"{text}\".")
+
+    def archive_available(self, conn):
+        if self.archive is None:
+            self.send_message(conn.sock, "[Server Message] The chat archive is not enabled on this server.")
+            return False
+        return True
 
-        message = f"[Server Message] You have joined the channel \"{channel_name}\"."
-        socket.sendall(message.encode())
+    def query_archive(self, conn, channel, method, args, more_message, empty_message):
+        # The archive's query thread scans the disk, the reply is sent where admin commands run
+        def reply(records, more):
+            self.run_admin(self.send_archived, conn, records, more and more_message, empty_message)
+        self.archive.query(channel.name, method, args, reply)
 
+    def send_archived(self, conn, records, more_message, empty_message):
+        # Send archived (time, line) records as one write, each line prefixed with its local time
+        if self.connections.get(conn.sock) is not conn: # left while the archive was read
+            return
+        if records is None:
+            self.send_message(conn.sock, "[Server Message] The chat archive cannot be read right now.")
+            return
+        if not records:
+            self.send_message(conn.sock, empty_message)
+            return
+        messages = [EncodedMessage(f"[{datetime.fromtimestamp(timestamp).isoformat(' ', 'seconds')}] {line.decode()}") for timestamp, line in records]
+        if more_message:
+            messages.append(EncodedMessage(more_message))
+        self.flush_connections([self.queue_lines(conn, messages)])
+
+    def notify_connected_client(self, username, channel, socket):
+        # Called with the channel locked, returns the connection to flush
+        self.log.write(f"[Server Message] {username} has joined the channel \"{channel.name}\".", "join", channel=channel.name, user=username)
+
+        message = f"[Server Message] You have joined the channel \"{channel.name}\"."
+        conn = self.queue_message(socket, message)
+        if conn is not None and HISTORY_REPLAY > 0:
+            conn = self.queue_history(conn, channel, HISTORY_REPLAY)
+        return conn
+
+    def queue_history(self, conn, channel, count):
+        # Queue the last count chat lines of channel as one write, call with channel.lock held.
+        # The lines are the history's own encoded bytes.
+        start = max(0, len(channel.history) - count)
+        return self.queue_lines(conn, islice(channel.history, start, None))
+
+    def queue_lines(self, conn, messages):
+        # Queue EncodedMessages as one write. Framed clients get their shared frames gathered by sendmsg,
+        # unframed clients read every recv as one message and get them newline separated.
+        lines = [message.encoded_for(conn) for message in messages]
+        if not lines:
+            return conn
+        data = lines if conn.protocol_version is not None else b"\n".join(lines)
+        if not conn.queue_output(data):
+            self.drop_slow_client(conn)
+            return None
+        return conn
+
+    def history_command(self, conn, channel, commands):
+        # /history N: the last N chat lines of the client's channel, /history since <timestamp>: from the archive
+        if len(commands) == 3 and commands[1] == "since":
+            timestamp = parse_timestamp(commands[2])
+            if timestamp is None:
+                self.send_message(conn.sock, "[Server Message] Usage: /history since unix_time|YYYY-MM-DDTHH:MM:SS")
+            elif self.archive_available(conn):
+                more_message = f"[Server Message] Showing the first {ARCHIVE_RESULTS} messages, ask again from a later time for the rest."
+                self.query_archive(conn, channel, "since", (timestamp, ARCHIVE_RESULTS), more_message,
+                                   f"[Server Message] No messages in channel \"{channel.name}\" since then.")
+            return
+        if len(commands) != 2 or not commands[1].isdecimal() or int(commands[1]) == 0:
+            self.send_message(conn.sock, "[Server Message] Usage: /history message_count")
+            return
+        with channel.lock:
+            if channel.history:
+                conn = self.queue_history(conn, channel, int(commands[1]))
+            else:
+                conn = self.queue_message(conn.sock, f"[Server Message] No messages in channel \"{channel.name}\" yet.")
+        self.flush_connections([conn])
+
+    @profiled
     def send_command(self, sock, channel, commands, client_username):
         # commands in format: [/send, target_client_username, file_path]
+        if len(commands) < 3: # chatclient checks this, other clients may not
+            self.send_message(sock, "[Server Message] Usage: /send target_client_username file_path")
+            return
 
         # Same client
         if client_username == commands[1]: 
             message = "[Server Message] Cannot send file to yourself."
-            sock.sendall(message.encode())
+            self.send_message(sock, message)
             return
 
         # Client doesn't exist
+        conn = self.connections.get(sock)
         client_exists = True
-        if not commands[1] in channel.connected_clients:
+        with channel.lock:
+            target_connected = commands[1] in channel.connected_clients
+        if not target_connected:
             message = f"[Server Message] {commands[1]} is not in the channel."
-            sock.sendall(message.encode())
+            self.send_message(sock, message)
             client_exists = False
+            if conn.has_transfer_ids(): # nothing to start
+                return
+
+        file_path = commands[2].strip()
+        relay = FileRelay(next(self.transfer_ids), conn, commands[1], file_path)
+        if not conn.has_transfer_ids(): # a new /send replaces one that never started
+            pending = self.pending_upload(conn)
+            if pending is not None:
+                del conn.uploads[pending.transfer_id]
+        conn.uploads[relay.transfer_id] = relay
 
-        file_path = commands[2]
-        
         message = "[Server Message] Start transmission."
-        sock.sendall(message.encode())
+        if conn.has_transfer_ids():
+            message += f" {file_path} {relay.transfer_id}"
+        self.send_message(sock, message, CONTROL)
 
     # creates output for client when client sends /list command
     def list_command(self, sock):
-        for channel in self.channels:
-            message = f"[Channel] {channel.name} {channel.port} Capacity: {len(channel.connected_clients)}/{channel.capacity}, Queue: {channel.queue_clients}\n"
-            sock.sendall(message.encode())
+        for channel in self.all_channels:
+            connected, queued = self.occupancy_of(channel)
+            message = f"[Channel] {channel.name} {channel.port} Capacity: {connected}/{channel.capacity}, Queue: {queued}\n"
+            self.send_message(sock, message)
 
+    @profiled
     def whisper_command(self, sock, channel, commands, client_username): 
         # commands is arr in format ["/whisper", client_username, chat_message]
+        if len(commands) < 3: # chatclient checks this, other clients may not
+            self.send_message(sock, "[Server Message] Usage: /whisper receiver_client_username chat_message")
+            return
 
         # Target client not in channel
-        if not commands[1] in channel.connected_clients: 
+        with channel.lock:
+            target_socket = channel.connected_clients.get(commands[1])
+            if target_socket is not None:
+                message = f"[{client_username} whispers to you] {commands[2]}"
+                target_conn = self.queue_message(target_socket, message)
+                channel.stats.messages_in += 1
+                channel.stats.messages_out += 1
+                channel.stats.bytes_in += len(commands[2].encode())
+                channel.stats.bytes_out += len(message.encode())
+
+        if target_socket is None: 
             message = f"[Server Message] {commands[1]} is not in the channel."
-            sock.sendall(message.encode())
+            self.send_message(sock, message)
         else: # Client in channel
-            message = f"[{client_username} whispers to you] {commands[2]}"
-            target_socket = channel.client_sockets.get(commands[1])
-            target_socket.sendall(message.encode())
+            self.flush_connections([target_conn])
 
             message = f"[{client_username} whispers to {commands[1]}] {commands[2]}"
 
-            print(message, file=sys.stdout) # successful whisper message to server stdout
-            sys.stdout.flush()
+            self.log.write(message, "whisper", channel=channel.name, user=client_username, target=commands[1]) # successful whisper message to server stdout
 
-            sock.sendall(message.encode()) # successful whisper message to sender client
+            self.send_message(sock, message) # successful whisper message to sender client
         
+    @profiled
     def switch_command(self, sock, channel, commands, client_username, queue_client):
+        if len(commands) != 2: # chatclient checks this, other clients may not
+            self.send_message(sock, "[Server Message] Usage: /switch channel_name")
+            return False
         new_channel = commands[1]
         new_channel_repr = repr(new_channel)[1:-1]
         new_channel = new_channel_repr
-        if new_channel not in self.channel_names:
+        if new_channel not in self.channels_by_name:
+            if new_channel in self.remote_channels: # served by another worker
+                return self.reserve_remote(self.connections[sock], new_channel, client_username)
             # new_channel_repr = repr(new_channel)[1:-1]
             message = f"[Server Message] Channel \"{new_channel_repr}\" does not exist."
-            sock.sendall(message.encode())
+            self.send_message(sock, message)
             return False
         
         # Get channel object using name
-        for current_channel in self.channels:
-            if current_channel.name == new_channel:
-                new_channel = current_channel
-                break
+        new_channel = self.channels_by_name[new_channel]
 
         # check if client exists already
-        if client_username in new_channel.connected_clients or client_username in new_channel.queue_clients_usernames:
+        with new_channel.lock:
+            duplicate = new_channel.has_user(client_username)
+        if duplicate:
             message = f"[Server Message] Channel \"{new_channel.name}\" already has user {client_username}."
-            sock.sendall(message.encode())
+            self.send_message(sock, message)
             return False
         
         return True
 
+    def open_archive(self):
+        # Open every channel's log on disk and fill the in-memory histories from it
+        try:
+            self.archive = ChatArchive(ARCHIVE_DIR, list(self.channels_by_name))
+            for channel in self.channels:
+                for timestamp, line in self.archive.channels[channel.name].last(HISTORY_MESSAGES):
+                    channel.remember(EncodedMessage(line.decode()))
+        except (OSError, struct.error) as error:
+            print(f"Error: unable to open the chat archive in \"{ARCHIVE_DIR}\": {error}", file=sys.stderr)
+            exit(EXIT_CODES.USAGE_ERROR.value)
+
     def main(self):
         self.load_config()
+        signal.signal(signal.SIGHUP, self.handle_sighup)
+        worker_count = min(int(WORKERS), len(self.channels))
+        if worker_count > 1:
+            self.supervise(worker_count) # does not return
+        if ARCHIVE_DIR:
+            self.open_archive()
         self.process_connections()  
 
+def parse_timestamp(text):
+    # Unix time or a local ISO 8601 date and time, None if it is neither
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        return None
+
 def usage_checking(arr): 
     config_file = None
     afk_time = 100 # default 100
@@ -802,6 +3568,86 @@ def usage_checking(arr):
             print("Usage: chatserver [afk_time] config_file", file=sys.stderr)
             exit(EXIT_CODES.USAGE_ERROR.value)
 
+    numbers = {"CHATSERVER_OUTBOUND_LIMIT": OUTBOUND_QUEUE_LIMIT, "CHATSERVER_OUTBOUND_BYTES": OUTBOUND_QUEUE_BYTES,
+               "CHATSERVER_RELAY_WINDOW": RELAY_WINDOW, "CHATSERVER_QUEUE_NOTIFY_INTERVAL": QUEUE_NOTIFY_INTERVAL,
+               "CHATSERVER_HISTORY_MESSAGES": HISTORY_MESSAGES, "CHATSERVER_HISTORY_BYTES": HISTORY_BYTES,
+               "CHATSERVER_HISTORY_REPLAY": HISTORY_REPLAY, "CHATSERVER_ARCHIVE_SEGMENT_BYTES": ARCHIVE_SEGMENT_BYTES,
+               "CHATSERVER_PROFILE_INTERVAL": PROFILE_SAMPLE_INTERVAL, "CHATSERVER_LOG_FLUSH_INTERVAL": LOG_FLUSH_INTERVAL,
+               "CHATSERVER_LOG_QUEUE_LIMIT": LOG_QUEUE_LIMIT, "CHATSERVER_MAX_CAPACITY": MAX_CAPACITY,
+               "CHATSERVER_LARGE_CHANNEL": LARGE_CHANNEL_CAPACITY, "CHATSERVER_BROADCAST_RING": BROADCAST_RING_SIZE}
+    for name, value in numbers.items(): # env_number could not parse it
+        if value is None:
+            print(f"Error: Invalid {name} \"{os.environ[name]}\", expected a number.", file=sys.stderr)
+            exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if SERVER_MODE not in SERVER_MODES: # CHATSERVER_MODE environment variable
+        print(f"Error: Invalid server mode \"{SERVER_MODE}\", expected one of: {', '.join(SERVER_MODES)}.", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if SLOW_CLIENT_POLICY not in SLOW_CLIENT_POLICIES: # CHATSERVER_SLOW_CLIENT_POLICY environment variable
+        print(f"Error: Invalid slow client policy \"{SLOW_CLIENT_POLICY}\", expected one of: {', '.join(SLOW_CLIENT_POLICIES)}.", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if OUTBOUND_QUEUE_LIMIT < 1 or OUTBOUND_QUEUE_BYTES < 1: # CHATSERVER_OUTBOUND_LIMIT, CHATSERVER_OUTBOUND_BYTES
+        print("Error: Outbound queue limits must be positive.", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if RELAY_WINDOW < 1: # CHATSERVER_RELAY_WINDOW environment variable
+        print("Error: Relay window must be positive.", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if QUEUE_NOTIFY_INTERVAL < 0: # CHATSERVER_QUEUE_NOTIFY_INTERVAL environment variable
+        print("Error: Queue notify interval must not be negative.", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if QUEUE_UPDATES not in QUEUE_UPDATE_MODES: # CHATSERVER_QUEUE_UPDATES environment variable
+        print(f"Error: Invalid queue update mode \"{QUEUE_UPDATES}\", expected one of: {', '.join(QUEUE_UPDATE_MODES)}.", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if HISTORY_MESSAGES < 0 or HISTORY_BYTES < 0 or HISTORY_REPLAY < 0: # CHATSERVER_HISTORY_* environment variables
+        print("Error: History limits must not be negative.", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if ARCHIVE_SEGMENT_BYTES < 1: # CHATSERVER_ARCHIVE_SEGMENT_BYTES environment variable
+        print("Error: Archive segment size must be positive.", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if METRICS_PORT is not None and not (METRICS_PORT.isdigit() and 1024 <= int(METRICS_PORT) <= 65535): # CHATSERVER_METRICS_PORT environment variable
+        print(f"Error: Invalid metrics port \"{METRICS_PORT}\".", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if PROFILE not in PROFILE_MODES: # CHATSERVER_PROFILE environment variable
+        print(f"Error: Invalid profile mode \"{PROFILE}\", expected one of: {', '.join(PROFILE_MODES)}.", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if PROFILE_SAMPLE_INTERVAL <= 0: # CHATSERVER_PROFILE_INTERVAL environment variable
+        print("Error: Profile sample interval must be positive.", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if not WORKERS.isdigit() or int(WORKERS) < 1: # CHATSERVER_WORKERS environment variable
+        print(f"Error: Invalid worker count \"{WORKERS}\".", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if SHARED_PORT is not None and not (SHARED_PORT.isdigit() and 1024 <= int(SHARED_PORT) <= 65535): # CHATSERVER_SHARED_PORT environment variable
+        print(f"Error: Invalid shared port \"{SHARED_PORT}\".", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if MAX_CAPACITY < 1 or LARGE_CHANNEL_CAPACITY < 1 or BROADCAST_RING_SIZE < 1: # CHATSERVER_MAX_CAPACITY, CHATSERVER_LARGE_CHANNEL, CHATSERVER_BROADCAST_RING
+        print("Error: Channel capacity limits and the broadcast ring size must be positive.", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if COMPRESSION != "off" and not all(codec in COMPRESSION_CODECS for codec in COMPRESSION.split(",")): # CHATSERVER_COMPRESSION environment variable
+        print(f"Error: Invalid compression \"{COMPRESSION}\", expected \"off\" or some of: {', '.join(COMPRESSION_CODECS)}.", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if LOG_FLUSH_INTERVAL < 0 or LOG_QUEUE_LIMIT < 1: # CHATSERVER_LOG_FLUSH_INTERVAL, CHATSERVER_LOG_QUEUE_LIMIT
+        print("Error: Log flush interval must not be negative and the log queue limit must be positive.", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
+    if LOG_FORMAT not in LOG_FORMATS: # CHATSERVER_LOG_FORMAT environment variable
+        print(f"Error: Invalid log format \"{LOG_FORMAT}\", expected one of: {', '.join(LOG_FORMATS)}.", file=sys.stderr)
+        exit(EXIT_CODES.USAGE_ERROR.value)
+
     # Attempt to open the configuration file
     try:
         with open(config_file) as file:
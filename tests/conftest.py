@@ -0,0 +1,202 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from chatprotocol import PROTOCOL_VERSIONS, TEXT, Compressor, FrameDecoder, encode_frame, encode_hello, parse_hello_reply # noqa: E402
+
+TIMEOUT = 5 # seconds any expected output may take
+
+def free_ports(count):
+    # Ports nothing listens on right now, for the config file
+    sockets = [socket.socket() for _ in range(count)]
+    try:
+        for sock in sockets:
+            sock.bind(("localhost", 0))
+        return [sock.getsockname()[1] for sock in sockets]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+def wait_for(predicate, timeout=TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+class ServerProcess:
+    # A chatserver.py run on free ports, with its stdout collected line by line
+    def __init__(self, directory, channels, env=None, afk_time=None):
+        ports = free_ports(len(channels) + 1)
+        self.ports = {name: port for (name, _), port in zip(channels, ports)}
+        self.spare_port = ports[-1] # e.g. for CHATSERVER_SHARED_PORT
+        self.config = os.path.join(directory, "config.txt")
+        self.write_config(channels)
+
+        environment = dict(os.environ, PYTHONUNBUFFERED="1")
+        for name, value in (env or {}).items():
+            environment[name] = str(value).replace("{spare_port}", str(self.spare_port))
+        args = [sys.executable, os.path.join(ROOT, "chatserver.py")]
+        if afk_time is not None:
+            args.append(str(afk_time))
+        self.process = subprocess.Popen(args + [self.config], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, text=True, cwd=directory, env=environment)
+        self.lines = []
+        self.reader = threading.Thread(target=self.read_output, daemon=True)
+        self.reader.start()
+        if not self.wait_for_line("Welcome to chatserver."):
+            self.stop()
+            raise AssertionError("server did not start:\n" + self.output())
+
+    def write_config(self, channels, ports=None):
+        ports = ports or self.ports
+        with open(self.config, "w") as file:
+            for name, capacity in channels:
+                file.write(f"channel {name} {ports[name]} {capacity}\n")
+
+    def read_output(self):
+        for line in self.process.stdout:
+            self.lines.append(line.rstrip("\n"))
+
+    def output(self):
+        return "\n".join(self.lines)
+
+    def wait_for_line(self, text, timeout=TIMEOUT):
+        return wait_for(lambda: any(text in line for line in self.lines), timeout)
+
+    def admin(self, command):
+        self.process.stdin.write(command + "\n")
+        self.process.stdin.flush()
+
+    def stop(self):
+        if self.process.poll() is None:
+            try:
+                self.admin("/shutdown")
+                self.process.wait(TIMEOUT)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+        self.reader.join(TIMEOUT)
+        assert "Traceback" not in self.output(), self.output()
+
+class PlainClient:
+    # The original unframed protocol: a bare username, then text
+    def __init__(self, port, username, channel=None):
+        self.sock = socket.create_connection(("localhost", port))
+        self.received = ""
+        self.closed = False # the server closed the connection
+        self.sock.sendall(username.encode() if channel is None else f"{username}\0\0{channel}".encode())
+
+    def send(self, text):
+        self.sock.sendall(text.encode())
+
+    def receive(self, timeout=0.1):
+        # Whatever arrives within timeout, added to self.received
+        if self.closed:
+            return self.received
+        self.sock.settimeout(timeout)
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    self.closed = True
+                    break
+                self.received += data.decode(errors="replace")
+        except socket.timeout:
+            pass
+        return self.received
+
+    def wait_for(self, text, timeout=TIMEOUT):
+        return wait_for(lambda: text in self.receive(), timeout)
+
+    def wait_for_close(self, timeout=TIMEOUT):
+        def closed():
+            self.receive()
+            return self.closed
+        return wait_for(closed, timeout)
+
+    def close(self):
+        self.sock.close()
+
+class FramedClient(PlainClient):
+    # The framed protocol, compressing if codecs are offered and the server agrees
+    def __init__(self, port, username, channel=None, codecs=(), versions=PROTOCOL_VERSIONS):
+        self.sock = socket.create_connection(("localhost", port))
+        self.decoder = FrameDecoder()
+        if codecs:
+            self.decoder.start_inflating()
+        self.compressor = None
+        self.version = self.codec = None
+        self.frames = [] # (frame type, payload) after the HELLO
+        self.closed = False
+        self.sock.sendall(encode_hello(username, versions, channel, codecs))
+
+    @property
+    def received(self):
+        return "\n".join(payload.decode(errors="replace") for frame_type, payload in self.frames)
+
+    def send(self, text, frame_type=TEXT):
+        data = encode_frame(frame_type, text)
+        self.sock.sendall(data if self.compressor is None else self.compressor.compress(data))
+
+    def receive(self, timeout=0.1):
+        if self.closed:
+            return self.received
+        self.sock.settimeout(timeout)
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    self.closed = True
+                    break
+                for frame_type, payload in self.decoder.feed(data):
+                    if self.version is None:
+                        self.version, self.codec = parse_hello_reply(payload)
+                        if self.codec is not None:
+                            self.compressor = Compressor()
+                    else:
+                        self.frames.append((frame_type, payload))
+        except socket.timeout:
+            pass
+        return self.received
+
+def chatclient(port, username, directory, env=None):
+    # chatclient.py run in directory, with stdin and stdout as text pipes
+    os.makedirs(directory, exist_ok=True)
+    return subprocess.Popen([sys.executable, "-u", os.path.join(ROOT, "chatclient.py"), str(port), username], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd=directory, env=dict(os.environ, **(env or {})))
+
+@pytest.fixture(params=["thread", "eventloop"])
+def mode(request):
+    return request.param
+
+@pytest.fixture
+def start_server(tmp_path, mode):
+    # start_server(channels=[(name, capacity)], env={...}, afk_time=None) -> ServerProcess, stopped after the test
+    servers = []
+
+    def start(channels=(("c1", 5),), env=None, afk_time=None):
+        server = ServerProcess(str(tmp_path), channels, dict({"CHATSERVER_MODE": mode}, **(env or {})), afk_time)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+@pytest.fixture
+def clients():
+    # Clients a test opens, closed after it
+    opened = []
+    yield opened
+    for client in opened:
+        client.close()
@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+
+import pytest
+
+import chatserver
+from chatserver import AFK_TICK, AFK_WHEEL_SLOTS, AfkScheduler
+
+@pytest.fixture
+def clock(monkeypatch):
+    # A monotonic clock the test moves by hand
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(chatserver.time, "monotonic", lambda: now.value)
+    return now
+
+def connection():
+    return SimpleNamespace(last_activity=0, afk_scheduled=False)
+
+def expired_at(scheduler, clock, seconds):
+    clock.value += seconds
+    return scheduler.advance()
+
+def test_idle_client_expires_after_afk_time(clock):
+    scheduler = AfkScheduler(5)
+    assert scheduler.next_tick_in() is None
+    conn = connection()
+    scheduler.record_activity(conn)
+    assert conn.afk_scheduled and 0 < scheduler.next_tick_in() < 2 * AFK_TICK
+    assert expired_at(scheduler, clock, 4.9) == []
+    assert expired_at(scheduler, clock, 0.2 + AFK_TICK) == [conn]
+    assert not conn.afk_scheduled and scheduler.next_tick_in() is None
+
+def test_active_client_is_reslotted(clock):
+    scheduler = AfkScheduler(5)
+    idle, active = connection(), connection()
+    scheduler.record_activity(idle)
+    scheduler.record_activity(active)
+    expired = []
+    for _ in range(4): # a message every 3 seconds keeps active in
+        expired += expired_at(scheduler, clock, 3)
+        scheduler.record_activity(active)
+    assert expired == [idle]
+    assert active.afk_scheduled and scheduler.scheduled == 1
+    assert expired_at(scheduler, clock, 5 + AFK_TICK) == [active]
+
+def test_deadline_beyond_one_revolution(clock):
+    afk_time = AFK_WHEEL_SLOTS * AFK_TICK * 2.5
+    scheduler = AfkScheduler(afk_time)
+    conn = connection()
+    scheduler.record_activity(conn)
+    for _ in range(int(afk_time / AFK_TICK) - 3): # tick by tick, passing its slot twice
+        assert expired_at(scheduler, clock, AFK_TICK) == []
+    assert expired_at(scheduler, clock, 5 * AFK_TICK) == [conn]
+
+def test_catches_up_after_falling_behind(clock):
+    scheduler = AfkScheduler(5)
+    conns = [connection() for _ in range(3)]
+    for conn in conns:
+        scheduler.record_activity(conn)
+        clock.value += 1
+    assert {id(conn) for conn in expired_at(scheduler, clock, 1000)} == {id(conn) for conn in conns}
+    assert scheduler.scheduled == 0
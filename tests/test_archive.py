@@ -0,0 +1,74 @@
+import threading
+import time
+from queue import Queue
+
+from chatserver import ChatArchive
+from conftest import TIMEOUT, PlainClient
+
+def test_search_and_history_since_survive_a_restart(start_server, clients, tmp_path):
+    env = {"CHATSERVER_ARCHIVE_DIR": tmp_path / "archive", "CHATSERVER_ARCHIVE_SEGMENT_BYTES": 300, "CHATSERVER_HISTORY_MESSAGES": 5}
+    server = start_server(env=env)
+    alice = PlainClient(server.ports["c1"], "alice")
+    clients.append(alice)
+    assert alice.wait_for("Welcome")
+    for i in range(12):
+        if i == 9:
+            time.sleep(0.2)
+            since = time.time()
+            time.sleep(0.2)
+        alice.send(f"line {i} apple{i % 3}")
+        assert server.wait_for_line(f"[alice] line {i} ")
+    server.stop()
+    assert len(list((tmp_path / "archive" / "c1").glob("*.log"))) > 1 # small segments roll over
+
+    server = start_server(env=env)
+    bob = PlainClient(server.ports["c1"], "bob")
+    clients.append(bob)
+    assert bob.wait_for("You have joined")
+
+    bob.received = ""
+    bob.send("/search apple2")
+    assert bob.wait_for("[alice] line 11 apple2")
+    assert [line.split("] ", 1)[1] for line in bob.received.splitlines() if "apple" in line] == \
+        [f"[alice] line {i} apple2" for i in (2, 5, 8, 11)]
+
+    bob.send("/search pear")
+    assert bob.wait_for('[Server Message] No messages in channel "c1" contain "pear".')
+
+    bob.received = ""
+    bob.send(f"/history since {since:.3f}")
+    assert bob.wait_for("[alice] line 11 apple2")
+    assert "line 8 " not in bob.received and "line 9 apple0" in bob.received
+
+    bob.send("/history since yesterday")
+    assert bob.wait_for("[Server Message] Usage: /history since unix_time|YYYY-MM-DDTHH:MM:SS")
+
+    bob.received = ""
+    bob.send("/history 2") # the in-memory history was filled from the archive
+    assert bob.wait_for("[alice] line 10 apple1\n[alice] line 11 apple2")
+
+def test_archive_queries_run_on_their_own_thread(tmp_path):
+    archive = ChatArchive(tmp_path, ["c1"])
+    archive.start()
+    archive.append("c1", time.time(), b"[alice] apple")
+    archive.close()
+    scanning, release = threading.Event(), threading.Event()
+    search = archive.channels["c1"].search
+    def slow_search(*args):
+        scanning.set()
+        release.wait(TIMEOUT)
+        return search(*args)
+    archive.channels["c1"].search = slow_search
+
+    replies = Queue()
+    archive.query("c1", "search", ("apple", 10), lambda *reply: replies.put((threading.current_thread(), reply)))
+    assert scanning.wait(TIMEOUT) and replies.empty() # the caller did not wait for the scan
+    release.set()
+    thread, (records, more) = replies.get(timeout=TIMEOUT)
+    assert thread is not threading.current_thread()
+    assert [line for _, line in records] == [b"[alice] apple"] and not more
+
+    for path in (tmp_path / "c1").iterdir(): # an archive that cannot be read gets a reply too
+        path.unlink()
+    archive.query("c1", "since", (0, 10), lambda *reply: replies.put(reply))
+    assert replies.get(timeout=TIMEOUT) == (None, False)
@@ -0,0 +1,82 @@
+import threading
+
+from chatprotocol import TEXT, encode_frame
+from chatserver import BroadcastRing, Connection, EncodedMessage
+from conftest import FramedClient, wait_for
+from test_slow_clients import LINE, LINES, keep_reading, outbound_counters, stalled_client, talker_lines
+
+def ring_of(size, count):
+    ring = BroadcastRing(size)
+    for i in range(count):
+        ring.publish(EncodedMessage(f"line {i}"))
+    return ring
+
+def lines(messages):
+    return [message.plain.decode() for message in messages]
+
+def test_ring_read():
+    ring = ring_of(4, 3)
+    messages, skipped = ring.read(1, 10)
+    assert lines(messages) == ["line 1", "line 2"] and skipped == 0
+    ring = ring_of(4, 10)
+    messages, skipped = ring.read(3, 2) # 3 to 5 were overwritten
+    assert lines(messages) == ["line 6", "line 7"] and skipped == 3
+    assert ring.read(10, 5) == ([], 0)
+
+def test_lagging_connection_counts_overwritten_broadcasts_as_dropped():
+    conn = Connection(None, None)
+    conn.ring, conn.ring_cursor = ring_of(4, 10), 0
+    assert conn.pending_broadcasts() == 4 and conn.dropped_messages() == 6 # counted before they are skipped
+    with conn.lock:
+        assert conn.catch_up()
+    assert [bytes(data).decode() for data in conn.outbound] == [f"line {i}" for i in range(6, 10)]
+    assert conn.outbound_dropped == conn.dropped_messages() == 6 and conn.pending_broadcasts() == 0
+    with conn.lock:
+        assert not conn.catch_up()
+
+def test_stalled_member_of_a_large_channel_drops_what_the_ring_overwrote(start_server, clients):
+    server = start_server(env={"CHATSERVER_LARGE_CHANNEL": 2, "CHATSERVER_BROADCAST_RING": 64})
+    slow = stalled_client(server.ports["c1"], "slow")
+    assert server.wait_for_line("slow has joined")
+    talker = FramedClient(server.ports["c1"], "talker")
+    reader = FramedClient(server.ports["c1"], "reader")
+    clients += [talker, reader]
+    assert server.wait_for_line("reader has joined")
+
+    stop = threading.Event()
+    threads = [threading.Thread(target=keep_reading, args=(client, stop)) for client in (talker, reader)]
+    for thread in threads:
+        thread.start()
+    try:
+        for i in range(LINES):
+            talker.sock.sendall(encode_frame(TEXT, f"{i} {LINE}"))
+        assert server.wait_for_line(f"[talker] {LINES - 1} ", timeout=20)
+        assert wait_for(lambda: talker_lines(reader) == LINES, timeout=20) # members that keep up lose nothing
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    dropped, coalesced = outbound_counters(server, "slow")
+    assert dropped > 0 and coalesced == 0 # skipped in the ring, whatever the slow client policy
+    assert "slow has left" not in server.output()
+    slow.close()
+
+def test_reload_across_the_large_channel_threshold(start_server, clients):
+    # Members keep every broadcast, in order and once, as /reload gives the channel a ring and takes it away
+    server = start_server(channels=(("c1", 3),), env={"CHATSERVER_LARGE_CHANNEL": 4})
+    alice = FramedClient(server.ports["c1"], "alice")
+    bob = FramedClient(server.ports["c1"], "bob")
+    clients += [alice, bob]
+    assert server.wait_for_line("bob has joined") and alice.wait_for("You have joined")
+    sent = 0
+    for capacity in (5, 3, 6, 2):
+        for _ in range(5):
+            alice.send(f"line {sent}")
+            sent += 1
+        server.write_config((("c1", capacity),))
+        server.admin("/reload")
+        assert server.wait_for_line(f'Channel "c1" now has a capacity of {capacity}.')
+    alice.send(f"line {sent}")
+    assert bob.wait_for(f"[alice] line {sent}")
+    received = [payload.decode() for _, payload in bob.frames if payload.startswith(b"[alice] ")]
+    assert received == [f"[alice] line {i}" for i in range(sent + 1)]
@@ -0,0 +1,67 @@
+import threading
+
+from chatserver import Channel, lock_channels
+from conftest import PlainClient
+
+class RecordingLock:
+    def __init__(self, name, entered):
+        self.name, self.entered = name, entered
+
+    def __enter__(self):
+        self.entered.append(self.name)
+
+    def __exit__(self, *exc_info):
+        self.entered.append(f"/{self.name}")
+
+def test_channels_are_locked_in_creation_order():
+    entered = []
+    first, second, third = (Channel(name, 0, 5, None) for name in ("c1", "c2", "c3"))
+    for channel in (first, second, third):
+        channel.lock = RecordingLock(channel.name, entered)
+    with lock_channels(third, first, second):
+        assert entered == ["c1", "c2", "c3"]
+    assert entered[3:] == ["/c3", "/c2", "/c1"]
+
+    entered.clear()
+    with lock_channels(second, second): # a /switch to the channel the client is in
+        pass
+    assert entered == ["c2", "/c2"]
+
+def test_crossing_switches_do_not_deadlock(start_server, clients):
+    # Clients of c1 and c2 switching into each other's channel at once lock the same two channels
+    server = start_server(channels=(("c1", 8), ("c2", 8)))
+    movers = {PlainClient(server.ports[channel], f"{channel}-{i}"): channel for channel in ("c1", "c2") for i in range(4)}
+    clients += movers
+    assert all(client.wait_for("You have joined") for client in movers)
+    for _ in range(3):
+        for client, channel in movers.items():
+            client.received = ""
+            movers[client] = "c2" if channel == "c1" else "c1"
+        threads = [threading.Thread(target=client.send, args=(f"/switch {channel}",)) for client, channel in movers.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for client, channel in movers.items():
+            assert client.wait_for(f'You have joined the channel "{channel}".'), client.received
+    client = next(iter(movers))
+    client.send("/list")
+    assert client.wait_for(f"[Channel] c2 {server.ports['c2']} Capacity: 4/8, Queue: 0")
+
+def test_racing_switches_of_one_username(start_server, clients):
+    # Two alices switching into the same channel at once: exactly one gets in
+    server = start_server(channels=(("c1", 5), ("c2", 5), ("c3", 5)))
+    first = PlainClient(server.ports["c1"], "alice")
+    second = PlainClient(server.ports["c3"], "alice")
+    clients += [first, second]
+    assert first.wait_for("You have joined") and second.wait_for("You have joined")
+    first.received = second.received = ""
+    threads = [threading.Thread(target=client.send, args=("/switch c2",)) for client in (first, second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    joined = '[Server Message] You have joined the channel "c2".'
+    refused = '[Server Message] Channel "c2" already has user alice.'
+    assert first.wait_for("c2") and second.wait_for("c2")
+    assert sorted((joined in client.received, refused in client.received) for client in (first, second)) == [(False, True), (True, False)]
@@ -0,0 +1,76 @@
+import os
+import zlib
+
+import pytest
+
+from chatprotocol import (COMPRESS_MIN_SIZE, COMPRESSED, CONTROL, FILE_DATA, HEADER, MAX_FRAME_SIZE, TEXT, Compressor, FrameDecoder,
+                          ProtocolError, encode_frame, encode_hello, encode_hello_reply, is_hello_reply, parse_hello, parse_hello_reply,
+                          split_transfer_id)
+
+def test_frames_split_across_and_within_reads():
+    data = encode_frame(TEXT, "hello") + encode_frame(CONTROL, "[FileSize] 3") + encode_frame(FILE_DATA, b"\0\1\2")
+    decoder = FrameDecoder()
+    frames = []
+    for i in range(len(data)):
+        frames += decoder.feed(data[i:i + 1])
+    assert frames == [(TEXT, b"hello"), (CONTROL, b"[FileSize] 3"), (FILE_DATA, b"\0\1\2")]
+    assert FrameDecoder().feed(data) == frames
+
+def test_oversized_frame_is_a_protocol_error():
+    with pytest.raises(ProtocolError):
+        FrameDecoder().feed(HEADER.pack(MAX_FRAME_SIZE + 1, TEXT))
+
+def test_hello_round_trip():
+    assert parse_hello(b"alice") == ("alice", None, None, ())
+    assert parse_hello(encode_hello("alice")) == ("alice", 2, None, ())
+    assert parse_hello(encode_hello("alice", versions=(1,))) == ("alice", 1, None, ())
+    assert parse_hello(encode_hello("alice", versions=(9,))) == ("alice", None, None, ())
+    assert parse_hello(encode_hello("alice", channel="c2", codecs=("zlib",))) == ("alice", 2, "c2", ("zlib",))
+    assert parse_hello(b"alice\0\0c2") == ("alice", None, "c2", ())
+
+def test_hello_reply():
+    reply = encode_hello_reply(2, "zlib")
+    assert is_hello_reply(reply) and not is_hello_reply(b"Welcome to chatclient, alice.")
+    assert parse_hello_reply(reply[HEADER.size:]) == (2, "zlib")
+    assert parse_hello_reply(encode_hello_reply(1)[HEADER.size:]) == (1, None)
+
+def test_split_transfer_id():
+    assert split_transfer_id("[Client Message] Ready 7") == ("[Client Message] Ready", 7)
+    assert split_transfer_id("[Client Message] Ready") == ("[Client Message] Ready", None)
+
+def test_compressed_stream_across_frames():
+    compressor, decoder = Compressor(), FrameDecoder()
+    decoder.start_inflating()
+    frames = [encode_frame(TEXT, f"the same phrase again and again, message {i}") for i in range(50)]
+    wire = b"".join(compressor.compress(frame) for frame in frames)
+    assert len(wire) < len(b"".join(frames)) / 2
+    assert decoder.feed(wire) == [(TEXT, frame[HEADER.size:]) for frame in frames]
+
+def test_small_and_incompressible_data_is_not_compressed():
+    compressor = Compressor()
+    small = encode_frame(TEXT, "hi")
+    assert len(small) < COMPRESS_MIN_SIZE and compressor.compress(small) == small
+    random_data = encode_frame(FILE_DATA, os.urandom(20000))
+    assert compressor.compress(random_data) == random_data
+    assert compressor.raw_bytes == 0
+
+def test_compressed_frame_without_agreement_is_a_protocol_error():
+    with pytest.raises(ProtocolError):
+        FrameDecoder().feed(encode_frame(COMPRESSED, zlib.compress(b"x")))
+
+def test_stream_continues_with_window_and_new_compressor():
+    # What a /switch into another worker does: the new owner inflates with the last window of the
+    # client's stream, and its own new compressor starts a stream the client's inflater continues
+    client, server = Compressor(), FrameDecoder()
+    server.start_inflating(keep_window=True)
+    line = encode_frame(TEXT, "a line that repeats itself across the handoff, " * 2)
+    server.feed(client.compress(line))
+
+    new_owner = FrameDecoder()
+    new_owner.start_inflating(bytes(server.window), keep_window=True)
+    assert new_owner.feed(client.compress(line)) == [(TEXT, line[HEADER.size:])]
+
+    receiver = FrameDecoder()
+    receiver.start_inflating()
+    receiver.feed(Compressor().compress(line))
+    assert receiver.feed(Compressor().compress(line)) == [(TEXT, line[HEADER.size:])]
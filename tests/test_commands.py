@@ -0,0 +1,147 @@
+import socket
+import time
+
+from chatprotocol import TEXT, encode_frame
+from conftest import TIMEOUT, FramedClient, PlainClient
+
+# Every test runs in thread and event loop mode (the mode fixture), the replies must be the same in both
+
+def test_list(start_server, clients):
+    server = start_server(channels=(("c1", 2), ("c2", 3)))
+    alice = PlainClient(server.ports["c1"], "alice")
+    bob = PlainClient(server.ports["c1"], "bob")
+    clients += [alice, bob]
+    assert server.wait_for_line("bob has joined")
+    carol = PlainClient(server.ports["c1"], "carol")
+    clients.append(carol)
+    assert carol.wait_for("You are in the waiting queue")
+    alice.send("/list")
+    assert alice.wait_for(f"[Channel] c2 {server.ports['c2']} Capacity: 0/3, Queue: 0")
+    assert f"[Channel] c1 {server.ports['c1']} Capacity: 2/2, Queue: 1" in alice.received
+    carol.send("/list") # queued clients can list too
+    assert carol.wait_for(f"[Channel] c1 {server.ports['c1']} Capacity: 2/2, Queue: 1")
+
+def test_whisper(start_server, clients):
+    server = start_server()
+    alice = PlainClient(server.ports["c1"], "alice")
+    bob = PlainClient(server.ports["c1"], "bob")
+    carol = PlainClient(server.ports["c1"], "carol")
+    clients += [alice, bob, carol]
+    assert all(client.wait_for("You have joined") for client in (alice, bob, carol))
+
+    alice.send("/whisper bob psst")
+    assert bob.wait_for("[alice whispers to you] psst")
+    assert alice.wait_for("[alice whispers to bob] psst")
+    assert server.wait_for_line("[alice whispers to bob] psst")
+    assert "psst" not in carol.receive()
+    alice.send("/whisper dave psst")
+    assert alice.wait_for("[Server Message] dave is not in the channel.")
+
+def test_switch(start_server, clients):
+    server = start_server(channels=(("c1", 5), ("c2", 5)))
+    alice = PlainClient(server.ports["c1"], "alice")
+    bob = PlainClient(server.ports["c2"], "bob")
+    carol = PlainClient(server.ports["c1"], "bob")
+    clients += [alice, bob, carol]
+    assert all(client.wait_for("You have joined") for client in (alice, bob, carol))
+
+    alice.send("/switch c3")
+    assert alice.wait_for('[Server Message] Channel "c3" does not exist.')
+    carol.send("/switch c2")
+    assert carol.wait_for('[Server Message] Channel "c2" already has user bob.')
+    alice.send("/switch c2")
+    assert alice.wait_for('[Server Message] You have joined the channel "c2".')
+    assert server.wait_for_line('alice has left the channel.')
+    alice.send("hello c2")
+    assert bob.wait_for("[alice] hello c2")
+    assert "hello c2" not in carol.receive()
+
+def test_send_to_someone_not_in_the_channel(start_server, clients):
+    server = start_server()
+    alice = PlainClient(server.ports["c1"], "alice")
+    clients.append(alice)
+    assert alice.wait_for("You have joined")
+    alice.send("/send alice notes.txt")
+    assert alice.wait_for("[Server Message] Cannot send file to yourself.")
+    alice.send("/send bob notes.txt")
+    assert alice.wait_for("[Server Message] bob is not in the channel.")
+
+def test_queue_promotion(start_server, clients):
+    server = start_server(channels=(("c1", 1),))
+    alice = PlainClient(server.ports["c1"], "alice")
+    clients.append(alice)
+    assert alice.wait_for("You have joined")
+    bob = PlainClient(server.ports["c1"], "bob")
+    clients.append(bob)
+    assert bob.wait_for("You are in the waiting queue")
+    carol = PlainClient(server.ports["c1"], "carol")
+    clients.append(carol)
+    assert bob.wait_for("You are in the waiting queue and there are 0 user(s) ahead of you.")
+    assert carol.wait_for("You are in the waiting queue and there are 1 user(s) ahead of you.")
+
+    alice.send("/quit")
+    assert bob.wait_for('[Server Message] You have joined the channel "c1".')
+    assert carol.wait_for("You are in the waiting queue and there are 0 user(s) ahead of you.")
+    bob.send("/quit")
+    assert carol.wait_for('[Server Message] You have joined the channel "c1".')
+
+def test_afk_eviction(start_server, clients):
+    server = start_server(channels=(("c1", 2),), afk_time=1)
+    alice = PlainClient(server.ports["c1"], "alice")
+    bob = PlainClient(server.ports["c1"], "bob")
+    clients += [alice, bob]
+    assert server.wait_for_line("bob has joined")
+    carol = PlainClient(server.ports["c1"], "carol")
+    clients.append(carol)
+    assert carol.wait_for("You are in the waiting queue") # queued clients never go AFK
+    for _ in range(5): # bob keeps talking past the AFK time
+        bob.send("still here")
+        time.sleep(0.4)
+    assert alice.wait_for('[Server Message] alice went AFK in channel "c1".')
+    assert bob.wait_for('[Server Message] alice went AFK in channel "c1".')
+    alice.close() # what chatclient does on its AFK message
+    assert carol.wait_for('You have joined the channel "c1".')
+    assert "bob went AFK" not in bob.receive() and not bob.closed
+
+def test_missing_arguments_get_usage(start_server, clients):
+    # chatclient checks these before sending, a client that does not must get an answer, not crash the server
+    server = start_server()
+    alice = PlainClient(server.ports["c1"], "alice")
+    clients.append(alice)
+    assert alice.wait_for("You have joined")
+    for command, usage in (("/whisper", "/whisper receiver_client_username chat_message"), ("/whisper bob", "/whisper receiver_client_username chat_message"),
+                           ("/send", "/send target_client_username file_path"), ("/send bob", "/send target_client_username file_path"),
+                           ("/switch", "/switch channel_name"), ("/history \u00b2", "/history message_count")): # a digit int() does not take
+        alice.received = ""
+        alice.send(command)
+        assert alice.wait_for(f"[Server Message] Usage: {usage}"), command
+    alice.send("still here")
+    assert alice.wait_for("[alice] still here")
+
+def test_undecodable_input_drops_only_that_client(start_server, clients):
+    server = start_server(channels=(("c1", 2),))
+    alice = PlainClient(server.ports["c1"], "alice")
+    bob = FramedClient(server.ports["c1"], "bob")
+    clients += [alice, bob]
+    assert server.wait_for_line("bob has joined")
+    carol = PlainClient(server.ports["c1"], "carol")
+    clients.append(carol)
+    assert carol.wait_for("You are in the waiting queue")
+
+    alice.sock.sendall(b"\xff\xfe")
+    assert alice.wait_for_close()
+    assert carol.wait_for('You have joined the channel "c1".')
+    bob.sock.sendall(encode_frame(TEXT, b"\xff\xfe"))
+    assert bob.wait_for_close()
+
+    eve = socket.create_connection(("localhost", server.ports["c1"])) # not even the username decodes
+    eve.sendall(b"\xff\xfe")
+    eve.settimeout(TIMEOUT)
+    assert eve.recv(100) == b""
+    eve.close()
+
+    dave = PlainClient(server.ports["c1"], "dave") # the server still accepts and serves clients
+    clients.append(dave)
+    assert dave.wait_for("You have joined")
+    dave.send("hello")
+    assert carol.wait_for("[dave] hello")
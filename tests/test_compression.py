@@ -0,0 +1,39 @@
+from conftest import FramedClient
+
+LINE = "the quick brown fox jumps over the lazy dog, line {}"
+
+def test_compression_is_negotiated(start_server, clients):
+    server = start_server()
+    alice = FramedClient(server.ports["c1"], "alice", codecs=("zlib",))
+    clients.append(alice)
+    assert alice.wait_for("Welcome to chatclient, alice.")
+    assert (alice.version, alice.codec) == (2, "zlib")
+
+def test_compression_off(start_server, clients):
+    server = start_server(env={"CHATSERVER_COMPRESSION": "off"})
+    alice = FramedClient(server.ports["c1"], "alice", codecs=("zlib",))
+    clients.append(alice)
+    assert alice.wait_for("Welcome to chatclient, alice.")
+    assert alice.codec is None
+
+def test_compressed_chat(start_server, clients):
+    server = start_server()
+    alice = FramedClient(server.ports["c1"], "alice", codecs=("zlib",))
+    bob = FramedClient(server.ports["c1"], "bob", codecs=("zlib",))
+    clients += [alice, bob]
+    assert server.wait_for_line("bob has joined") and bob.wait_for("Welcome")
+    for i in range(20):
+        alice.send(LINE.format(i))
+    assert bob.wait_for("[alice] " + LINE.format(19))
+    assert all(f"[alice] {LINE.format(i)}" in bob.received for i in range(20))
+
+def test_silent_member_of_large_channel_gets_last_line(start_server, clients):
+    # Ring-buffered broadcasts must all be flushed to a member that never sends anything
+    server = start_server(channels=(("big", 4),), env={"CHATSERVER_LARGE_CHANNEL": 2})
+    sender = FramedClient(server.ports["big"], "sender", codecs=("zlib",))
+    silent = FramedClient(server.ports["big"], "silent", codecs=("zlib",))
+    clients += [sender, silent]
+    assert server.wait_for_line("silent has joined") and silent.wait_for("Welcome")
+    for i in range(5):
+        sender.send(LINE.format(i))
+        assert silent.wait_for("[sender] " + LINE.format(i), timeout=2), silent.received
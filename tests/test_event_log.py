@@ -0,0 +1,62 @@
+import io
+import json
+import time
+
+import pytest
+
+import chatserver
+from chatprotocol import TEXT, encode_frame
+from chatserver import EventLog
+from conftest import TIMEOUT, FramedClient, PlainClient, wait_for
+
+def test_lines_before_start_are_written_straight_away():
+    stream = io.StringIO()
+    log = EventLog(stream)
+    log.write("first")
+    assert stream.getvalue() == "first\n"
+    log.start()
+    for i in range(100):
+        log.write(f"line {i}")
+    log.close()
+    assert stream.getvalue() == "first\n" + "".join(f"line {i}\n" for i in range(100))
+
+def test_json_lines(monkeypatch):
+    monkeypatch.setattr(chatserver, "LOG_FORMAT", "json")
+    stream = io.StringIO()
+    EventLog(stream).write("[alice] hi", "chat", channel="c1", user="alice")
+    line = json.loads(stream.getvalue())
+    assert line.pop("time") == pytest.approx(chatserver.time.time(), abs=5)
+    assert line == {"event": "chat", "channel": "c1", "user": "alice", "message": "[alice] hi"}
+
+def test_json_format(start_server, clients):
+    server = start_server(env={"CHATSERVER_LOG_FORMAT": "json"})
+    alice = PlainClient(server.ports["c1"], "alice")
+    bob = PlainClient(server.ports["c1"], "bob")
+    clients += [alice, bob]
+    assert server.wait_for_line('"event": "join"') and bob.wait_for("You have joined")
+    alice.send("hello")
+    assert bob.wait_for("[alice] hello")
+    alice.send("/quit")
+    assert server.wait_for_line('"event": "leave"')
+    lines = [json.loads(line) for line in server.lines] # every line is json, startup included
+    assert lines[0]["event"] == "server" and lines[0]["message"].startswith('Channel "c1" is created')
+    events = [(line["event"], line.get("user"), line["message"]) for line in lines if line["event"] != "server"]
+    assert ("chat", "alice", "[alice] hello") in events
+    assert ("leave", "alice", "[Server Message] alice has left the channel.") in events
+    assert all(line["channel"] == "c1" for line in lines if line["event"] in ("join", "chat", "leave"))
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_shutdown_writes_every_queued_line(start_server, clients, workers):
+    # With a long flush interval the last chat lines are still queued when /shutdown comes
+    server = start_server(env={"CHATSERVER_LOG_FLUSH_INTERVAL": 2, "CHATSERVER_WORKERS": workers})
+    talker = FramedClient(server.ports["c1"], "talker")
+    clients.append(talker)
+    assert talker.wait_for("You have joined")
+    talker.sock.sendall(b"".join(encode_frame(TEXT, f"line {i}") for i in range(500)))
+    assert talker.wait_for("[talker] line 499")
+    time.sleep(0.2) # the server logs each line after sending it
+    server.admin("/shutdown")
+    assert server.process.wait(TIMEOUT) == 0
+    assert wait_for(lambda: server.lines and server.lines[-1] == "[Server Message] Server shuts down.")
+    chat = [line for line in server.lines if line.startswith("[talker] ")]
+    assert chat == [f"[talker] line {i}" for i in range(500)]
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import time
+import zlib
+
+import pytest
+
+from chatprotocol import CONTROL, FILE_CHUNK_SIZE, FILE_DATA, FILE_DATA_HEADER
+from conftest import FramedClient, PlainClient, chatclient, wait_for
+
+FILE = "".join(f"file line {i}\n" for i in range(200))
+
+def test_unframed_upload_in_one_write(start_server, clients):
+    # "[FileSize] <size>" and the first file bytes arriving in one recv must not leak into the channel as chat
+    server = start_server()
+    alice = PlainClient(server.ports["c1"], "alice")
+    bob = PlainClient(server.ports["c1"], "bob")
+    carol = PlainClient(server.ports["c1"], "carol")
+    clients += [alice, bob, carol]
+    assert server.wait_for_line("carol has joined")
+
+    alice.send("/send bob notes.txt")
+    assert alice.wait_for("Start transmission.")
+    alice.send(f"[FileSize] {len(FILE)}{FILE}")
+    assert bob.wait_for(f"FileSize notes.txt {len(FILE)}")
+    bob.send("[Client Message] Ready")
+    assert bob.wait_for(FILE.rstrip("\n"))
+    bob.send("[Client Message] Received")
+    time.sleep(0.3)
+
+    assert "file line" not in carol.receive()
+    assert "file line" not in server.output()
+
+@pytest.mark.parametrize("compression", ["zlib", "off"])
+@pytest.mark.parametrize("size", [0, 100000, 3000000])
+def test_chatclient_send(start_server, tmp_path, compression, size):
+    server = start_server()
+    env = {"CHATCLIENT_COMPRESSION": compression}
+    alice = chatclient(server.ports["c1"], "alice", tmp_path / "alice", env)
+    bob = chatclient(server.ports["c1"], "bob", tmp_path / "bob", env)
+    try:
+        assert server.wait_for_line("bob has joined")
+        data = (FILE * (size // len(FILE) + 1)).encode()[:size // 2] + os.urandom(size - size // 2) # compressible, then not
+        (tmp_path / "alice" / "blob.bin").write_bytes(data)
+        alice.stdin.write("/send bob blob.bin\n")
+        alice.stdin.flush()
+        assert server.wait_for_line('alice sent "blob.bin" to bob.', timeout=30)
+        assert (tmp_path / "bob" / "blob.bin").read_bytes() == data
+    finally:
+        for client in (alice, bob):
+            client.kill()
+            client.wait()
+
+def control_messages(client):
+    return [payload.decode() for frame_type, payload in client.frames if frame_type == CONTROL]
+
+def test_resume_from_the_offset_the_target_has(start_server, clients):
+    server = start_server()
+    alice = FramedClient(server.ports["c1"], "alice")
+    bob = FramedClient(server.ports["c1"], "bob")
+    clients += [alice, bob]
+    assert server.wait_for_line("bob has joined") and alice.wait_for("Welcome")
+    data = os.urandom(300000)
+    kept = 100000 # what bob still has of an earlier, interrupted transfer
+
+    alice.send("/send bob blob.bin")
+    assert alice.wait_for("Start transmission. blob.bin ")
+    transfer_id = int(control_messages(alice)[-1].split()[-1])
+    alice.send(f"[FileSize] {len(data)} {hashlib.sha256(data).hexdigest()} {transfer_id}", CONTROL)
+    assert bob.wait_for(f"[Server Message] FileSize blob.bin {len(data)} {hashlib.sha256(data).hexdigest()} {transfer_id}")
+    bob.send(f"[Client Message] Ready {kept} {transfer_id}", CONTROL)
+    assert alice.wait_for(f"[Server Message] Resume {kept} {transfer_id}")
+
+    for offset in range(kept, len(data), FILE_CHUNK_SIZE):
+        chunk = data[offset:offset + FILE_CHUNK_SIZE]
+        alice.send(FILE_DATA_HEADER.pack(transfer_id, zlib.crc32(chunk)) + chunk, FILE_DATA)
+    received = bytearray()
+    def all_received():
+        bob.receive()
+        received[:] = b"".join(payload[FILE_DATA_HEADER.size:] for frame_type, payload in bob.frames if frame_type == FILE_DATA)
+        return len(received) >= len(data) - kept
+    assert wait_for(all_received, timeout=10)
+    assert bytes(received) == data[kept:]
+    for frame_type, payload in bob.frames:
+        if frame_type == FILE_DATA:
+            chunk_id, crc = FILE_DATA_HEADER.unpack_from(payload)
+            assert chunk_id == transfer_id and crc == zlib.crc32(payload[FILE_DATA_HEADER.size:])
+    bob.send(f"[Client Message] Received {transfer_id}", CONTROL)
+    assert server.wait_for_line('alice sent "blob.bin" to bob.')
@@ -0,0 +1,86 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from chatprotocol import CONTROL, TEXT, encode_frame
+from conftest import TIMEOUT, FramedClient, PlainClient, chatclient
+
+def test_plain_client(start_server, clients):
+    server = start_server()
+    alice = PlainClient(server.ports["c1"], "alice")
+    clients.append(alice)
+    assert alice.wait_for('Welcome to chatclient, alice.[Server Message] You have joined the channel "c1".')
+
+def test_framed_client_gets_a_hello(start_server, clients):
+    server = start_server()
+    alice = FramedClient(server.ports["c1"], "alice")
+    clients.append(alice)
+    assert alice.wait_for("Welcome to chatclient, alice.")
+    assert (alice.version, alice.codec) == (2, None)
+    assert alice.frames[0] == (TEXT, b"Welcome to chatclient, alice.")
+
+def test_unknown_version_falls_back_to_plain_text(start_server, clients):
+    server = start_server()
+    alice = PlainClient(server.ports["c1"], "alice\0framed/9")
+    clients.append(alice)
+    assert alice.wait_for("Welcome to chatclient, alice.")
+    assert alice.received.startswith("Welcome") # no HELLO frame
+
+def test_framed_and_plain_clients_chat(start_server, clients):
+    server = start_server()
+    alice = FramedClient(server.ports["c1"], "alice")
+    bob = PlainClient(server.ports["c1"], "bob")
+    clients += [alice, bob]
+    assert server.wait_for_line("bob has joined")
+    alice.sock.sendall(encode_frame(TEXT, "one") + encode_frame(TEXT, "two") + encode_frame(TEXT, "/list"))
+    assert alice.wait_for("[Channel] c1")
+    assert (TEXT, b"[alice] one") in alice.frames and (TEXT, b"[alice] two") in alice.frames
+    assert bob.wait_for("[alice] two")
+    bob.send("hi alice")
+    assert alice.wait_for("[bob] hi alice")
+
+@pytest.mark.parametrize("version", [1, 2])
+def test_transfers_have_ids_from_version_2(start_server, clients, version):
+    server = start_server()
+    alice = FramedClient(server.ports["c1"], "alice", versions=(version,))
+    bob = PlainClient(server.ports["c1"], "bob")
+    clients += [alice, bob]
+    assert server.wait_for_line("bob has joined") and alice.wait_for("Welcome")
+    assert alice.version == version
+    alice.send("/send bob notes.txt")
+    assert alice.wait_for("Start transmission.")
+    control = [payload.decode() for frame_type, payload in alice.frames if frame_type == CONTROL]
+    if version == 1:
+        assert control == ["[Server Message] Start transmission."]
+    else:
+        assert len(control) == 1 and control[0].startswith("[Server Message] Start transmission. notes.txt ")
+
+def test_chatclient_joins_a_server_from_before_framing(tmp_path):
+    # What the original server does with a handshake: the whole first recv is the username
+    listener = socket.create_server(("localhost", 0))
+    usernames = []
+    def serve():
+        for _ in range(2):
+            sock, _ = listener.accept()
+            with sock:
+                username = sock.recv(1024).decode().strip()
+                usernames.append(username)
+                sock.sendall(f"Welcome to chatclient, {username}.".encode())
+                time.sleep(0.1)
+                sock.sendall(b'[Server Message] You have joined the channel "c1".')
+                sock.recv(1024) # until the client goes
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+
+    client = chatclient(listener.getsockname()[1], "alice", tmp_path)
+    try:
+        assert client.stdout.readline() == "Welcome to chatclient, alice.\n"
+        assert client.stdout.readline() == '[Server Message] You have joined the channel "c1".\n'
+        assert usernames[-1] == "alice" and "\0" in usernames[0]
+    finally:
+        client.kill()
+        client.wait()
+        thread.join(TIMEOUT)
+        listener.close()
@@ -0,0 +1,36 @@
+import pytest
+
+from conftest import FramedClient, PlainClient
+
+@pytest.mark.parametrize("codecs", [(), ("zlib",)])
+def test_history_replay_and_command(start_server, clients, codecs):
+    server = start_server(env={"CHATSERVER_HISTORY_REPLAY": 3})
+    alice = PlainClient(server.ports["c1"], "alice")
+    clients.append(alice)
+    assert alice.wait_for("Welcome")
+    for i in range(5):
+        alice.send(f"message number {i} for the history")
+        assert server.wait_for_line(f"[alice] message number {i}")
+
+    bob = FramedClient(server.ports["c1"], "bob", codecs=codecs)
+    clients.append(bob)
+    assert bob.wait_for("[alice] message number 4 for the history")
+    assert "message number 1" not in bob.received
+    assert [payload.decode() for _, payload in bob.frames[-3:]] == [f"[alice] message number {i} for the history" for i in (2, 3, 4)]
+
+    bob.frames.clear()
+    bob.send("/history 2")
+    assert bob.wait_for("[alice] message number 4")
+    assert [payload.decode() for _, payload in bob.frames] == [f"[alice] message number {i} for the history" for i in (3, 4)]
+
+def test_history_for_unframed_client(start_server, clients):
+    server = start_server(env={"CHATSERVER_HISTORY_REPLAY": 2})
+    alice = PlainClient(server.ports["c1"], "alice")
+    clients.append(alice)
+    assert alice.wait_for("Welcome")
+    for i in range(3):
+        alice.send(f"line {i}")
+        assert server.wait_for_line(f"[alice] line {i}")
+    bob = PlainClient(server.ports["c1"], "bob")
+    clients.append(bob)
+    assert bob.wait_for("[alice] line 1\n[alice] line 2")
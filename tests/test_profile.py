@@ -0,0 +1,48 @@
+import os
+import re
+import time
+
+from conftest import PlainClient, wait_for
+
+def profile(server, command="/profile"):
+    # The [Profile] lines one admin command logs
+    server.lines.clear()
+    server.admin(command)
+    assert server.wait_for_line("[Profile]")
+    if command == "/profile": # a report is several lines, give the last of them time to arrive
+        time.sleep(0.3)
+    return [line for line in server.lines if line.startswith("[Profile]")]
+
+def test_profile_on_off_and_reset(start_server, clients, tmp_path):
+    server = start_server(channels=(("c1", 5), ("c2", 5)))
+    assert profile(server) == ["[Profile] Stopped", "[Profile] lock c1 Wait: -; Hold: -", "[Profile] lock c2 Wait: -; Hold: -"]
+    assert profile(server, "/profile on") == ["[Profile] Started, stack samples go to chatserver-stacks.txt."]
+    assert profile(server, "/profile on") == ["[Profile] Already running, stack samples go to chatserver-stacks.txt."]
+
+    alice = PlainClient(server.ports["c1"], "alice")
+    clients.append(alice)
+    assert alice.wait_for("You have joined")
+    for i in range(3):
+        alice.send(f"line {i}")
+        assert alice.wait_for(f"[alice] line {i}")
+    report = profile(server)
+    assert report[0] == "[Profile] Running"
+    assert re.match(r"\[Profile\] lock c1 Wait: \d+ x, p50/p99: .*; Hold: \d+ x, ", report[1])
+    assert report[2].startswith("[Profile] lock c2 Wait: ") # the report itself takes every channel lock
+    assert any(re.match(r"\[Profile\] handler print_message 3 x, p50/p99: \S+ms/\S+ms, total: ", line) for line in report)
+    assert any(line.startswith("[Profile] handler handle_message ") for line in report)
+
+    stacks = (tmp_path / "chatserver-stacks.txt").read_text().splitlines() # written by the report
+    assert stacks and all(re.match(r".+ \(\S+\.py\)(;.+)? \d+$", line) for line in stacks)
+    assert any("chatserver.py" in line for line in stacks)
+
+    assert profile(server, "/profile off") == ["[Profile] Stopped."]
+    assert profile(server, "/profile off") == ["[Profile] Not running."]
+    assert profile(server)[0] == "[Profile] Stopped" # what was recorded is kept until reset
+    assert profile(server, "/profile reset") == ["[Profile] Reset."]
+    assert profile(server) == ["[Profile] Stopped", "[Profile] lock c1 Wait: -; Hold: -", "[Profile] lock c2 Wait: -; Hold: -"]
+
+def test_profile_from_the_start(start_server, tmp_path):
+    server = start_server(env={"CHATSERVER_PROFILE": "on", "CHATSERVER_PROFILE_STACKS": tmp_path / "stacks.txt"})
+    assert profile(server)[0] == "[Profile] Running"
+    assert wait_for(lambda: os.path.exists(tmp_path / "stacks.txt"))
@@ -0,0 +1,52 @@
+from conftest import PlainClient
+
+QUEUED = "You are in the waiting queue and there are {} user(s) ahead of you."
+
+def fill_queue(server, clients, count):
+    # One member of c1 (capacity 1) and count queued clients, in order
+    member = PlainClient(server.ports["c1"], "member")
+    clients.append(member)
+    assert member.wait_for("You have joined")
+    queued = []
+    for i in range(count):
+        client = PlainClient(server.ports["c1"], f"q{i}")
+        clients.append(client)
+        assert client.wait_for(QUEUED.format(i))
+        queued.append(client)
+    return member, queued
+
+def test_position_updates_are_coalesced(start_server, clients):
+    server = start_server(channels=(("c1", 1),), env={"CHATSERVER_QUEUE_NOTIFY_INTERVAL": 0.5})
+    member, queued = fill_queue(server, clients, 5)
+    for client in queued:
+        client.received = ""
+    queued[0].close() # two leave within one interval
+    queued[2].close()
+    assert queued[4].wait_for(QUEUED.format(2))
+    assert queued[4].received.count("waiting queue") == 1 # not 3 first
+    assert queued[1].wait_for(QUEUED.format(0)) and queued[3].wait_for(QUEUED.format(1))
+    assert queued[1].received.count("waiting queue") == 1
+
+def test_pull_mode_answers_position_only_when_asked(start_server, clients):
+    server = start_server(channels=(("c1", 1),), env={"CHATSERVER_QUEUE_UPDATES": "pull"})
+    member, queued = fill_queue(server, clients, 3)
+    queued[2].received = ""
+    queued[0].close()
+    assert not queued[2].wait_for("waiting queue", timeout=0.5)
+    queued[2].send("/position")
+    assert queued[2].wait_for(QUEUED.format(1))
+
+    member.send("/quit") # promotion is still pushed
+    assert queued[1].wait_for('You have joined the channel "c1".')
+    queued[2].received = ""
+    queued[2].send("/position")
+    assert queued[2].wait_for(QUEUED.format(0))
+
+def test_position_in_push_mode(start_server, clients):
+    server = start_server(channels=(("c1", 1),))
+    member, queued = fill_queue(server, clients, 2)
+    queued[1].received = ""
+    queued[1].send("/position")
+    assert queued[1].wait_for(QUEUED.format(1))
+    member.send("/position") # only queued clients have a position, for members it is chat
+    assert member.wait_for("[member] /position")
@@ -0,0 +1,52 @@
+import os
+import signal
+import socket
+
+import pytest
+
+from conftest import PlainClient, free_ports
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_reload_applies_the_new_configuration(start_server, clients, workers):
+    server = start_server(channels=(("c1", 3), ("c2", 2), ("c3", 1)), env={"CHATSERVER_WORKERS": workers})
+    a, b, c = (PlainClient(server.ports["c1"], name) for name in "abc")
+    d = PlainClient(server.ports["c2"], "d")
+    e = PlainClient(server.ports["c3"], "e")
+    clients += [a, b, c, d, e]
+    assert server.wait_for_line("e has joined")
+
+    # c1 shrinks, c2 moves to another port, c3 goes and c4 is new
+    old_c2_port = server.ports["c2"]
+    server.ports["c2"], server.ports["c4"] = free_ports(2)
+    server.write_config((("c1", 1), ("c2", 2), ("c4", 1)))
+    server.admin("/reload")
+    assert server.wait_for_line("[Server Message] Configuration reloaded.")
+    assert b.wait_for("You are in the waiting queue and there are 0 user(s) ahead of you.")
+    assert c.wait_for("You are in the waiting queue and there are 1 user(s) ahead of you.")
+    assert e.wait_for("[Server Message] You are removed from the channel.")
+    assert "waiting queue" not in a.receive() and "removed" not in d.receive()
+    with pytest.raises(OSError):
+        socket.create_connection(("localhost", old_c2_port)).close()
+
+    f = PlainClient(server.ports["c2"], "f")
+    g = PlainClient(server.ports["c4"], "g")
+    clients += [f, g]
+    assert f.wait_for('You have joined the channel "c2".') and g.wait_for('You have joined the channel "c4".')
+    a.send("/list")
+    assert a.wait_for(f"[Channel] c4 {server.ports['c4']} Capacity: 1/1, Queue: 0")
+
+    server.write_config((("c1", 3), ("c2", 2), ("c4", 1)))
+    os.kill(server.process.pid, signal.SIGHUP)
+    assert b.wait_for('You have joined the channel "c1".') and c.wait_for('You have joined the channel "c1".')
+
+def test_invalid_configuration_changes_nothing(start_server, clients):
+    server = start_server()
+    alice = PlainClient(server.ports["c1"], "alice")
+    clients.append(alice)
+    assert server.wait_for_line("alice has joined")
+    with open(server.config, "w") as file:
+        file.write("channel c1 not_a_port 3\n")
+    server.admin("/reload")
+    assert server.wait_for_line("[Server Message] Invalid configuration file, nothing is reloaded.")
+    alice.send("still here")
+    assert alice.wait_for("[alice] still here")
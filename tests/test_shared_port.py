@@ -0,0 +1,28 @@
+import pytest
+
+from conftest import FramedClient, PlainClient
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_shared_port(start_server, clients, workers):
+    server = start_server(channels=(("c1", 2), ("c2", 1)), env={"CHATSERVER_SHARED_PORT": "{spare_port}", "CHATSERVER_WORKERS": workers})
+    assert server.wait_for_line(f"Every channel can be joined on port {server.spare_port}.")
+    alice = PlainClient(server.ports["c1"], "alice")
+    bob = PlainClient(server.spare_port, "bob", channel="c1")
+    carol = FramedClient(server.spare_port, "carol", channel="c2")
+    dave = PlainClient(server.spare_port, "dave", channel="c2")
+    clients += [alice, bob, carol, dave]
+
+    assert bob.wait_for('You have joined the channel "c1".')
+    assert carol.wait_for('You have joined the channel "c2".') and carol.version == 2
+    assert dave.wait_for("You are in the waiting queue and there are 0 user(s) ahead of you.")
+    bob.send("hi from the shared port")
+    assert alice.wait_for("[bob] hi from the shared port")
+
+@pytest.mark.parametrize("hello, reply", [("nobody\0\0nope", 'Channel "nope" does not exist.'),
+                                          ("nobody", "Name a channel to join on this port.")])
+def test_shared_port_needs_a_channel(start_server, clients, hello, reply):
+    server = start_server(env={"CHATSERVER_SHARED_PORT": "{spare_port}"})
+    client = PlainClient(server.spare_port, hello)
+    clients.append(client)
+    assert client.wait_for(reply)
+    assert client.wait_for_close()
@@ -0,0 +1,87 @@
+import re
+import socket
+import threading
+
+import pytest
+
+from chatprotocol import encode_frame, encode_hello, TEXT
+from conftest import FramedClient, wait_for
+
+LINES = 2000
+LINE = "x" * 4000 # enough in all to fill the kernel buffers of the stalled client
+
+def stalled_client(port, username):
+    # Joins and never reads, with a small receive buffer so its outbound queue fills quickly
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(("localhost", port))
+    sock.sendall(encode_hello(username))
+    return sock
+
+def talker_lines(client):
+    return sum(1 for _, payload in list(client.frames) if payload.startswith(b"[talker] "))
+
+def keep_reading(client, stop):
+    while not stop.is_set():
+        client.receive()
+
+def outbound_counters(server, username):
+    # (dropped, coalesced) from the last /outbound line of username
+    server.lines.clear()
+    server.admin("/outbound")
+    assert server.wait_for_line(f" {username} Depth:")
+    line = [line for line in server.lines if f" {username} Depth:" in line][-1]
+    return tuple(int(value) for value in re.search(r"Dropped: (\d+), Coalesced: (\d+)", line).groups())
+
+@pytest.mark.parametrize("policy", ["drop", "coalesce", "disconnect"])
+def test_slow_client_policy(start_server, clients, policy):
+    server = start_server(env={"CHATSERVER_SLOW_CLIENT_POLICY": policy, "CHATSERVER_OUTBOUND_LIMIT": 64})
+    slow = stalled_client(server.ports["c1"], "slow")
+    talker = FramedClient(server.ports["c1"], "talker")
+    reader = FramedClient(server.ports["c1"], "reader")
+    clients += [talker, reader]
+    assert server.wait_for_line("reader has joined")
+
+    stop = threading.Event()
+    threads = [threading.Thread(target=keep_reading, args=(client, stop)) for client in (talker, reader)]
+    for thread in threads:
+        thread.start()
+    try:
+        for i in range(LINES):
+            talker.sock.sendall(encode_frame(TEXT, f"{i} {LINE}"))
+        assert server.wait_for_line(f"[talker] {LINES - 1} ", timeout=20)
+        assert wait_for(lambda: talker_lines(reader) == LINES, timeout=20) # a client that keeps up loses nothing
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if policy == "disconnect":
+        assert server.wait_for_line("slow has left the channel.")
+    else:
+        assert "slow has left" not in server.output()
+        dropped, coalesced = outbound_counters(server, "slow")
+        assert (dropped if policy == "drop" else coalesced) > 0
+    assert "reader has left" not in server.output()
+    slow.close()
+
+def test_burst_from_one_recv_does_not_trip_the_policy(start_server, clients):
+    # Hundreds of short lines parsed from one recv are queued for every member before they are written
+    server = start_server(env={"CHATSERVER_SLOW_CLIENT_POLICY": "disconnect", "CHATSERVER_OUTBOUND_LIMIT": 64})
+    talker = FramedClient(server.ports["c1"], "talker")
+    reader = FramedClient(server.ports["c1"], "reader")
+    clients += [talker, reader]
+    assert server.wait_for_line("reader has joined")
+
+    stop = threading.Event()
+    threads = [threading.Thread(target=keep_reading, args=(client, stop)) for client in (talker, reader)]
+    for thread in threads:
+        thread.start()
+    try:
+        talker.sock.sendall(b"".join(encode_frame(TEXT, f"short line {i}") for i in range(LINES)))
+        assert wait_for(lambda: talker_lines(reader) == LINES, timeout=20)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    assert "has left" not in server.output()
@@ -0,0 +1,64 @@
+import re
+import urllib.error
+import urllib.request
+
+import pytest
+
+from chatserver import Histogram
+from conftest import PlainClient
+
+def test_histogram():
+    histogram = Histogram((1, 5, 10))
+    assert histogram.quantile(0.5) is None
+    for value in (0.5, 2, 3, 4, 20):
+        histogram.observe(value)
+    assert histogram.quantile(0.2) == 1 and histogram.quantile(0.5) == 5 and histogram.quantile(0.99) is not None
+    assert histogram.exposition("x", 'channel="c1"') == ['x_bucket{channel="c1",le="1"} 1', 'x_bucket{channel="c1",le="5"} 4', 'x_bucket{channel="c1",le="10"} 4',
+                                                         'x_bucket{channel="c1",le="+Inf"} 5', 'x_sum{channel="c1"} 29.5', 'x_count{channel="c1"} 5']
+    assert histogram.exposition("x")[-1] == "x_count 5"
+
+def busy_channel(server, clients):
+    # alice and bob in c1 (capacity 2), carol queued; alice says hello and whispers to bob
+    alice = PlainClient(server.ports["c1"], "alice")
+    bob = PlainClient(server.ports["c1"], "bob")
+    clients += [alice, bob]
+    assert alice.wait_for("You have joined") and bob.wait_for("You have joined")
+    carol = PlainClient(server.ports["c1"], "carol")
+    clients.append(carol)
+    assert carol.wait_for("waiting queue")
+    alice.send("hello")
+    assert bob.wait_for("[alice] hello")
+    alice.send("/whisper bob psst")
+    assert bob.wait_for("[alice whispers to you] psst")
+
+def test_stats(start_server, clients):
+    server = start_server(channels=(("c1", 2), ("c2", 3)))
+    busy_channel(server, clients)
+    server.admin("/stats")
+    assert server.wait_for_line("[Stats] server ")
+    # "hello" to both members, then the whisper: "psst" in, "[alice whispers to you] psst" out
+    assert "[Stats] c1 Clients: 2/2, Queue: 1, In: 2 (9 B), Out: 3 (54 B), Broadcast p50/p99: " in server.output()
+    assert "[Stats] c2 Clients: 0/3, Queue: 0, In: 0 (0 B), Out: 0 (0 B), Broadcast p50/p99: -/-, Queue wait p50/p99: -/-, AFK: 0" in server.output()
+    assert re.search(r"\[Stats\] server Connections: 3, Threads: \d+, Transfers: 0 sent, 0 failed, 0 B", server.output())
+
+def metrics(port, path="/metrics"):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=5) as response:
+        assert response.headers["Content-Type"].startswith("text/plain")
+        return response.read().decode()
+
+def test_prometheus_endpoint(start_server, clients):
+    server = start_server(channels=(("c1", 2),), env={"CHATSERVER_METRICS_PORT": "{spare_port}"})
+    busy_channel(server, clients)
+    text = metrics(server.spare_port)
+    samples = dict(line.rsplit(" ", 1) for line in text.splitlines() if not line.startswith("#"))
+    assert samples['chatserver_messages_in_total{channel="c1"}'] == "2"
+    assert samples['chatserver_messages_out_total{channel="c1"}'] == "3"
+    assert samples['chatserver_connected_clients{channel="c1"}'] == "2"
+    assert samples['chatserver_queue_depth{channel="c1"}'] == "1"
+    assert samples['chatserver_broadcast_seconds_count{channel="c1"}'] == samples['chatserver_broadcast_seconds_bucket{channel="c1",le="+Inf"}'] == "1"
+    assert samples["chatserver_connections"] == "3"
+    assert samples['chatserver_transfers_total{result="sent"}'] == "0"
+    assert "# TYPE chatserver_messages_in_total counter" in text and "# TYPE chatserver_queue_wait_seconds histogram" in text
+    with pytest.raises(urllib.error.HTTPError) as error:
+        metrics(server.spare_port, "/")
+    assert error.value.code == 404
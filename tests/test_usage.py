@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+USAGE_ERROR = 4
+
+@pytest.mark.parametrize("name, value", [
+    ("CHATSERVER_OUTBOUND_LIMIT", "abc"),
+    ("CHATSERVER_OUTBOUND_BYTES", "0"),
+    ("CHATSERVER_RELAY_WINDOW", "0"),
+    ("CHATSERVER_QUEUE_NOTIFY_INTERVAL", "-1"),
+    ("CHATSERVER_QUEUE_NOTIFY_INTERVAL", "nan"),
+    ("CHATSERVER_HISTORY_MESSAGES", "ten"),
+    ("CHATSERVER_ARCHIVE_SEGMENT_BYTES", "0"),
+    ("CHATSERVER_PROFILE_INTERVAL", "fast"),
+    ("CHATSERVER_LOG_FLUSH_INTERVAL", "-0.5"),
+    ("CHATSERVER_LOG_QUEUE_LIMIT", "0"),
+    ("CHATSERVER_MAX_CAPACITY", "1.5"),
+    ("CHATSERVER_COMPRESSION", "brotli"),
+])
+def test_invalid_environment_is_a_usage_error(tmp_path, name, value):
+    config = tmp_path / "config.txt"
+    config.write_text("channel c1 4455 3\n")
+    result = subprocess.run([sys.executable, os.path.join(ROOT, "chatserver.py"), str(config)], capture_output=True,
+                            text=True, timeout=10, env=dict(os.environ, **{name: value}))
+    assert result.returncode == USAGE_ERROR
+    assert result.stderr.startswith("Error: ") and "Traceback" not in result.stderr
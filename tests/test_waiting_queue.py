@@ -0,0 +1,69 @@
+import random
+
+from chatserver import WaitingQueue
+
+def queue_of(*usernames):
+    queue = WaitingQueue()
+    for username in usernames:
+        queue.put(username, f"{username}-socket")
+    return queue
+
+def assert_positions(queue, usernames):
+    assert list(queue) == usernames
+    assert [queue.position(username) for username in usernames] == list(range(len(usernames)))
+
+def test_put_and_pop_in_arrival_order():
+    queue = queue_of("a", "b", "c")
+    assert len(queue) == 3 and "b" in queue and "d" not in queue
+    assert queue.get("b") == "b-socket"
+    assert queue.pop() == ("a", "a-socket")
+    assert_positions(queue, ["b", "c"])
+    queue.put("d", "d-socket")
+    assert_positions(queue, ["b", "c", "d"])
+
+def test_remove_from_the_middle():
+    queue = queue_of("a", "b", "c", "d")
+    assert queue.remove("b") == "b-socket"
+    assert queue.remove("b") is None and queue.remove("nobody") is None
+    assert_positions(queue, ["a", "c", "d"])
+    assert list(queue.items()) == [("a", "a-socket"), ("c", "c-socket"), ("d", "d-socket")]
+
+def test_push_front():
+    queue = queue_of("a", "b")
+    queue.pop()
+    queue.push_front("z", "z-socket")
+    assert_positions(queue, ["z", "b"])
+    queue.put("c", "c-socket")
+    assert_positions(queue, ["z", "b", "c"])
+    assert queue.pop() == ("z", "z-socket")
+
+def test_renumbers_after_churn():
+    # Clients joining and leaving forever must not grow the tree without bound
+    queue = queue_of("a", "b")
+    for i in range(5000):
+        queue.put(f"c{i}", "c-socket")
+        queue.remove(f"c{i}")
+    assert len(queue.tree) <= 2 * len(queue) + 1024 + 1
+    queue.put("c", "c-socket")
+    assert_positions(queue, ["a", "b", "c"])
+
+def test_matches_a_list():
+    rng = random.Random(1)
+    queue, model = WaitingQueue(), []
+    for i in range(3000):
+        action = rng.random()
+        if action < 0.5 or not model:
+            queue.put(f"u{i}", i)
+            model.append(f"u{i}")
+        elif action < 0.7:
+            assert queue.pop()[0] == model.pop(0)
+        elif action < 0.95:
+            username = rng.choice(model)
+            queue.remove(username)
+            model.remove(username)
+        else:
+            queue.push_front(f"u{i}", i)
+            model.insert(0, f"u{i}")
+        if i % 100 == 0:
+            assert_positions(queue, model)
+    assert_positions(queue, model)
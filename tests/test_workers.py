@@ -0,0 +1,67 @@
+import os
+import signal
+import subprocess
+import time
+
+from conftest import FramedClient, PlainClient, wait_for
+
+def worker_pids(server):
+    # Worker n serves every n-th channel of the config file, and workers are forked in order
+    output = subprocess.run(["pgrep", "-P", str(server.process.pid)], capture_output=True, text=True).stdout
+    return sorted(int(pid) for pid in output.split())
+
+def test_switch_to_a_stalled_worker_holds_up_only_that_client(start_server, clients):
+    server = start_server(channels=(("c1", 5), ("c2", 5)), env={"CHATSERVER_WORKERS": 2})
+    alice = FramedClient(server.ports["c1"], "alice")
+    bob = PlainClient(server.ports["c1"], "bob")
+    clients += [alice, bob]
+    assert server.wait_for_line("bob has joined")
+    assert len(worker_pids(server)) == 2
+
+    owner = worker_pids(server)[1]
+    os.kill(owner, signal.SIGSTOP)
+    try:
+        alice.send("/switch c2")
+        alice.send("still here")
+        time.sleep(0.2)
+        bob.send("hello while alice waits") # the worker keeps serving c1, alice included
+        assert alice.wait_for("[bob] hello while alice waits", timeout=2)
+        assert "still here" not in bob.receive() # alice is not read until the answer
+        assert alice.wait_for('Channel "c2" is not available.', timeout=10)
+        assert bob.wait_for("[alice] still here")
+    finally:
+        os.kill(owner, signal.SIGCONT)
+
+def test_switch_to_a_channel_of_another_worker(start_server, clients):
+    server = start_server(channels=(("c1", 5), ("c2", 5)), env={"CHATSERVER_WORKERS": 2})
+    alice = FramedClient(server.ports["c1"], "alice", codecs=("zlib",))
+    bob = PlainClient(server.ports["c2"], "bob")
+    clients += [alice, bob]
+    assert server.wait_for_line("bob has joined") and alice.wait_for("Welcome")
+
+    alice.send("/switch c2")
+    assert alice.wait_for('[Server Message] You have joined the channel "c2".')
+    alice.send("hello c2")
+    assert bob.wait_for("[alice] hello c2")
+    bob.send("hello alice")
+    assert alice.wait_for("[bob] hello alice")
+
+def test_switch_follows_reloaded_channels_of_other_workers(start_server, clients):
+    server = start_server(channels=(("c1", 5), ("c2", 5)), env={"CHATSERVER_WORKERS": 2})
+    alice = PlainClient(server.ports["c1"], "alice")
+    clients.append(alice)
+    assert alice.wait_for("You have joined")
+
+    # c2 goes, c3 is new and served by the other worker, the one with fewer channels
+    server.ports["c3"] = server.spare_port
+    server.write_config((("c1", 5), ("c3", 5)))
+    server.admin("/reload")
+    assert server.wait_for_line("[Server Message] Configuration reloaded.")
+    def listed():
+        alice.send("/list") # the supervisor logs the reload before alice's worker has applied it
+        return alice.wait_for(f"[Channel] c3 {server.ports['c3']}", timeout=0.5)
+    assert wait_for(listed)
+    alice.send("/switch c2")
+    assert alice.wait_for('[Server Message] Channel "c2" does not exist.')
+    alice.send("/switch c3")
+    assert alice.wait_for('[Server Message] You have joined the channel "c3".')